@@ -1,19 +1,53 @@
+import atexit
+import concurrent.futures
+import hmac
+import contextvars
+import math
 import logging
 import os
+import random
 import sys
 import re
+import threading
+import time
+from collections import Counter
 from datetime import datetime, timedelta
-from functools import wraps
-import pytz
+from functools import lru_cache
 
-import requests
-from bs4 import BeautifulSoup
-from werkzeug.contrib.cache import SimpleCache
 
-from flask import Flask, json, request, jsonify
-from fuzzywuzzy import fuzz, process
-from utils.fetch import random_user_agent as _random_user_agent
+from flask import Flask, Response, g, json, request, jsonify, send_file
+from utils.fetch import get_client as _get_client
+from utils.egress import get_egress as _get_egress
+from utils.aio import get_engine as _get_engine
 from utils.parser import parse_time as _parse_time
+from utils.parser import parse_departure_table as _parse_departure_table
+from utils.cache import TTLCache, get_backend
+from utils.breaker import CLOSED, CircuitBreaker, CircuitOpenError
+from utils.hedge import HedgedFetcher, LatencyTracker, RetryBudget
+from utils.stations import StationRefresher, load_station_map
+from utils.payload import Payload
+from utils.payload import dumps as _dumps
+from utils.prefetch import HotStations, PrefetchScheduler
+from utils.ratelimit import TokenBucket
+from utils import admission as _admission
+from utils import deadline as _deadline
+from utils.deadline import DeadlineExceeded
+from utils.admission import API, BACKGROUND, INTERACTIVE
+from utils.admission import AdmissionController, AdmissionRejected, SharedTokenBucket
+from utils.snapshot import NetworkCrawler
+from utils.stream import StreamHub
+from utils.history import DepartureHistory
+from utils.export import FORMATS as _EXPORT_FORMATS
+from utils.export import ordered_results
+from utils.export import serialize as _serialize_export
+from utils.slack import SLACK_RESPONSE_HOSTS, DeferredResponder
+from utils.slack import allowed_response_url, response_host, verify_signature
+from utils.profiler import MODES as _PROFILE_MODES
+from utils.profiler import ProfileStore, RequestProfile
+from utils import metrics as _metrics_module
+from utils.metrics import registry as _metrics
+from utils.metrics import span as _span
+from utils.metrics import timed as _timed
 
 logging.basicConfig()
 logger = logging.getLogger('app')
@@ -24,10 +58,7 @@ __location__ = os.path.realpath(
     os.path.join(__cwd__, os.path.dirname(__file__))
 )
 
-with open(os.path.join(__location__, 'utils', 'stations.json'), 'r') as fp:
-    _STATIONS = json.load(fp)
-
-_INVERSE_STATIONS = {value:key for key, value in _STATIONS.items()}
+_STATIONS_PATH = os.path.join(__location__, 'utils', 'stations.json')
 
 _FOOTER_MESSAGE = {
         "type": "context",
@@ -84,6 +115,16 @@ _HELP_MESSAGE = [
     {
         "type": "divider"
     },
+    {
+        "type": "section",
+        "text": {
+            "type": "mrkdwn",
+            "text": "`/kvb station a, station b`: retrieve departures at several stations at once.\n\n:point_right: `/kvb dom, neumarkt -l 16` will return the schedules of line 16 at Dom/Hbf and Neumarkt."
+        }
+    },
+    {
+        "type": "divider"
+    },
     {
         "type": "section",
         "text": {
@@ -97,173 +138,779 @@ _HELP_MESSAGE = [
 
 app = Flask(__name__)
 
-cache = SimpleCache()
+# shared by the workers of a node, see KVB_CACHE_URL
+cache = get_backend(
+    os.environ.get('KVB_CACHE_URL'),
+    maxsize=int(os.environ.get('KVB_CACHE_MAXSIZE', 10000))
+)
+
+# points the app to a stand-in of kvb.koeln, e.g., benchmarks/kvb_server.py
+_KVB_BASE_URL = os.environ.get('KVB_BASE_URL', 'https://www.kvb.koeln').rstrip('/')
+
+# 'async' downloads on the event loop of utils.aio, 'sync' on the pooled session,
+# 'egress' through the pool of luminati proxy sessions of utils.egress
+_FETCH_ENGINE = os.environ.get('KVB_FETCH_ENGINE', 'async')
+
+# batch requests fetch their stations concurrently on a shared, bounded pool
+_BATCH_EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+    max_workers=int(os.environ.get('KVB_BATCH_WORKERS', 8)),
+    thread_name_prefix='kvb-batch'
+)
+_BATCH_MAX_STATIONS = int(os.environ.get('KVB_BATCH_MAX_STATIONS', 20))
+_BATCH_DEADLINE = float(os.environ.get('KVB_BATCH_DEADLINE', 5))
+# slack gives up after 3 seconds
+_SLACK_BATCH_DEADLINE = 2.5
+# acknowledge slash commands at once and post the reply to the response_url
+_SLACK_DEFERRED = os.environ.get('KVB_SLACK_DEFERRED', '1') == '1'
+
+# exports fetch their stations on a pool of their own, never more than the window ahead of the response
+_EXPORT_EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+    max_workers=int(os.environ.get('KVB_EXPORT_WORKERS', 4)),
+    thread_name_prefix='kvb-export'
+)
+_EXPORT_WINDOW = int(os.environ.get('KVB_EXPORT_WINDOW', 16))
+# exports running per client in this worker
+_EXPORTS_PER_CLIENT = int(os.environ.get('KVB_EXPORTS_PER_CLIENT', 1))
+_export_clients = Counter()
+_export_clients_lock = threading.Lock()
+
+# browsers and CDNs may keep the station list this long before revalidating it
+_STATIONS_MAX_AGE = int(os.environ.get('KVB_STATIONS_MAX_AGE', 3600))
+
+# see utils.parser.PARSER_BACKENDS
+_PARSER_BACKEND = os.environ.get('KVB_PARSER_BACKEND', 'lxml')
+
+# departures are shared between all requests for the same station
+departures_cache = TTLCache(
+    ttl=int(os.environ.get('KVB_DEPARTURES_TTL', 20)),
+    backend=cache,
+    namespace='departures:',
+    stale_ttl=int(os.environ.get('KVB_DEPARTURES_STALE_TTL', 900))
+)
+
+# stop calling kvb.koeln while it is down and serve the cached departures instead
+upstream_breaker = CircuitBreaker(
+    'kvb.koeln',
+    failure_threshold=int(os.environ.get('KVB_BREAKER_FAILURES', 5)),
+    reset_timeout=float(os.environ.get('KVB_BREAKER_RESET', 30))
+)
+
+# every kvb.koeln request is admitted first: interactive slack commands go
+# before api requests, which go before background work
+upstream_admission = AdmissionController(
+    SharedTokenBucket(cache, rate=float(os.environ.get('KVB_UPSTREAM_RATE', 10)))
+    if os.environ.get('KVB_UPSTREAM_SHARED', '1') == '1'
+    else TokenBucket(rate=float(os.environ.get('KVB_UPSTREAM_RATE', 10))),
+    max_waits={
+        INTERACTIVE: float(os.environ.get('KVB_ADMISSION_WAIT_INTERACTIVE', 2.5)),
+        API: float(os.environ.get('KVB_ADMISSION_WAIT_API', 1)),
+        BACKGROUND: float(os.environ.get('KVB_ADMISSION_WAIT_BACKGROUND', 30)),
+    },
+    client_rate=float(os.environ.get('KVB_CLIENT_RATE', 2)),
+    client_burst=float(os.environ.get('KVB_CLIENT_BURST', 10)),
+)
+
+# downloads of the sync and egress engines, hedged requests run next to the first one
+_FETCH_EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+    max_workers=int(os.environ.get('KVB_FETCH_THREADS', 32)),
+    thread_name_prefix='kvb-fetch'
+)
+
+
+def _download(url, station=None):
+    if _FETCH_ENGINE == 'egress':
+        page = _get_egress().get(url, key=station)
+    else:
+        page = _get_client().get(url)
+    return page.status_code, page.text
+
+
+def _submit_download(url, station=None):
+    if _FETCH_ENGINE == 'async':
+        engine = _get_engine()
+        return engine.submit(engine.fetch(url))
+    # the download trims its timeouts to the deadline of the request
+    return _FETCH_EXECUTOR.submit(contextvars.copy_context().run, _download, url, station)
 
 
-def search_station(st):
+def parse_deadlines(value):
+    """
+    parse_deadlines reads seconds per endpoint, e.g., 'get_network_departures=20,slack_kvb_departures=2'
+
+    0 leaves an endpoint without a deadline.
+
+    :rtype: dict
+    """
+    deadlines = {}
+    for item in value.split(','):
+        if not item.strip():
+            continue
+        endpoint, seconds = item.split('=')
+        seconds = float(seconds)
+        deadlines[endpoint.strip()] = seconds if seconds > 0 else None
+    return deadlines
+
+
+# seconds a request has to answer, every upstream call within it gets what is left, see utils.deadline
+_REQUEST_DEADLINE = float(os.environ.get('KVB_REQUEST_DEADLINE', 10))
+# clients may ask for another deadline with X-Request-Deadline, up to this many seconds
+_REQUEST_DEADLINE_MAX = float(os.environ.get('KVB_REQUEST_DEADLINE_MAX', 30))
+_DEADLINES = {
+    'slack_kvb_departures': _SLACK_BATCH_DEADLINE,
+    'get_stations_departures': _BATCH_DEADLINE,
+    'post_stations_departures': _BATCH_DEADLINE,
+    'stream_departures': None,
+    'export_departures': None,
+    'metrics': None,
+    'admin_profiles': None,
+    'admin_profile': None,
+}
+_DEADLINES.update(parse_deadlines(os.environ.get('KVB_DEADLINES', '')))
+
+
+# hedges slow kvb requests and retries failed ones, never while the circuit is not closed
+_HEDGE = os.environ.get('KVB_HEDGE', '1') == '1'
+upstream_fetcher = HedgedFetcher(
+    _submit_download,
+    tracker=LatencyTracker(window=int(os.environ.get('KVB_HEDGE_WINDOW', 1000))),
+    budget=RetryBudget(ratio=float(os.environ.get('KVB_HEDGE_BUDGET', 0.1))),
+    quantile=float(os.environ.get('KVB_HEDGE_QUANTILE', 0.95)),
+    retries=int(os.environ.get('KVB_RETRIES', 2)),
+    retry_base=float(os.environ.get('KVB_RETRY_BASE', 0.25)),
+    retry_mode=os.environ.get('KVB_RETRY_MODE', 'multirand'),
+    deadline=float(os.environ.get('KVB_FETCH_DEADLINE', 8)),
+    allow=lambda: upstream_breaker.state == CLOSED,
+)
+
+# hot stations are learned from the requests and kept warm in the background
+hot_stations = HotStations(
+    window=int(os.environ.get('KVB_PREFETCH_WINDOW', 900))
+)
+prefetcher = PrefetchScheduler(
+    refresh=lambda station: prefetch_departures(station),
+    # the cache is shared by the workers, one refresh per station and round is enough
+    needed=lambda station: departures_cache.get(str(station), min_ttl=prefetcher.max_interval) is None,
+    hot_stations=hot_stations,
+    limiter=TokenBucket(rate=float(os.environ.get('KVB_PREFETCH_RATE', 2))),
+    stations=[
+        i.strip() for i in os.environ.get('KVB_PREFETCH_STATIONS', '').split(',')
+        if i.strip()
+    ],
+    interval=float(os.environ.get('KVB_PREFETCH_INTERVAL', 15)),
+    max_hot=int(os.environ.get('KVB_PREFETCH_MAX_HOT', 10)),
+)
+
+
+@lru_cache(maxsize=None)
+def _berlin_tz():
+    # pytz is imported on first use to keep the start of the app fast
+    import pytz
+    return pytz.timezone('Europe/Berlin')
+
+
+@_timed('search_station')
+def search_station(st, station_map=None):
     """
     search_station searches among the existing database of the stations and finds the best match of the input
 
     :param st: input station name to be searched
     :type st: str
+    :param station_map: map to search in, defaults to the one in use
+    :type station_map: utils.stations.StationMap
     :return: best match of the station name and id
     :rtype: str
     """
 
-    res = []
-    for key, val in _STATIONS.items():
-        score = fuzz.token_set_ratio(st, key)
-        res.append(
-            {
-                'station': key,
-                'score': score,
-                'station_id': val
-            }
-        )
+    if station_map is None:
+        station_map = _STATION_MAP
+    res = station_map.index.search(st)
     if not res:
         return {}
     else:
-        res = sorted(res, key=lambda k: k['score'], reverse=True)
-        res = res[0]
-        return res
+        return res[0]
 
 
-def cached(timeout=30, key='view/%s'):
-    def decorator(f):
-        @wraps(f)
-        def decorated_function(*args, **kwargs):
-            cache_key = key % request.path
-            rv = cache.get(cache_key)
-            if rv is not None:
-                return rv
-            rv = f(*args, **kwargs)
-            cache.set(cache_key, rv, timeout=timeout)
-            return rv
-        return decorated_function
-    return decorator
+def payload_response(payload, max_age=0):
+    """
+    payload_response sends a serialized payload with its ETag and Cache-Control
 
+    The body is compressed with the best encoding the client accepts. GET
+    requests whose If-None-Match carries the ETag are answered with 304 Not
+    Modified and no body.
 
-def get_departures(station):
+    :param payload: serialized body
+    :type payload: utils.payload.Payload
+    :param max_age: seconds clients may reuse the response, 0 makes them revalidate every time
+    :type max_age: int
+    :rtype: flask.Response
     """
-    get_departures extracts the departure time at the station
+    encoding = payload.negotiate(request.accept_encodings)
+    etag = payload.variant_etag(encoding)
+
+    response = Response(status=200, content_type=payload.content_type)
+    response.set_etag(etag)
+    response.vary.add('Accept-Encoding')
+    if max_age > 0:
+        response.headers['Cache-Control'] = f'public, max-age={int(max_age)}'
+    else:
+        response.headers['Cache-Control'] = 'no-cache'
 
-    :param station_id: id of the station, e.g., 46 is Drehbrucke
-    :type station_id: int
-    :return: json data of the departure times
-    :rtype: dict
+    if request.method in ('GET', 'HEAD') and request.if_none_match.contains(etag):
+        _metrics.inc('tram_bot_payload_responses_total', status=304, encoding=encoding or 'identity')
+        response.status_code = 304
+        return response
+
+    _metrics.inc('tram_bot_payload_responses_total', status=200, encoding=encoding or 'identity')
+    response.set_data(payload.variant(encoding))
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def shed_response(departures):
+    """
+    shed_response answers a request whose kvb.koeln fetch was not admitted with 429 or 503 and Retry-After
+    """
+    return jsonify(departures), departures['status'], {'Retry-After': str(departures['retry_after'])}
+
+
+# last serialized departures per station id of the station map, see departures_payload
+_DEPARTURES_PAYLOADS = {}
+
+
+def departures_payload(departures):
+    """
+    departures_payload serializes the departures of a station, reusing the last body while the data is unchanged
+
+    Renders differ in local_time and age only as long as the same fetch is
+    shown and no departure minute has passed, so the first body is kept and
+    its ETag stays valid until the departures actually change. Only stations
+    of the station map are remembered, any id may be requested, and only
+    departures with status 200 are passed in.
+
+    :param departures: result of retrieve_departures
+    :type departures: dict
+    :rtype: utils.payload.Payload
+    """
+    station = departures.get('station') or {}
+    version = _dumps([
+        departures['status'], departures.get('fetched_at'), departures.get('stale'),
+        departures.get('message'), station, departures['departures'],
+        departures.get('upstream', {}).get('breaker')
+    ])
+
+    key = station.get('id')
+    if key not in _STATION_MAP.inverse:
+        return Payload.from_json(departures)
+    last = _DEPARTURES_PAYLOADS.get(key)
+    if last is not None and last[0] == version:
+        return last[1]
+
+    payload = Payload.from_json(departures)
+    _DEPARTURES_PAYLOADS[key] = (version, payload)
+    return payload
+
+
+def departures_max_age(departures):
+    """
+    departures_max_age is the number of seconds the departures stay fresh in the cache
+    """
+    if departures['status'] != 200 or departures.get('stale'):
+        return 0
+    return max(departures_cache.ttl - departures.get('age', 0), 0)
+
+
+
+def departures_url(station):
+    """
+    departures_url is the kvb page listing the next departures of a station
     """
 
     # We use the overview page for the departure time
     # url = f"https://www.kvb.koeln/haltestellen/overview/{station}/"
-    url = f"https://www.kvb.koeln/qr/{station}/"
+    return f"{_KVB_BASE_URL}/qr/{station}/"
+
 
-    req = requests.get(url, headers=_random_user_agent())
-    soup = BeautifulSoup(req.text, "lxml")
-    tables = soup.find('table', id='qr_ergebnis')
-    if not tables:
+def fetch_departures(station):
+    """
+    fetch_departures downloads and parses the departure table of a station from kvb
+
+    The departure times are kept relative to the moment of the fetch so that
+    cached results can be rendered again later. The download goes through the
+    engine selected with KVB_FETCH_ENGINE, after upstream_admission let it
+    through, and the circuit breaker of kvb.koeln: while it is open
+    CircuitOpenError is raised without a request. With
+    KVB_HEDGE slow requests are hedged and failed ones retried, see
+    upstream_fetcher.
+
+    :param station: id of the station, e.g., 46 is Drehbrucke
+    :type station: int
+    :return: fetch timestamp and parsed departures
+    :rtype: dict
+    """
+
+    url = departures_url(station)
+
+    # no request is started without time left to wait for its answer
+    _deadline.check(f'fetch the departures of {station}')
+    # may wait for a token or raise AdmissionRejected
+    upstream_admission.admit()
+
+    if not upstream_breaker.allow():
+        raise CircuitOpenError(f'kvb.koeln is unavailable, retrying in {upstream_breaker.reset_timeout} seconds')
+
+    with _span('fetch'):
+        try:
+            if _HEDGE:
+                status, html = upstream_fetcher.get(url, station=station)
+            elif _FETCH_ENGINE == 'async':
+                status, html = _get_engine().get(url, timeout=_deadline.remaining())
+            else:
+                status, html = _download(url, station)
+        except Exception:
+            _metrics.inc('tram_bot_upstream_responses_total', status='error')
+            upstream_breaker.record_failure()
+            raise
+    _metrics.inc('tram_bot_upstream_responses_total', status=status)
+    if status >= 500:
+        upstream_breaker.record_failure()
+        raise Exception(f'kvb.koeln answered {status} for station {station}')
+    upstream_breaker.record_success()
+    fetched_at = time.time()
+
+    with _span('parse'):
+        fetched = parse_departures(station, html, fetched_at)
+
+    if departure_history is not None and str(station).isdigit():
+        departure_history.record(int(station), fetched)
+    return fetched
+
+
+def parse_departures(station, html, fetched_at):
+    """
+    parse_departures extracts the departure table from a downloaded kvb page
+
+    :param station: id of the station
+    :type station: int
+    :param html: html of the departure page
+    :type html: str
+    :param fetched_at: unix timestamp of the download
+    :type fetched_at: float
+    :return: fetch timestamp and parsed departures
+    :rtype: dict
+    """
+    departures = _parse_departure_table(html, backend=_PARSER_BACKEND)
+    if departures is None:
+        _metrics.inc('tram_bot_parse_failures_total', kind='table')
         logger.warning(f'can not get info for station {station}')
         return {
-            'status': 200,
-            'data': []
+            'fetched_at': fetched_at,
+            'departures': []
         }
     else:
-        logger.debug(f'got timetable for {station}: {tables}')
-
-    # define the column names of the table
-    fields = ['line', 'terminal', 'departures_in']
-
-    departures = [
-        dict(
-            zip(fields, [cell.text for cell in row("td")])
-        )
-        for row in tables('tr')
-    ]
+        logger.debug(f'got timetable for {station}: {departures}')
 
-    res_data = []
-    kvb_local_time = datetime.now(pytz.timezone('Europe/Berlin'))
     for dep in departures:
-        dep_parse_time = {}
+        if not dep:
+            # header rows have no cells
+            continue
         try:
-            dep_parse_time = _parse_time(dep.get('departures_in',''))
-            dep['departures_in'] = '{value} {unit}'.format(
-                **dep_parse_time
-            )
+            dep['parsed_time'] = _parse_time(dep.get('departures_in',''))
         except Exception as e:
+            _metrics.inc('tram_bot_parse_failures_total', kind='time')
             logger.error(f'Could not parse departure time: {e}')
 
+    return {
+        'fetched_at': fetched_at,
+        'departures': departures
+    }
+
+
+def render_departures(fetched, now=None):
+    """
+    render_departures converts fetched departures into the api format
+
+    departures_in is recomputed from the fetch timestamp so that cached data
+    stays correct, departures that have left since the fetch are dropped.
+    age is the number of seconds since the fetch and stale tells whether the
+    data is older than KVB_DEPARTURES_TTL.
+
+    :param fetched: result of fetch_departures
+    :type fetched: dict
+    :param now: unix timestamp to render the departures for, defaults to now
+    :type now: float
+    :return: json data of the departure times
+    :rtype: dict
+    """
+    if now is None:
+        now = time.time()
+
+    tz = _berlin_tz()
+    kvb_local_time = datetime.fromtimestamp(now, tz)
+    kvb_fetch_time = datetime.fromtimestamp(fetched['fetched_at'], tz)
+    age = max(now - fetched['fetched_at'], 0)
+    elapsed_minutes = int(age // 60)
+
+    res_data = []
+    for dep in fetched['departures']:
+        dep = dict(dep)
+        dep_parse_time = dep.pop('parsed_time', None)
         if dep_parse_time:
-            dep_departure_time = (
-                kvb_local_time + timedelta(minutes=dep_parse_time.get('value'))
+            if elapsed_minutes and dep_parse_time['value'] < elapsed_minutes:
+                # left since the fetch
+                continue
+            dep['departures_in'] = '{value} {unit}'.format(
+                value=max(dep_parse_time['value'] - elapsed_minutes, 0),
+                unit=dep_parse_time['unit']
+            )
+            dep['departures_at'] = (
+                kvb_fetch_time + timedelta(minutes=dep_parse_time['value'])
             ).strftime('%H:%M')
-            dep['departures_at'] = dep_departure_time
 
         res_data.append(dep)
 
     res_dict = {
         'status': 200,
         'local_time': kvb_local_time.isoformat(),
+        'fetched_at': kvb_fetch_time.isoformat(),
+        'age': int(age),
+        'stale': age > departures_cache.ttl,
         #'data': res_data,
-        'departures': res_data
+        'departures': res_data,
+        'upstream': upstream_breaker.snapshot()
     }
 
     return res_dict
 
 
-def retrieve_departures(station):
+def cached_departures(station, attempts=3):
     """
-    retrieve_departures retrieves departures at a station for a given station id or name
+    cached_departures returns the fetched departures of a station from the departures cache, fetching them if needed
+
+    Requests for a station being fetched wait for that fetch. If it was
+    refused for the quota of the client that started it, the waiting requests
+    do not get its 429 but fetch on their own account.
+
+    :return: result of fetch_departures
+    :rtype: dict
     """
-    message = 'successfully downloaded info'
+    client = _admission.current()[1]
+    for attempt in range(attempts):
+        try:
+            return departures_cache.get_or_set(
+                str(station), lambda: fetch_departures(station), serve_stale=True
+            )
+        except AdmissionRejected as e:
+            if e.client is None or e.client == client or attempt == attempts - 1:
+                raise
+
+
+def get_departures(station, track=True):
+    """
+    get_departures extracts the departure time at the station
+
+    Departures are shared through a per-station cache, see KVB_DEPARTURES_TTL.
+    Expired departures are served at once, marked as stale, while they are
+    refreshed in the background. If kvb.koeln fails and nothing is cached
+    the status is 503, 504 if the deadline of the request was reached first.
+
+    :param station_id: id of the station, e.g., 46 is Drehbrucke
+    :type station_id: int
+    :param track: count the request for the hot stations kept warm by the prefetcher, if the station is in the map
+    :type track: bool
+    :return: json data of the departure times
+    :rtype: dict
+    """
+
+    if track and str(station).isdigit() and int(station) in _STATION_MAP.inverse:
+        # only stations of the map, made up ids would be prefetched from kvb.koeln
+        hot_stations.record(str(station))
+    try:
+        fetched = cached_departures(station)
+    except Exception as e:
+        # a request timeout cut to the deadline says so by leaving no time
+        timed_out = (
+            isinstance(e, (DeadlineExceeded, concurrent.futures.TimeoutError)) or _deadline.remaining(1) <= 0
+        )
+        if timed_out:
+            _metrics.inc('tram_bot_deadline_exceeded_total', stage='fetch')
+            logger.warning(f'no departures for {station} within the deadline of the request')
+        else:
+            logger.error(f'could not fetch departures for {station}: {e}')
+        fetched = departures_cache.get_stale(str(station))
+        if fetched is None and network_crawler.snapshot is not None and str(station).isdigit():
+            # the last sweep of the network may still know the station
+            fetched = network_crawler.snapshot.fetched(int(station))
+        if fetched is None:
+            unavailable = {
+                'status': 503,
+                'message': f'departures are unavailable: {e}',
+                'local_time': datetime.now(tz=_berlin_tz()).isoformat(),
+                'departures': [],
+                'upstream': upstream_breaker.snapshot()
+            }
+            if isinstance(e, AdmissionRejected):
+                # shed, the client should come back later
+                unavailable['status'] = e.status
+                unavailable['retry_after'] = math.ceil(e.retry_after)
+            elif timed_out:
+                unavailable['status'] = 504
+            return unavailable
+
+    departures = render_departures(fetched)
+    if departures['stale']:
+        _metrics.inc('tram_bot_stale_responses_total')
+
+    return departures
+
+
+def refresh_departures(station):
+    """
+    refresh_departures fetches departures of a station into the departures cache
+
+    :return: result of fetch_departures
+    :rtype: dict
+    """
+    fetched = fetch_departures(station)
+    departures_cache.set(str(station), fetched)
+    return fetched
+
+
+def prefetch_departures(station):
+    """
+    prefetch_departures refreshes the departures of a station that expire before the next prefetch round
+
+    The refresh takes the lock of the departures cache, a station refreshed
+    by another worker meanwhile is not fetched again.
+
+    :return: whether kvb.koeln was asked
+    :rtype: bool
+    """
+    return departures_cache.refresh(
+        str(station), lambda: fetch_departures(station), min_ttl=prefetcher.max_interval
+    )
+
+
+def resolve_station(station):
+    """
+    resolve_station maps a user input to a station name and id
+
+    Results are memoized since users send the same few queries over and over,
+    the hit and miss counters are available from _resolve_station.cache_info().
+
+    :param station: station name, part of it or station id
+    :type station: str
+    :return: station name, station id and the search result if the input had to be searched
+    :rtype: tuple
+    """
+    return _resolve_station(station, _STATION_MAP)
+
+
+@lru_cache(maxsize=int(os.environ.get('KVB_RESOLVE_CACHE_SIZE', 1024)))
+def _resolve_station(station, station_map):
+    # the map is part of the key, a result never outlives the map it was resolved in
+    station_searched = None
     if isinstance(station, (int, float)) or station.isdigit():
         station_id = int(float(station))
-        station = _INVERSE_STATIONS.get(station_id)
-    elif isinstance(station, str) and (not station.isdigit()):
+        station = station_map.inverse.get(station_id)
+    else:
         station = station.lower()
-        if station.isdigit():
-            station_id = station
-        elif _STATIONS.get(station):
-            station_id = _STATIONS.get(station)
+        if station_map.stations.get(station):
+            station_id = station_map.stations.get(station)
         else:
-            station_searched = search_station(station)
+            # the fuzzy search is the slow part, exceptions are not memoized
+            _deadline.check('search the station')
+            station_searched = search_station(station, station_map)
             station_id = station_searched.get('station_id')
-            message = f'{message}; checking departures for  {station_searched}'
             station = station_searched.get('station')
-    else:
+
+    return station, station_id, station_searched
+
+
+def swap_stations(station_map):
+    """
+    swap_stations puts a station map in use
+
+    The map comes with all its derived structures, so one assignment swaps
+    them all and requests never see names of one map with the index of another.
+
+    :param station_map: new station map
+    :type station_map: utils.stations.StationMap
+    """
+    global _STATION_MAP
+
+    _STATION_MAP = station_map
+    _resolve_station.cache_clear()
+
+
+def load_stations(path=_STATIONS_PATH):
+    """
+    load_stations (re)loads the station map and everything derived from it
+
+    The map is unpickled from the file prebuilt by `python -m utils.stations build`
+    as long as it was built from path, otherwise it is built from path.
+
+    :param path: path to the json file of station names and ids
+    :type path: str
+    """
+    swap_stations(load_station_map(stations_path=path))
+
+
+load_stations()
+
+# the map is checked against the kvb overview page in the background
+station_refresher = StationRefresher(
+    current=lambda: _STATION_MAP,
+    swap=swap_stations,
+    interval=float(os.environ.get('KVB_STATIONS_REFRESH', 21600)),
+    admit=lambda: upstream_admission.admit(BACKGROUND)
+)
+
+# sweeps all stations into one snapshot of the network, see KVB_CRAWL
+network_crawler = NetworkCrawler(
+    fetch=refresh_departures,
+    stations=lambda: list(_STATION_MAP.inverse),
+    limiter=TokenBucket(rate=float(os.environ.get('KVB_CRAWL_RATE', 5))),
+    concurrency=int(os.environ.get('KVB_CRAWL_CONCURRENCY', 8)),
+    interval=float(os.environ.get('KVB_CRAWL_INTERVAL', 300)),
+    backend=cache
+)
+
+# records every fetched departure for analytics, see KVB_HISTORY
+departure_history = DepartureHistory(
+    path=os.environ.get('KVB_HISTORY_PATH'),
+    buffer_size=int(os.environ.get('KVB_HISTORY_BUFFER', 50000)),
+    flush_interval=float(os.environ.get('KVB_HISTORY_FLUSH', 5)),
+    retention=float(os.environ.get('KVB_HISTORY_RETENTION', 0))
+) if os.environ.get('KVB_HISTORY', '0') == '1' else None
+
+
+@_timed('retrieve_departures')
+def retrieve_departures(station):
+    """
+    retrieve_departures retrieves departures at a station for a given station id or name
+    """
+    message = 'successfully downloaded info'
+    if not isinstance(station, (int, float, str)):
         return json.dumps({
             'status': 200,
             'message': 'input station {} is invalid'.format(station),
             'data': []
         })
 
+    try:
+        station, station_id, station_searched = resolve_station(station)
+    except DeadlineExceeded as e:
+        _metrics.inc('tram_bot_deadline_exceeded_total', stage='resolve')
+        return {
+            'status': 504,
+            'message': str(e),
+            'local_time': datetime.now(tz=_berlin_tz()).isoformat(),
+            'station': {'name': station, 'id': None},
+            'departures': []
+        }
+    if station_searched is not None:
+        message = f'{message}; checking departures for  {station_searched}'
+
     departures = get_departures(station_id)
-    departures['message'] = message
+    if departures['status'] == 200 and departures['stale']:
+        message = f'{message}; departures are {departures["age"]} seconds old, refreshing'
+    departures.setdefault('message', message)
     departures['station'] = {'name': station, 'id': station_id}
 
     return departures
 
 
+def retrieve_departures_batch(stations, deadline=None):
+    """
+    retrieve_departures_batch retrieves departures at several stations concurrently
+
+    Stations are fetched on a bounded thread pool. Stations that are not done
+    when the deadline is reached are returned as timed out instead of holding
+    back the others, the deadline of the request is never exceeded.
+
+    :param stations: station names or ids
+    :type stations: list
+    :param deadline: seconds to wait for all stations, defaults to KVB_BATCH_DEADLINE
+    :type deadline: float
+    :return: departures of every station in the order of the input
+    :rtype: dict
+    """
+    if deadline is None:
+        deadline = _BATCH_DEADLINE
+    deadline = min(deadline, _deadline.remaining(deadline))
+
+    stations = stations[:_BATCH_MAX_STATIONS]
+    futures = [
+        # the stations are fetched with the priority, client and deadline of the request
+        _BATCH_EXECUTOR.submit(contextvars.copy_context().run, retrieve_departures, station)
+        for station in stations
+    ]
+    done, not_done = concurrent.futures.wait(futures, timeout=deadline)
+
+    results = []
+    for station, future in zip(stations, futures):
+        if future in not_done:
+            results.append({
+                'status': 504,
+                'message': f'timed out after {deadline:.1f} seconds',
+                'station': {'name': station, 'id': None},
+                'departures': []
+            })
+        elif future.exception() is not None:
+            logger.error(f'could not retrieve departures for {station}: {future.exception()}')
+            results.append({
+                'status': 502,
+                'message': f'could not retrieve departures: {future.exception()}',
+                'station': {'name': station, 'id': None},
+                'departures': []
+            })
+        else:
+            results.append(future.result())
+
+    return {
+        'status': 200,
+        'local_time': datetime.now(tz=_berlin_tz()).isoformat(),
+        'timed_out': len(not_done),
+        'stations': results
+    }
+
+
 @app.route("/")
 def index():
     output = {
-        "local_time": datetime.now(tz=pytz.timezone('Europe/Berlin')).isoformat(),
+        "local_time": datetime.now(tz=_berlin_tz()).isoformat(),
         "methods": {
             "departures": "/station/{station_id}/departures/",
-            "stations": "/station/"
+            "stations": "/station/",
+            "batch": "/stations/departures/?stations={station},{station}",
+            "network": "/network/departures/?within={minutes}&line={line}",
+            "history": "/history/departures/?station={station}&line={line}&since={time}&until={time}",
+            "export": "/export/departures/?stations={station},{station}&format={ndjson|csv}"
         }
     }
     return json.dumps(output)
 
 @app.route("/station/")
-@cached()
 def stations_list():
-    return json.dumps(_STATIONS)
+    return payload_response(_STATION_MAP.payload, max_age=_STATIONS_MAX_AGE)
 
 @app.route("/station/<int:station>/departures/")
 @app.route("/station/<station>/departures/")
 def get_station_departures(station):
 
     departures = retrieve_departures(station)
-    return json.dumps(departures)
+    if not isinstance(departures, dict):
+        # invalid input, already serialized
+        return departures
+    if 'retry_after' in departures:
+        return shed_response(departures)
+    if departures['status'] != 200:
+        # errors are neither remembered nor revalidated
+        return jsonify(departures), departures['status']
+    return payload_response(
+        departures_payload(departures), max_age=departures_max_age(departures)
+    )
 
 
 @app.route("/station", methods = ['POST'])
@@ -279,10 +926,364 @@ def post_station_departures():
             raise Exception("Can not convert input station into str")
 
     departures = retrieve_departures(station)
+    if not isinstance(departures, dict):
+        return departures
+    if 'retry_after' in departures:
+        return shed_response(departures)
+    if departures['status'] != 200:
+        return jsonify(departures), departures['status']
+
+    return payload_response(Payload.from_json(departures))
+
+
+@app.route("/stations/departures/")
+def get_stations_departures():
+
+    stations = [
+        i.strip() for i in request.args.get('stations', '').split(',') if i.strip()
+    ]
+    deadline = request.args.get('deadline', type=float)
+    if deadline is not None:
+        deadline = min(deadline, _BATCH_DEADLINE)
 
-    return json.dumps(departures)
+    departures = retrieve_departures_batch(stations, deadline=deadline)
 
+    return payload_response(Payload.from_json(departures))
 
+
+@app.route("/stations", methods = ['POST'])
+def post_stations_departures():
+
+    data = request.json
+    stations = [str(i) for i in data.get("stations", [])]
+
+    departures = retrieve_departures_batch(stations)
+
+    return payload_response(Payload.from_json(departures))
+
+
+def retrieve_network_departures(within=10, line=None):
+    """
+    retrieve_network_departures lists what departs anywhere on the network in the next minutes
+
+    The departures come from the last sweep of NetworkCrawler, so they are
+    up to KVB_CRAWL_INTERVAL seconds plus the duration of a sweep old.
+
+    :param within: minutes from now
+    :type within: int
+    :param line: only departures of this line
+    :type line: str
+    :return: departures of all stations, soonest first
+    :rtype: dict
+    """
+    local_time = datetime.now(tz=_berlin_tz())
+    snapshot = network_crawler.snapshot
+    if snapshot is None:
+        return {
+            'status': 503,
+            'message': 'no snapshot of the network yet, see KVB_CRAWL',
+            'local_time': local_time.isoformat(),
+            'departures': []
+        }
+
+    departures = snapshot.departing_within(within, line=line)
+    for dep in departures:
+        dep['station'] = _STATION_MAP.inverse.get(dep['station_id'])
+
+    return {
+        'status': 200,
+        'local_time': local_time.isoformat(),
+        'crawled_at': datetime.fromtimestamp(snapshot.crawled_at, _berlin_tz()).isoformat(),
+        'age': int(time.time() - snapshot.crawled_at),
+        'within': within,
+        'stations': snapshot.stations,
+        'departures': departures
+    }
+
+
+@app.route("/network/departures/")
+def get_network_departures():
+
+    within = min(request.args.get('within', 10, type=int), 60)
+    line = request.args.get('line')
+
+    departures = retrieve_network_departures(within=within, line=line)
+
+    if departures['status'] != 200:
+        return jsonify(departures), departures['status']
+    return payload_response(Payload.from_json(departures))
+
+
+def parse_timestamp(value):
+    """
+    parse_timestamp reads a unix timestamp or an ISO 8601 time, local to Cologne unless it has an offset
+
+    :rtype: float
+    """
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = _berlin_tz().localize(parsed)
+    return parsed.timestamp()
+
+
+def retrieve_history_departures(station=None, line=None, since=None, until=None, limit=1000):
+    """
+    retrieve_history_departures lists the recorded departures of a station or line within a time window
+
+    :param station: station name, part of it or station id
+    :type station: str
+    :param line: line, e.g., '5'
+    :type line: str
+    :param since: unix timestamp the window starts at, defaults to a day ago
+    :type since: float
+    :param until: unix timestamp the window ends at, defaults to now
+    :type until: float
+    :return: departures as observed, oldest first
+    :rtype: dict
+    """
+    local_time = datetime.now(tz=_berlin_tz())
+    if departure_history is None:
+        return {
+            'status': 404,
+            'message': 'the departure history is not recorded, see KVB_HISTORY',
+            'local_time': local_time.isoformat(),
+            'departures': []
+        }
+
+    station_id = None
+    if station is not None:
+        _, station_id, _ = resolve_station(station)
+        if station_id is None:
+            return {
+                'status': 404,
+                'message': f'unknown station {station}',
+                'local_time': local_time.isoformat(),
+                'departures': []
+            }
+
+    if until is None:
+        until = time.time()
+    if since is None:
+        since = until - 86400
+
+    departures = departure_history.query(
+        station_id=station_id, line=line, since=since, until=until, limit=limit
+    )
+    tz = _berlin_tz()
+    for dep in departures:
+        dep['local_time'] = datetime.fromtimestamp(dep['observed_at'], tz).isoformat()
+
+    return {
+        'status': 200,
+        'local_time': local_time.isoformat(),
+        'since': datetime.fromtimestamp(since, tz).isoformat(),
+        'until': datetime.fromtimestamp(until, tz).isoformat(),
+        'station_id': station_id,
+        'line': line,
+        'truncated': len(departures) == limit,
+        'departures': departures
+    }
+
+
+@app.route("/history/departures/")
+def get_history_departures():
+
+    try:
+        since = parse_timestamp(request.args.get('since'))
+        until = parse_timestamp(request.args.get('until'))
+    except ValueError as e:
+        return jsonify({'status': 400, 'message': f'invalid time: {e}'}), 400
+
+    departures = retrieve_history_departures(
+        station=request.args.get('station'),
+        line=request.args.get('line'),
+        since=since,
+        until=until,
+        limit=min(request.args.get('limit', 1000, type=int), 10000)
+    )
+
+    if departures['status'] != 200:
+        return jsonify(departures), departures['status']
+    return payload_response(Payload.from_json(departures))
+
+
+# one poller per station feeds all streaming clients of the worker
+stream_hub = StreamHub(
+    get=lambda station_id: get_departures(station_id),
+    interval=float(os.environ.get('KVB_STREAM_INTERVAL', 10)),
+    max_clients=int(os.environ.get('KVB_STREAM_MAX_CLIENTS', 50)),
+    max_queue=int(os.environ.get('KVB_STREAM_MAX_QUEUE', 20))
+)
+_STREAM_HEARTBEAT = float(os.environ.get('KVB_STREAM_HEARTBEAT', 15))
+_STREAM_MAX_SECONDS = float(os.environ.get('KVB_STREAM_MAX_SECONDS', 3600))
+
+
+@app.route("/stream/departures/")
+def stream_departures():
+    """
+    stream_departures streams the departures of stations as server-sent events
+
+    The client first gets a snapshot event per station, then diff events with
+    the rows added and removed, and a heartbeat comment when nothing changed.
+    """
+
+    station_ids = []
+    for station in request.args.get('stations', '').split(',')[:_BATCH_MAX_STATIONS]:
+        if not station.strip():
+            continue
+        _, station_id, _ = resolve_station(station.strip())
+        if station_id is None:
+            return jsonify({'status': 404, 'message': f'unknown station {station}'}), 404
+        if station_id not in station_ids:
+            station_ids.append(station_id)
+    if not station_ids:
+        return jsonify({'status': 400, 'message': 'no station given, use ?stations=dom,46'}), 400
+
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    if request.method == 'HEAD':
+        # nothing is streamed, no slot is taken
+        return Response(content_type='text/event-stream', headers=headers)
+
+    subscription = stream_hub.subscribe(station_ids)
+    if subscription is None:
+        return jsonify({'status': 503, 'message': 'too many streaming clients, poll /station/<station>/departures/ instead'}), 503
+
+    response = Response(
+        stream_hub.stream(
+            subscription, heartbeat=_STREAM_HEARTBEAT, max_seconds=_STREAM_MAX_SECONDS
+        ),
+        content_type='text/event-stream',
+        headers=headers
+    )
+    # the body is not iterated if the response fails before the first
+    # byte, the slot is released when the response closes in any case
+    response.call_on_close(lambda: stream_hub.unsubscribe(subscription))
+    return response
+
+
+def retrieve_export_departures(station_id, client=None, attempts=10):
+    """
+    retrieve_export_departures retrieves the departures of a station for an export
+
+    Runs in a context of its own: the fetches have background priority and no
+    deadline, and exports do not make stations hot. They count against the
+    quota of the client of the export, a station over it waits for the
+    quota instead of failing, so an export goes at the pace of KVB_CLIENT_RATE.
+
+    :param client: client of the export, see admission_client
+    :type client: str
+    :param attempts: times a station is tried while the client is over its quota
+    :type attempts: int
+    """
+    def retrieve():
+        _admission.enter(BACKGROUND, client)
+        return get_departures(station_id, track=False)
+
+    for attempt in range(attempts):
+        departures = contextvars.Context().run(retrieve)
+        if departures['status'] != 429 or attempt == attempts - 1:
+            break
+        time.sleep(departures['retry_after'])
+    departures['station'] = {'name': _STATION_MAP.inverse.get(station_id), 'id': station_id}
+    return departures
+
+
+def export_stations(station_ids, client=None):
+    """
+    export_stations yields the departures of the stations in their order while the next ones are fetched
+    """
+    for station_id, future in ordered_results(
+        _EXPORT_EXECUTOR, lambda station_id: retrieve_export_departures(station_id, client),
+        station_ids, window=_EXPORT_WINDOW
+    ):
+        if future.exception() is not None:
+            _metrics.inc('tram_bot_export_stations_total', status='error')
+            logger.error(f'could not export departures for {station_id}: {future.exception()}')
+            # the export gets a row with the error instead of missing the station
+            yield {
+                'status': 500,
+                'message': 'could not retrieve the departures',
+                'departures': [],
+                'station': {'name': _STATION_MAP.inverse.get(station_id), 'id': station_id}
+            }
+            continue
+        departures = future.result()
+        _metrics.inc('tram_bot_export_stations_total', status=departures['status'])
+        yield departures
+
+
+@app.route("/export/departures/", methods=['GET', 'POST'])
+def export_departures():
+    """
+    export_departures streams the departures of many or all stations as ndjson or csv, one row per departure
+
+    Rows have the columns of utils.export.EXPORT_COLUMNS. The response is
+    sent in chunks as the stations come in, a few stations are fetched ahead,
+    so memory does not grow with the number of stations. Stations are given
+    in ?stations=, or as {"stations": [...]} in a POST for long lists, all
+    stations without. A client runs KVB_EXPORTS_PER_CLIENT exports at a time
+    per worker, more get 429.
+    """
+    kind = request.args.get('format', 'ndjson')
+    if kind not in _EXPORT_FORMATS:
+        return jsonify({'status': 400, 'message': f'unknown format {kind}, use one of {", ".join(_EXPORT_FORMATS)}'}), 400
+
+    if request.method == 'POST':
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict) or not isinstance(body.get('stations', []), list):
+            return jsonify({'status': 400, 'message': 'send the stations as {"stations": [...]}'}), 400
+        stations = [str(i) for i in body.get('stations', [])]
+    else:
+        stations = request.args.get('stations', '').split(',')
+
+    station_ids = []
+    for station in stations:
+        if not station.strip():
+            continue
+        _, station_id, _ = resolve_station(station.strip())
+        if station_id is None:
+            return jsonify({'status': 404, 'message': f'unknown station {station}'}), 404
+        if station_id not in station_ids:
+            station_ids.append(station_id)
+    if not station_ids:
+        station_ids = sorted(_STATION_MAP.inverse)
+
+    client = _admission.current()[1]
+    with _export_clients_lock:
+        busy = _EXPORTS_PER_CLIENT > 0 and _export_clients[client] >= _EXPORTS_PER_CLIENT
+        if not busy:
+            _export_clients[client] += 1
+    if busy:
+        _metrics.inc('tram_bot_exports_rejected_total')
+        return jsonify({'status': 429, 'message': 'an export of this client is running already'}), 429, {'Retry-After': '60'}
+
+    response = Response(
+        _serialize_export(export_stations(station_ids, client), kind),
+        content_type=_EXPORT_FORMATS[kind],
+        headers={
+            'Content-Disposition': f'attachment; filename=departures.{kind}',
+            'X-Accel-Buffering': 'no'
+        }
+    )
+    # also when the client goes away before the end
+    response.call_on_close(lambda: end_export(client))
+    return response
+
+
+def end_export(client):
+    with _export_clients_lock:
+        _export_clients[client] -= 1
+        if _export_clients[client] <= 0:
+            del _export_clients[client]
+
+
+@_timed('format_slack_kvb_departures')
 def format_slack_kvb_departures(departures, line=None, custom_message=None):
 
 
@@ -306,6 +1307,22 @@ def format_slack_kvb_departures(departures, line=None, custom_message=None):
 		}
     ]
 
+    if departures.get('status') == 503:
+        dep_schedule_blocks.append({
+            "type": "context",
+            "elements": [{"type": "mrkdwn", "text": "KVB is not answering at the moment, please try again later."}]
+        })
+    elif departures.get('stale'):
+        dep_schedule_blocks.append({
+            "type": "context",
+            "elements": [{
+                "type": "mrkdwn",
+                "text": "KVB is not answering, showing the schedule from {} minutes ago.".format(
+                    departures.get('age', 0) // 60
+                )
+            }]
+        })
+
     if not line:
         all_lines = set([i.get('line') for i in dep_schedule])
     else:
@@ -363,20 +1380,177 @@ def format_slack_kvb_departures(departures, line=None, custom_message=None):
     return res
 
 
+def format_slack_kvb_batch(batch, line=None):
+    """
+    format_slack_kvb_batch formats departures of several stations as one slack message
+    """
+
+    blocks = []
+    for departures in batch.get('stations', []):
+        if departures.get('status') != 200:
+            blocks.append(
+                {
+                    "type": "section",
+                    "text": {
+                        "type": "mrkdwn",
+                        "text": "Could not get the KVB Schedule for *{}*: {}".format(
+                            departures.get('station', {}).get('name'),
+                            departures.get('message')
+                        )
+                    }
+                }
+            )
+        else:
+            # the footer is added once for the whole message
+            blocks.extend(
+                format_slack_kvb_departures(departures, line=line)["blocks"][:-1]
+            )
+        blocks.append(
+            {
+                "type": "divider"
+            }
+        )
+
+    blocks.append(
+        _FOOTER_MESSAGE
+    )
+
+    return {
+        "blocks": blocks
+    }
+
+
+def parse_slack_command(text):
+    """
+    parse_slack_command splits the text of a /kvb command into stations and line
+
+    :param text: text of the slash command, e.g., `dom -l 5` or `dom, neumarkt`
+    :type text: str
+    :return: station names or ids and the line to filter for
+    :rtype: tuple
+    """
+    line = None
+
+    if ',' in text:
+        station_text = text
+        if ' -l ' in text:
+            station_text, line = text.rsplit(' -l ', 1)
+            line = line.strip()
+        stations = [i.strip() for i in station_text.split(',') if i.strip()]
+    elif ' -l ' in text:
+        re_station = re.compile(r'(\S+)\s+-l\s+(\S+)')
+        station_line = re_station.findall(text)
+        if station_line:
+            station, line = station_line[0]
+        else:
+            station = text
+        stations = [station]
+    else:
+        stations = [text]
+
+    return stations, line
+
+
+def build_slack_reply(stations, line=None, deadline=None):
+    """
+    build_slack_reply retrieves departures and formats them as a slack message
+    """
+    if len(stations) == 1:
+        return format_slack_kvb_departures(
+            retrieve_departures(stations[0]), line=line
+        )
+
+    return format_slack_kvb_batch(
+        retrieve_departures_batch(stations, deadline=deadline), line=line
+    )
+
+
+def build_deferred_slack_reply(stations, line=None):
+    """
+    build_deferred_slack_reply builds a reply posted to the response_url, with KVB_SLACK_DEADLINE seconds to do so
+
+    It runs in a copy of the context of the slash command, whose deadline was
+    meant for the immediate answer.
+    """
+    _deadline.start(slack_responder.deadline)
+    return build_slack_reply(stations, line=line)
+
+
+def has_fresh_departures(stations):
+    """
+    has_fresh_departures checks whether all stations can be answered from the departures cache
+
+    Stale entries count as well, they are served at once and refreshed in the background.
+    """
+    for station in stations:
+        try:
+            _, station_id, _ = resolve_station(station)
+        except Exception:
+            return False
+        if station_id is None or departures_cache.get_stale(str(station_id)) is None:
+            return False
+    return True
+
+
+def _post_slack_reply(response_url, payload):
+    # a redirect could lead away from the hosts of _SLACK_RESPONSE_HOSTS
+    _get_client().request('POST', response_url, json=payload, allow_redirects=False)
+
+
+# signing secret of the slack app, commands signed with anything else are refused
+_SLACK_SIGNING_SECRET = os.environ.get('KVB_SLACK_SIGNING_SECRET')
+if not _SLACK_SIGNING_SECRET:
+    logger.warning('KVB_SLACK_SIGNING_SECRET is not set, slack commands are not verified')
+# replies are posted to response urls on these hosts only
+_SLACK_RESPONSE_HOSTS = SLACK_RESPONSE_HOSTS + tuple(
+    host.strip() for host in os.environ.get('KVB_SLACK_RESPONSE_HOSTS', '').split(',') if host.strip()
+)
+
+
+_SLACK_UNAVAILABLE_MESSAGE = {
+    "response_type": "ephemeral",
+    "text": "Sorry, the KVB schedule could not be retrieved in time. Please try again."
+}
+
+slack_responder = DeferredResponder(
+    post=_post_slack_reply,
+    max_workers=int(os.environ.get('KVB_SLACK_WORKERS', 4)),
+    max_queue=int(os.environ.get('KVB_SLACK_MAX_QUEUE', 50)),
+    deadline=float(os.environ.get('KVB_SLACK_DEADLINE', 25)),
+)
+
+
+@app.before_request
+def verify_slack_request():
+    # registered before the hooks reading the form, the raw body is gone once it is parsed
+    if request.endpoint != 'slack_kvb_departures' or not _SLACK_SIGNING_SECRET:
+        return None
+    if not verify_signature(
+        _SLACK_SIGNING_SECRET,
+        request.headers.get('X-Slack-Request-Timestamp'),
+        request.get_data(),
+        request.headers.get('X-Slack-Signature')
+    ):
+        return jsonify({'status': 401, 'message': 'invalid slack signature'}), 401
+    return None
+
+
 @app.route("/slack/kvb/departures", methods=["POST"])
 def slack_kvb_departures():
 
     data = request.form
-    # TODO: validate token
-    token = data.get('token', None)
     command = data.get('command', None)
     text = data.get('text', '')
-
-    logger.info(f"Slack Request: {data}")
+    response_url = data.get('response_url')
+    if response_url and not allowed_response_url(response_url, _SLACK_RESPONSE_HOSTS):
+        # never post to hosts other than slack's, the reply is given inline instead
+        logger.warning(f'ignoring the response_url on {response_host(response_url)}')
+        response_url = None
+
+    # the form carries the token and the response_url, neither is logged
+    logger.info(f"Slack Request: {command} {text!r} from {data.get('team_id')}:{data.get('user_id')}")
     sys.stdout.flush()
 
-    line = None
-
     if isinstance(text, str):
         text = text.strip()
 
@@ -388,29 +1562,386 @@ def slack_kvb_departures():
                 {}, custom_message=_HELP_MESSAGE
             )
         )
-    elif ' -l ' in text:
-        re_station = re.compile(r'(\S+)\s+-l\s+(\S+)')
-        station_line = re_station.findall(text)
-        if station_line:
-            station, line = station_line[0]
-        else:
-            station = text
+
+    stations, line = parse_slack_command(text)
+
+    deferred = (
+        _SLACK_DEFERRED and response_url and not has_fresh_departures(stations)
+    )
+    if not deferred:
+        # fresh data is on hand, or slack can not be answered later
+        return jsonify(
+            build_slack_reply(stations, line=line, deadline=_SLACK_BATCH_DEADLINE)
+        )
+
+    context = contextvars.copy_context()
+    queued = slack_responder.submit(
+        lambda: context.run(build_deferred_slack_reply, stations, line=line),
+        response_url,
+        error_payload=_SLACK_UNAVAILABLE_MESSAGE
+    )
+    if not queued:
+        logger.warning(f'slack reply queue is full, rejecting {text}')
+        return jsonify({
+            "response_type": "ephemeral",
+            "text": "Too many requests right now, please try again in a moment."
+        })
+
+    return jsonify({
+        "response_type": "ephemeral",
+        "text": "Looking up the KVB schedule for *{}* ...".format(', '.join(stations))
+    })
+
+
+def collect_metrics():
+    """
+    collect_metrics reads the statistics of the caches, clients and prefetcher at scrape time
+    """
+    resolve_info = _resolve_station.cache_info()
+    samples = [
+        ('tram_bot_cache_requests_total', 'counter', {'cache': 'departures', 'result': 'hit'}, departures_cache.hits),
+        ('tram_bot_cache_requests_total', 'counter', {'cache': 'departures', 'result': 'miss'}, departures_cache.misses),
+        ('tram_bot_cache_requests_total', 'counter', {'cache': 'departures', 'result': 'coalesced'}, departures_cache.coalesced),
+        ('tram_bot_cache_requests_total', 'counter', {'cache': 'departures', 'result': 'stale'}, departures_cache.stale_hits),
+        ('tram_bot_cache_revalidations_total', 'counter', {}, departures_cache.revalidations),
+        ('tram_bot_breaker_open', 'gauge', {'upstream': upstream_breaker.name}, int(upstream_breaker.state != 'closed')),
+        ('tram_bot_breaker_state', 'gauge', {'upstream': upstream_breaker.name, 'state': upstream_breaker.state}, 1),
+        ('tram_bot_breaker_transitions_total', 'counter', {'upstream': upstream_breaker.name}, upstream_breaker.transitions),
+        ('tram_bot_breaker_rejected_total', 'counter', {'upstream': upstream_breaker.name}, upstream_breaker.rejected),
+        ('tram_bot_cache_requests_total', 'counter', {'cache': 'resolve_station', 'result': 'hit'}, resolve_info.hits),
+        ('tram_bot_cache_requests_total', 'counter', {'cache': 'resolve_station', 'result': 'miss'}, resolve_info.misses),
+        ('tram_bot_prefetch_refreshes_total', 'counter', {'result': 'ok'}, prefetcher.refreshed),
+        ('tram_bot_stations', 'gauge', {}, len(_STATION_MAP)),
+        ('tram_bot_stream_clients', 'gauge', {}, stream_hub.clients),
+        ('tram_bot_stream_pollers', 'gauge', {}, stream_hub.pollers),
+        ('tram_bot_stream_messages_total', 'counter', {}, stream_hub.messages),
+        ('tram_bot_stream_overflows_total', 'counter', {}, stream_hub.overflows),
+        ('tram_bot_stream_refused_total', 'counter', {}, stream_hub.refused),
+        ('tram_bot_station_refreshes_total', 'counter', {'result': 'swapped'}, station_refresher.swaps),
+        ('tram_bot_station_refreshes_total', 'counter', {'result': 'not_modified'}, station_refresher.not_modified),
+        ('tram_bot_station_refreshes_total', 'counter', {'result': 'failed'}, station_refresher.failed),
+        ('tram_bot_slack_replies_total', 'counter', {'result': 'posted'}, slack_responder.posted),
+        ('tram_bot_slack_replies_total', 'counter', {'result': 'rejected'}, slack_responder.rejected),
+        ('tram_bot_slack_replies_total', 'counter', {'result': 'expired'}, slack_responder.expired),
+        ('tram_bot_slack_replies_total', 'counter', {'result': 'failed'}, slack_responder.failed),
+        ('tram_bot_slack_replies_pending', 'gauge', {}, slack_responder.pending),
+        ('tram_bot_prefetch_refreshes_total', 'counter', {'result': 'failed'}, prefetcher.failed),
+        ('tram_bot_prefetch_refreshes_total', 'counter', {'result': 'skipped'}, prefetcher.skipped),
+    ]
+
+    snapshot = network_crawler.snapshot
+    if snapshot is not None:
+        samples += [
+            ('tram_bot_snapshot_stations', 'gauge', {}, snapshot.stations),
+            ('tram_bot_snapshot_departures', 'gauge', {}, len(snapshot)),
+            ('tram_bot_snapshot_bytes', 'gauge', {}, snapshot.memory_bytes()),
+            ('tram_bot_snapshot_crawl_seconds', 'gauge', {}, snapshot.crawl_seconds),
+            ('tram_bot_snapshot_age_seconds', 'gauge', {}, time.time() - snapshot.crawled_at),
+        ]
+
+    admission = upstream_admission.statistics()
+    samples.append(('tram_bot_admission_queued', 'gauge', {}, admission['queued']))
+    samples.append(('tram_bot_admission_wait_seconds_total', 'counter', {}, admission['waited']))
+    for priority, admitted in admission['admitted'].items():
+        samples.append(('tram_bot_admission_total', 'counter', {'priority': priority, 'result': 'admitted'}, admitted))
+    for (priority, status), rejected in admission['rejected'].items():
+        samples.append(('tram_bot_admission_total', 'counter', {'priority': priority, 'result': str(status)}, rejected))
+
+    if departure_history is not None:
+        history = departure_history.statistics()
+        samples += [
+            ('tram_bot_history_rows_total', 'counter', {'result': 'written'}, history['written']),
+            ('tram_bot_history_rows_total', 'counter', {'result': 'dropped'}, history['dropped']),
+            ('tram_bot_history_rows_total', 'counter', {'result': 'failed'}, history['failed']),
+            ('tram_bot_history_pending', 'gauge', {}, history['pending']),
+        ]
+
+    if _HEDGE:
+        hedging = upstream_fetcher.statistics()
+        samples += [
+            ('tram_bot_upstream_hedges_total', 'counter', {'result': 'sent'}, hedging['hedges']),
+            ('tram_bot_upstream_hedges_total', 'counter', {'result': 'won'}, hedging['hedge_wins']),
+            ('tram_bot_upstream_retries_total', 'counter', {}, hedging['retries']),
+            ('tram_bot_upstream_extra_denied_total', 'counter', {}, hedging['denied']),
+            ('tram_bot_upstream_deadline_exceeded_total', 'counter', {}, hedging['timeouts']),
+            ('tram_bot_upstream_hedge_delay_seconds', 'gauge', {}, hedging['hedge_delay']),
+        ]
+        for quantile, key in (('0.5', 'p50'), ('0.95', 'p95'), ('0.99', 'p99')):
+            if hedging[key] is not None:
+                samples.append((
+                    'tram_bot_upstream_latency_seconds', 'gauge', {'quantile': quantile}, hedging[key]
+                ))
+
+    if _FETCH_ENGINE == 'async':
+        engine = _get_engine().statistics()
+        samples += [
+            ('tram_bot_upstream_in_flight', 'gauge', {}, engine['in_flight']),
+            ('tram_bot_upstream_waiting', 'gauge', {}, engine['waiting']),
+        ]
+    elif _FETCH_ENGINE == 'egress':
+        egress = _get_egress().statistics()
+        samples.append(('tram_bot_proxy_sessions_retired_total', 'counter', {}, egress['retired']))
+        # labelled by slot, session ids change with every rotation
+        for slot, stats in enumerate(egress['sessions']):
+            samples += [
+                ('tram_bot_proxy_session_requests', 'gauge', {'slot': slot}, stats['requests']),
+                ('tram_bot_proxy_session_latency_seconds', 'gauge', {'slot': slot}, stats['latency'] or 0.0),
+                ('tram_bot_proxy_session_error_rate', 'gauge', {'slot': slot}, stats['error_rate']),
+            ]
     else:
-        station = text
+        client = _get_client().statistics()
+        for pool, stats in client['pools'].items():
+            samples += [
+                ('tram_bot_pool_connections_opened_total', 'counter', {'pool': pool}, stats['connections_opened']),
+                ('tram_bot_pool_idle_connections', 'gauge', {'pool': pool}, stats['idle_connections']),
+            ]
+
+    return samples
+
+
+_metrics.add_collector(collect_metrics)
+_metrics.describe('tram_bot_request_seconds', 'histogram', 'Duration of requests per endpoint')
+_metrics.describe('tram_bot_upstream_responses_total', 'counter', 'Responses of kvb.koeln by status code')
+_metrics.describe('tram_bot_parse_failures_total', 'counter', 'Departure pages or rows that could not be parsed')
+_metrics.describe('tram_bot_cache_requests_total', 'counter', 'Cache lookups by result')
+_metrics.describe('tram_bot_payload_responses_total', 'counter', 'Json responses by status (200 or 304 Not Modified) and content encoding')
+_metrics.describe('tram_bot_cache_revalidations_total', 'counter', 'Background refreshes of stale cache entries')
+_metrics.describe('tram_bot_stale_responses_total', 'counter', 'Departures served older than KVB_DEPARTURES_TTL')
+_metrics.describe('tram_bot_deadline_exceeded_total', 'counter', 'Departures not retrieved within the deadline of the request by stage')
+_metrics.describe('tram_bot_breaker_open', 'gauge', 'Whether the circuit of an upstream is open or half open')
+_metrics.describe('tram_bot_breaker_state', 'gauge', 'Current state of the circuit of an upstream')
+_metrics.describe('tram_bot_breaker_transitions_total', 'counter', 'State changes of the circuit of an upstream')
+_metrics.describe('tram_bot_breaker_rejected_total', 'counter', 'Calls refused by an open circuit')
+_metrics.describe('tram_bot_slack_replies_total', 'counter', 'Deferred slack replies by outcome')
+_metrics.describe('tram_bot_slack_replies_pending', 'gauge', 'Deferred slack replies queued or running')
+_metrics.describe('tram_bot_stations', 'gauge', 'Stations of the station map in use')
+_metrics.describe('tram_bot_stream_clients', 'gauge', 'Clients connected to the departures stream')
+_metrics.describe('tram_bot_stream_pollers', 'gauge', 'Stations polled for streaming clients')
+_metrics.describe('tram_bot_stream_messages_total', 'counter', 'Events sent to streaming clients that left')
+_metrics.describe('tram_bot_stream_overflows_total', 'counter', 'Queues of slow streaming clients dropped for a resync')
+_metrics.describe('tram_bot_stream_refused_total', 'counter', 'Streaming clients refused over KVB_STREAM_MAX_CLIENTS')
+_metrics.describe('tram_bot_snapshot_stations', 'gauge', 'Stations in the snapshot of the network')
+_metrics.describe('tram_bot_snapshot_departures', 'gauge', 'Departures in the snapshot of the network')
+_metrics.describe('tram_bot_snapshot_bytes', 'gauge', 'Memory used by the columns of the snapshot of the network')
+_metrics.describe('tram_bot_snapshot_crawl_seconds', 'gauge', 'Duration of the sweep of the snapshot of the network')
+_metrics.describe('tram_bot_snapshot_age_seconds', 'gauge', 'Seconds since the snapshot of the network was taken')
+_metrics.describe('tram_bot_station_refreshes_total', 'counter', 'Checks of the kvb overview page by outcome')
+_metrics.describe('tram_bot_prefetch_refreshes_total', 'counter', 'Background refreshes of hot stations')
+_metrics.describe('tram_bot_admission_total', 'counter', 'kvb.koeln requests admitted or shed (429 over the client quota, 503 over the deadline) by priority')
+_metrics.describe('tram_bot_admission_queued', 'gauge', 'kvb.koeln requests waiting for admission')
+_metrics.describe('tram_bot_admission_wait_seconds_total', 'counter', 'Seconds kvb.koeln requests waited for admission')
+_metrics.describe('tram_bot_export_stations_total', 'counter', 'Stations exported by the status of their departures')
+_metrics.describe('tram_bot_exports_rejected_total', 'counter', 'Exports refused since the client ran KVB_EXPORTS_PER_CLIENT already')
+_metrics.describe('tram_bot_history_rows_total', 'counter', 'Departure rows of the history written, dropped on a full buffer or lost to failed writes')
+_metrics.describe('tram_bot_history_pending', 'gauge', 'Departure rows of the history waiting for the writer')
+_metrics.describe('tram_bot_upstream_hedges_total', 'counter', 'Hedged kvb.koeln requests sent and the ones answering first')
+_metrics.describe('tram_bot_upstream_retries_total', 'counter', 'Retries of failed kvb.koeln requests')
+_metrics.describe('tram_bot_upstream_extra_denied_total', 'counter', 'Hedges and retries refused by the budget or the circuit breaker')
+_metrics.describe('tram_bot_upstream_deadline_exceeded_total', 'counter', 'kvb.koeln fetches without an answer within KVB_FETCH_DEADLINE')
+_metrics.describe('tram_bot_upstream_hedge_delay_seconds', 'gauge', 'Seconds a kvb.koeln request is given before it is hedged')
+_metrics.describe('tram_bot_upstream_latency_seconds', 'gauge', 'Recent latency percentiles of kvb.koeln')
+_metrics.describe('tram_bot_upstream_in_flight', 'gauge', 'Requests to kvb.koeln in flight on the async engine')
+_metrics.describe('tram_bot_upstream_waiting', 'gauge', 'Requests waiting for a slot of the async engine')
+_metrics.describe('tram_bot_proxy_sessions_retired_total', 'counter', 'Proxy sessions replaced for throttling, errors or age')
+_metrics.describe('tram_bot_proxy_session_requests', 'gauge', 'Requests of the current proxy session of a slot')
+_metrics.describe('tram_bot_proxy_session_latency_seconds', 'gauge', 'Moving average latency of the proxy session of a slot')
+_metrics.describe('tram_bot_proxy_session_error_rate', 'gauge', 'Moving average error rate of the proxy session of a slot')
+_metrics.describe('tram_bot_pool_connections_opened_total', 'counter', 'Connections opened by the pooled client')
+_metrics.describe('tram_bot_pool_idle_connections', 'gauge', 'Idle keep-alive connections of the pooled client')
+
+
+@app.route("/metrics")
+def metrics():
+    return _metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+
+@app.before_request
+def start_timing():
+    g.request_start = time.perf_counter()
+    _metrics_module.start_request()
+
+
+# proxies in front of the app appending to X-Forwarded-For, the heroku router is one
+_TRUSTED_PROXIES = int(os.environ.get('KVB_TRUSTED_PROXIES', 1))
+
+
+def admission_client():
+    """
+    admission_client identifies who a request is made for, for the upstream quotas
 
+    Slack commands count per user, everything else per client ip as seen by
+    the router. Clients may send any X-Forwarded-For, only the entries
+    appended by the KVB_TRUSTED_PROXIES proxies are taken, from the right.
+    """
+    if request.endpoint == 'slack_kvb_departures':
+        return f"slack:{request.form.get('team_id')}:{request.form.get('user_id')}"
+    if _TRUSTED_PROXIES > 0:
+        forwarded = [
+            hop.strip() for hop in request.headers.get('X-Forwarded-For', '').split(',') if hop.strip()
+        ]
+        if len(forwarded) >= _TRUSTED_PROXIES:
+            return forwarded[-_TRUSTED_PROXIES]
+    return request.remote_addr
 
-    if not isinstance(station, str):
-        try:
-            station = str(station)
-        except Exception as e:
-            raise Exception("Can not convert input station into str")
 
-    departures = retrieve_departures(station)
+@app.before_request
+def enter_admission():
+    priority = INTERACTIVE if request.endpoint == 'slack_kvb_departures' else API
+    g.admission = _admission.enter(priority, admission_client())
+
+
+@app.teardown_request
+def leave_admission(exc):
+    if 'admission' in g:
+        _admission.leave(g.pop('admission'))
+
+
+def request_deadline():
+    """
+    request_deadline is the number of seconds the current request has to answer, None for no deadline
+
+    Endpoints have the one of KVB_DEADLINES or else KVB_REQUEST_DEADLINE. A
+    client may ask for another one with the X-Request-Deadline header, in
+    seconds up to KVB_REQUEST_DEADLINE_MAX; endpoints without a deadline
+    ignore it.
+    """
+    seconds = _DEADLINES.get(request.endpoint, _REQUEST_DEADLINE)
+    if seconds is None:
+        return None
+    asked = request.headers.get('X-Request-Deadline', type=float)
+    if asked is not None and asked > 0:
+        seconds = min(asked, _REQUEST_DEADLINE_MAX)
+    return seconds
+
+
+@app.before_request
+def start_deadline():
+    g.deadline = _deadline.start(request_deadline())
+
+
+@app.teardown_request
+def reset_deadline(exc):
+    if 'deadline' in g:
+        _deadline.reset(g.pop('deadline'))
+
+
+# profiling is off without a token: its hooks are not even registered
+_PROFILE_TOKEN = os.environ.get('KVB_PROFILE_TOKEN')
+_PROFILE_SAMPLE = float(os.environ.get('KVB_PROFILE_SAMPLE', 0))
+_PROFILE_MODE = os.environ.get('KVB_PROFILE_MODE', 'collapsed')
+profile_store = ProfileStore(
+    directory=os.environ.get('KVB_PROFILE_DIR'),
+    max_files=int(os.environ.get('KVB_PROFILE_MAX_FILES', 100))
+) if _PROFILE_TOKEN else None
 
-    return jsonify(
-        format_slack_kvb_departures(departures, line=line)
+
+def profile_authorized(token):
+    return token is not None and hmac.compare_digest(token, _PROFILE_TOKEN)
+
+
+def start_profile():
+    """
+    start_profile profiles the request if it sends the token in X-Profile or ?profile=, or is sampled
+
+    X-Profile-Mode or ?profile_mode= picks 'collapsed' or 'pstats' instead of KVB_PROFILE_MODE.
+    """
+    if request.endpoint is None or request.endpoint.startswith('admin_'):
+        return
+    token = request.headers.get('X-Profile') or request.args.get('profile')
+    if token is not None:
+        if not profile_authorized(token):
+            return
+    elif not (_PROFILE_SAMPLE > 0 and random.random() < _PROFILE_SAMPLE):
+        return
+    mode = request.headers.get('X-Profile-Mode') or request.args.get('profile_mode') or _PROFILE_MODE
+    if mode not in _PROFILE_MODES:
+        mode = _PROFILE_MODE
+    g.profile = RequestProfile(mode=mode).start()
+
+
+def stop_profile(resp):
+    profile = g.pop('profile', None)
+    if profile is not None:
+        data = profile.stop()
+        name = profile_store.write(
+            f'{request.endpoint}-{int(profile.seconds * 1000)}ms', profile.mode, data
+        )
+        # fetch it from /admin/profiles/<name>
+        resp.headers['X-Profile'] = name
+    return resp
+
+
+def abort_profile(exc):
+    profile = g.pop('profile', None)
+    if profile is not None:
+        # the request failed before after_request
+        profile.stop()
+
+
+if _PROFILE_TOKEN:
+    app.before_request(start_profile)
+    app.after_request(stop_profile)
+    app.teardown_request(abort_profile)
+
+
+def admin_authorized():
+    header = request.headers.get('Authorization', '')
+    if not header.startswith('Bearer '):
+        return False
+    return profile_authorized(header[len('Bearer '):])
+
+
+@app.route("/admin/profiles/")
+def admin_profiles():
+    if profile_store is None:
+        return jsonify({'status': 404, 'message': 'profiling is off, see KVB_PROFILE_TOKEN'}), 404
+    if not admin_authorized():
+        return jsonify({'status': 401, 'message': 'send Authorization: Bearer <KVB_PROFILE_TOKEN>'}), 401
+    return jsonify({'status': 200, 'profiles': profile_store.list()})
+
+
+@app.route("/admin/profiles/<name>")
+def admin_profile(name):
+    if profile_store is None:
+        return jsonify({'status': 404, 'message': 'profiling is off, see KVB_PROFILE_TOKEN'}), 404
+    if not admin_authorized():
+        return jsonify({'status': 401, 'message': 'send Authorization: Bearer <KVB_PROFILE_TOKEN>'}), 401
+    path = profile_store.path(name)
+    if path is None:
+        return jsonify({'status': 404, 'message': f'no profile {name}'}), 404
+    return send_file(
+        path, mimetype='text/plain' if name.endswith('.collapsed') else 'application/octet-stream',
+        as_attachment=True, attachment_filename=name, cache_timeout=0
     )
 
+
+@app.after_request
+def add_server_timing(resp):
+    if 'request_start' in g:
+        elapsed = time.perf_counter() - g.request_start
+        _metrics.observe(
+            'tram_bot_request_seconds', elapsed, endpoint=request.endpoint or 'unknown'
+        )
+        timings = _metrics_module.request_timings() + [('total', elapsed)]
+        resp.headers['Server-Timing'] = _metrics_module.server_timing_header(timings)
+    return resp
+
+
+@app.before_first_request
+def start_background_tasks():
+    # started per worker, threads do not survive the fork of gunicorn
+    if os.environ.get('KVB_PREFETCH', '1') == '1':
+        prefetcher.start()
+    if station_refresher.interval > 0:
+        station_refresher.start()
+    if os.environ.get('KVB_CRAWL', '0') == '1':
+        network_crawler.start()
+    if departure_history is not None:
+        departure_history.start()
+        # rows still buffered are written when the worker exits
+        atexit.register(departure_history.stop)
+
+
 # Add CORS header to every request
 # CORS allows us to use the api cross domain
 @app.after_request
@@ -0,0 +1,245 @@
+import contextvars
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import Counter, OrderedDict
+
+try:
+    from utils import deadline as _deadline
+    from utils.ratelimit import TokenBucket
+except ImportError:
+    import deadline as _deadline
+    from ratelimit import TokenBucket
+
+logging.basicConfig()
+logger = logging.getLogger('admission')
+
+# lower is served first
+INTERACTIVE = 0
+API = 1
+BACKGROUND = 2
+PRIORITY_NAMES = {INTERACTIVE: 'interactive', API: 'api', BACKGROUND: 'background'}
+
+# priority and client of the upstream requests made by the current request,
+# threads without one, e.g., the prefetcher, are background
+_context = contextvars.ContextVar('admission', default=(BACKGROUND, None))
+
+
+def enter(priority, client=None):
+    """
+    enter sets the priority and client of the upstream requests of the current context
+
+    :return: token for leave
+    """
+    return _context.set((priority, client))
+
+
+def leave(token):
+    _context.reset(token)
+
+
+def current():
+    """
+    current returns the priority and client of the current context
+    """
+    return _context.get()
+
+
+class AdmissionRejected(Exception):
+    """
+    AdmissionRejected is raised instead of queueing an upstream request that can not be sent in time
+
+    :param status: 429 if the client is over its quota, 503 if the upstream budget is spent
+    :type status: int
+    :param retry_after: seconds after which a retry may succeed
+    :type retry_after: float
+    :param client: client over its quota, None if the upstream budget is spent
+    :type client: str
+    """
+
+    def __init__(self, message, status, retry_after, client=None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+        self.client = client
+
+
+class SharedTokenBucket(object):
+    """
+    SharedTokenBucket allows ``rate`` operations per second across all workers sharing a cache backend.
+
+    Operations are counted per window of ``window`` seconds with the atomic
+    incr of the backend, so a sqlite backend coordinates the workers of a
+    node and a redis backend the ones of all nodes.
+
+    :param backend: cache backend, see utils.cache.get_backend
+    :param rate: operations per second
+    :type rate: float
+    :param window: seconds per counting window
+    :type window: float
+    :param key: key of the counters in the backend
+    :type key: str
+    """
+
+    def __init__(self, backend, rate, window=1.0, key='admission:upstream'):
+        self.backend = backend
+        self.rate = rate
+        self.window = window
+        self.key = key
+        self._limit = max(int(rate * window), 1)
+        self._exhausted_until = 0.0
+
+    def try_acquire(self, tokens=1):
+        now = time.time()
+        if now < self._exhausted_until:
+            # known to be spent, no need to ask the backend
+            return False
+        slot = int(now // self.window)
+        count = self.backend.incr(f'{self.key}:{slot}', tokens, self.window * 2 + 1)
+        if count > self._limit:
+            self._exhausted_until = (slot + 1) * self.window
+            return False
+        return True
+
+    def wait_time(self, tokens=1):
+        return max(self._exhausted_until - time.time(), 0.0)
+
+
+class AdmissionController(object):
+    """
+    AdmissionController decides when an upstream request may be sent.
+
+    Requests take a token of ``bucket``; while none is available they wait in
+    a queue ordered by priority, interactive slack commands first, then the
+    api, then background work. A request whose estimated wait exceeds its
+    deadline is rejected at once with a 503 instead of queueing, and a client
+    that used up its own quota of ``client_rate`` requests per second is
+    rejected with a 429. Cached answers never get here.
+
+    :param bucket: upstream rate, a utils.ratelimit.TokenBucket or a SharedTokenBucket
+    :param max_waits: seconds a request of each priority may wait
+    :type max_waits: dict
+    :param client_rate: upstream requests per second of a client, 0 for no quota
+    :type client_rate: float
+    :param client_burst: burst of a client, defaults to twice its rate
+    :type client_burst: float
+    :param max_clients: clients whose quota is tracked, the least recent are forgotten
+    :type max_clients: int
+    """
+
+    def __init__(self, bucket, max_waits=None, client_rate=0, client_burst=None, max_clients=10000):
+        self.bucket = bucket
+        self.max_waits = {INTERACTIVE: 2.5, API: 1.0, BACKGROUND: 30.0}
+        self.max_waits.update(max_waits or {})
+        self.client_rate = client_rate
+        self.client_burst = client_burst if client_burst is not None else 2 * client_rate
+        self.max_clients = max_clients
+
+        self.admitted = Counter()
+        self.rejected = Counter()
+        self.waited = 0.0
+
+        self._queue = []
+        self._sequence = itertools.count()
+        self._ready = threading.Condition()
+        self._clients = OrderedDict()
+        self._clients_lock = threading.Lock()
+
+    @property
+    def queued(self):
+        return len(self._queue)
+
+    def _quota(self, client):
+        with self._clients_lock:
+            quota = self._clients.get(client)
+            if quota is None:
+                quota = self._clients[client] = TokenBucket(self.client_rate, self.client_burst)
+                if len(self._clients) > self.max_clients:
+                    self._clients.popitem(last=False)
+            else:
+                self._clients.move_to_end(client)
+            return quota
+
+    def _reject(self, priority, status, retry_after, message, client=None):
+        self.rejected[(priority, status)] += 1
+        raise AdmissionRejected(message, status, retry_after, client)
+
+    def admit(self, priority=None, client=None, deadline=None):
+        """
+        admit blocks until an upstream request may be sent
+
+        :param priority: INTERACTIVE, API or BACKGROUND, defaults to the one of the current context
+        :type priority: int
+        :param client: client the request is made for, defaults to the one of the current context
+        :type client: str
+        :param deadline: time.monotonic() by which the request has to be sent, defaults to the deadline of the
+            current context, see utils.deadline, and is cut to the max wait of its priority
+        :type deadline: float
+        :return: seconds waited
+        :rtype: float
+        :raises AdmissionRejected: if the client is over its quota or the request can not be sent before its deadline
+        """
+        if priority is None:
+            priority, context_client = current()
+            client = client if client is not None else context_client
+
+        start = time.monotonic()
+        if deadline is None:
+            deadline = _deadline.at()
+        if deadline is None:
+            deadline = start + self.max_waits[priority]
+        else:
+            deadline = min(deadline, start + self.max_waits[priority])
+
+        if client is not None and self.client_rate > 0:
+            quota = self._quota(client)
+            if not quota.try_acquire():
+                # the message reaches the client, it does not name it
+                self._reject(priority, 429, quota.wait_time(), 'too many kvb.koeln requests from this client', client)
+
+        with self._ready:
+            ahead = sum(1 for entry in self._queue if entry[0] <= priority)
+            estimate = self.bucket.wait_time() + ahead / self.bucket.rate
+            if start + estimate > deadline:
+                self._reject(priority, 503, estimate, 'kvb.koeln request budget is spent')
+
+            entry = [priority, next(self._sequence)]
+            heapq.heappush(self._queue, entry)
+            try:
+                while True:
+                    if self._queue[0] is entry and self.bucket.try_acquire():
+                        heapq.heappop(self._queue)
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._reject(priority, 503, self.bucket.wait_time(), 'kvb.koeln request budget is spent')
+                    if self._queue[0] is entry:
+                        wait = max(self.bucket.wait_time(), 0.001)
+                    else:
+                        # woken up by the request ahead once it is through
+                        wait = remaining
+                    self._ready.wait(min(wait, remaining))
+            except AdmissionRejected:
+                self._queue.remove(entry)
+                heapq.heapify(self._queue)
+                raise
+            finally:
+                self._ready.notify_all()
+
+        waited = time.monotonic() - start
+        self.admitted[priority] += 1
+        self.waited += waited
+        return waited
+
+    def statistics(self):
+        return {
+            'queued': self.queued,
+            'waited': self.waited,
+            'admitted': {PRIORITY_NAMES[p]: n for p, n in self.admitted.items()},
+            'rejected': {
+                (PRIORITY_NAMES[p], status): n for (p, status), n in self.rejected.items()
+            },
+            'clients': len(self._clients),
+        }
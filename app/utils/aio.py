@@ -0,0 +1,166 @@
+import asyncio
+import concurrent.futures
+import logging
+import os
+import threading
+
+try:
+    from utils.fetch import random_user_agent
+except ImportError:
+    from fetch import random_user_agent
+
+logging.basicConfig()
+logger = logging.getLogger('aio')
+
+
+class AsyncFetchEngine(object):
+    """
+    AsyncFetchEngine runs all kvb downloads of a worker on one asyncio event loop.
+
+    The loop lives in a daemon thread, request threads hand coroutines to it
+    and wait for the result, so hundreds of lookups can be in flight while
+    only ``concurrency`` requests actually hit kvb.koeln at the same time.
+
+    :param concurrency: maximum number of requests in flight towards kvb
+    :type concurrency: int
+    :param timeout: connect and read timeout in seconds
+    :type timeout: tuple
+    """
+
+    def __init__(self, concurrency=100, timeout=(3, 10)):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.in_flight = 0
+        self.waiting = 0
+
+        self._loop = asyncio.new_event_loop()
+        self._ready = threading.Event()
+        self._error = None
+        self._thread = threading.Thread(
+            target=self._run, name='kvb-async-fetch', daemon=True
+        )
+        self._thread.start()
+        self._ready.wait()
+        if self._error is not None:
+            # e.g., aiohttp is not installed, the next get_engine tries again
+            self._thread.join()
+            raise self._error
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        try:
+            self._loop.run_until_complete(self._start())
+        except BaseException as e:
+            self._error = e
+            self._loop.close()
+            return
+        finally:
+            self._ready.set()
+        self._loop.run_forever()
+
+    async def _start(self):
+        # aiohttp is the slowest import of the app, it is only needed once the first page is fetched
+        import aiohttp
+
+        connect_timeout, read_timeout = self.timeout
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.concurrency),
+            timeout=aiohttp.ClientTimeout(
+                sock_connect=connect_timeout, sock_read=read_timeout
+            ),
+        )
+
+    async def fetch(self, url, headers=None):
+        """
+        fetch downloads a page, it has to be awaited on the engine loop
+
+        :param url: url of the page
+        :type url: str
+        :return: status code and text of the response
+        :rtype: tuple
+        """
+        if headers is None:
+            headers = random_user_agent()
+
+        self.waiting += 1
+        try:
+            # cancelled while waiting, e.g., by the timeout of run, the count is released as well
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.in_flight += 1
+        try:
+            async with self._session.get(url, headers=headers) as resp:
+                return resp.status, await resp.text()
+        finally:
+            self.in_flight -= 1
+            self._semaphore.release()
+
+    def submit(self, coro):
+        """
+        submit schedules a coroutine on the engine loop from any thread
+
+        :return: future of the result of the coroutine
+        :rtype: concurrent.futures.Future
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+    def run(self, coro, timeout=None):
+        """
+        run executes a coroutine on the engine loop and waits for its result
+
+        A coroutine still running after ``timeout`` seconds is cancelled, nobody waits for it anymore.
+        """
+        future = self.submit(coro)
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise
+
+    def get(self, url, headers=None, timeout=None):
+        """
+        get downloads a page and blocks the calling thread until it is done
+
+        :return: status code and text of the response
+        :rtype: tuple
+        """
+        return self.run(self.fetch(url, headers=headers), timeout=timeout)
+
+    def statistics(self):
+        return {
+            'concurrency': self.concurrency,
+            'in_flight': self.in_flight,
+            'waiting': self.waiting,
+        }
+
+
+_ENGINE = None
+_ENGINE_PID = None
+_ENGINE_LOCK = threading.Lock()
+
+
+def get_engine():
+    """
+    get_engine returns the async fetch engine of this process
+
+    The engine is started on first use in every worker process, the number of
+    concurrent kvb requests is set with KVB_ASYNC_CONCURRENCY.
+    """
+    global _ENGINE, _ENGINE_PID
+
+    # the event loop thread does not survive a fork
+    if _ENGINE is None or _ENGINE_PID != os.getpid():
+        with _ENGINE_LOCK:
+            if _ENGINE is None or _ENGINE_PID != os.getpid():
+                _ENGINE = AsyncFetchEngine(
+                    concurrency=int(os.environ.get('KVB_ASYNC_CONCURRENCY', 100)),
+                    timeout=(
+                        float(os.environ.get('KVB_CONNECT_TIMEOUT', 3)),
+                        float(os.environ.get('KVB_READ_TIMEOUT', 10)),
+                    ),
+                )
+                _ENGINE_PID = os.getpid()
+
+    return _ENGINE
@@ -0,0 +1,118 @@
+import logging
+import threading
+import time
+
+logging.basicConfig()
+logger = logging.getLogger('breaker')
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpenError(Exception):
+    """
+    CircuitOpenError is raised instead of calling an upstream that is known to be down
+    """
+
+
+class CircuitBreaker(object):
+    """
+    CircuitBreaker stops calling an upstream after repeated failures.
+
+    After ``failure_threshold`` consecutive failures the circuit opens and
+    calls are refused for ``reset_timeout`` seconds. Then it is half open:
+    up to ``half_open_probes`` calls are let through as probes, one success
+    closes the circuit again and a failure opens it for another period.
+
+    :param name: name of the upstream, used in logs
+    :type name: str
+    :param failure_threshold: consecutive failures that open the circuit
+    :type failure_threshold: int
+    :param reset_timeout: seconds the circuit stays open before probing
+    :type reset_timeout: float
+    :param half_open_probes: calls let through while half open
+    :type half_open_probes: int
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30, half_open_probes=1):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_probes = half_open_probes
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.transitions = 0
+        self.rejected = 0
+
+        self._probes = 0
+        self._lock = threading.Lock()
+
+    def _transition(self, state):
+        if state != self.state:
+            logger.warning(f'circuit of {self.name}: {self.state} -> {state}')
+            self.state = state
+            self.transitions += 1
+
+    def allow(self):
+        """
+        allow tells whether a call may go to the upstream now
+
+        :rtype: bool
+        """
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN:
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    self.rejected += 1
+                    return False
+                self._transition(HALF_OPEN)
+                self._probes = 0
+            if self._probes < self.half_open_probes:
+                self._probes += 1
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._transition(CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+                self._transition(OPEN)
+
+    def call(self, func, *args, **kwargs):
+        """
+        call runs func through the breaker, exceptions count as failures
+        """
+        if not self.allow():
+            raise CircuitOpenError(f'circuit of {self.name} is open')
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            self.record_failure()
+            raise
+        self.record_success()
+        return result
+
+    def snapshot(self):
+        """
+        snapshot of the breaker state for api responses
+
+        :rtype: dict
+        """
+        retry_in = None
+        if self.state == OPEN:
+            retry_in = max(self.reset_timeout - (time.monotonic() - self.opened_at), 0)
+        return {
+            'breaker': self.state,
+            'failures': self.failures,
+            'retry_in': retry_in,
+        }
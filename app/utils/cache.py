@@ -0,0 +1,488 @@
+import logging
+import os
+import pickle
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from urllib.parse import urlparse
+
+try:
+    from utils import deadline as _deadline
+    from utils.universal import private_dir
+except ImportError:
+    import deadline as _deadline
+    from universal import private_dir
+
+logging.basicConfig()
+logger = logging.getLogger('cache')
+
+
+class MemoryBackend(object):
+    """
+    MemoryBackend keeps entries in a dict private to the process.
+
+    :param maxsize: maximum number of entries kept
+    :type maxsize: int
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        item = self._data.get(key)
+        if item is None:
+            return None
+        expires_at, value = item
+        if expires_at < time.time():
+            return None
+        return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            if key not in self._data and len(self._data) >= self.maxsize:
+                self._evict()
+            self._data[key] = (time.time() + ttl, value)
+
+    def add(self, key, value, ttl):
+        with self._lock:
+            if self.get(key) is not None:
+                return False
+            if key not in self._data and len(self._data) >= self.maxsize:
+                self._evict()
+            self._data[key] = (time.time() + ttl, value)
+            return True
+
+    def incr(self, key, amount, ttl):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] < time.time():
+                if key not in self._data and len(self._data) >= self.maxsize:
+                    self._evict()
+                item = (time.time() + ttl, 0)
+            self._data[key] = (item[0], item[1] + amount)
+            return item[1] + amount
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def _evict(self):
+        now = time.time()
+        expired = [k for k, (expires_at, _) in self._data.items() if expires_at < now]
+        for k in expired:
+            del self._data[k]
+        if len(self._data) >= self.maxsize:
+            # dicts keep insertion order, so the first key is the oldest one
+            del self._data[next(iter(self._data))]
+
+
+class SQLiteBackend(object):
+    """
+    SQLiteBackend keeps entries in a local sqlite file shared by all workers of a node.
+
+    The database runs in WAL mode so readers do not block the writer. Every
+    thread of every process uses its own connection.
+
+    :param path: path of the database file
+    :type path: str
+    :param maxsize: maximum number of entries kept, the ones expiring first are evicted
+    :type maxsize: int
+    """
+
+    def __init__(self, path=None, maxsize=10000):
+        if path is None:
+            path = os.path.join(private_dir(), 'cache.sqlite')
+        self.path = path
+        self.maxsize = maxsize
+        self._local = threading.local()
+        self._writes = 0
+
+        connection = self._connection()
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS cache '
+            '(key TEXT PRIMARY KEY, value BLOB, expires_at REAL)'
+        )
+        connection.execute(
+            'CREATE INDEX IF NOT EXISTS cache_expires_at ON cache (expires_at)'
+        )
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            # sqlite3 is imported on first use to keep the start of the app fast
+            import sqlite3
+
+            connection = sqlite3.connect(
+                self.path, timeout=5, isolation_level=None
+            )
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def get(self, key):
+        row = self._connection().execute(
+            'SELECT value FROM cache WHERE key = ? AND expires_at >= ?',
+            (key, time.time())
+        ).fetchone()
+        if row is None:
+            return None
+        return pickle.loads(row[0])
+
+    def set(self, key, value, ttl):
+        self._connection().execute(
+            'INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)',
+            (key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), time.time() + ttl)
+        )
+        self._written()
+
+    def add(self, key, value, ttl):
+        connection = self._connection()
+        now = time.time()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.execute(
+                'DELETE FROM cache WHERE key = ? AND expires_at < ?', (key, now)
+            )
+            cursor = connection.execute(
+                'INSERT OR IGNORE INTO cache (key, value, expires_at) VALUES (?, ?, ?)',
+                (key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), now + ttl)
+            )
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        self._written()
+        return cursor.rowcount == 1
+
+    def incr(self, key, amount, ttl):
+        connection = self._connection()
+        now = time.time()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute(
+                'SELECT value, expires_at FROM cache WHERE key = ? AND expires_at >= ?', (key, now)
+            ).fetchone()
+            value, expires_at = (pickle.loads(row[0]), row[1]) if row else (0, now + ttl)
+            value += amount
+            connection.execute(
+                'INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)',
+                (key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), expires_at)
+            )
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        if row is None:
+            self._written()
+        return value
+
+    def delete(self, key):
+        self._connection().execute('DELETE FROM cache WHERE key = ?', (key,))
+
+    def _written(self):
+        # bounding the size costs a count, so it is only checked now and then
+        self._writes += 1
+        if self._writes % 100 == 0:
+            self.evict()
+
+    def evict(self):
+        connection = self._connection()
+        connection.execute('DELETE FROM cache WHERE expires_at < ?', (time.time(),))
+        size = connection.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+        if size > self.maxsize:
+            connection.execute(
+                'DELETE FROM cache WHERE key IN '
+                '(SELECT key FROM cache ORDER BY expires_at LIMIT ?)',
+                (size - self.maxsize,)
+            )
+
+
+class RedisBackend(object):
+    """
+    RedisBackend keeps entries in redis, or any server speaking its protocol.
+
+    The size bound is the maxmemory policy of the server, e.g., allkeys-lru.
+
+    :param url: redis url, e.g., redis://localhost:6379/0
+    :type url: str
+    """
+
+    def __init__(self, url):
+        try:
+            import redis
+        except ImportError:
+            raise Exception('The redis cache backend needs the redis package: pip install redis')
+
+        self.client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        value = self.client.get(key)
+        if value is None:
+            return None
+        return pickle.loads(value)
+
+    def set(self, key, value, ttl):
+        self.client.set(
+            key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), px=int(ttl * 1000)
+        )
+
+    def add(self, key, value, ttl):
+        return bool(self.client.set(
+            key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), px=int(ttl * 1000), nx=True
+        ))
+
+    def incr(self, key, amount, ttl):
+        # counters are plain integers in redis, they are only read back through incr
+        value = self.client.incrby(key, amount)
+        if value == amount:
+            self.client.pexpire(key, int(ttl * 1000))
+        return value
+
+    def delete(self, key):
+        self.client.delete(key)
+
+
+def get_backend(url=None, maxsize=10000):
+    """
+    get_backend creates the cache backend for a url
+
+    - memory:// keeps entries in the process
+    - sqlite:///path/to/file.sqlite shares entries between the workers of a node
+    - redis://host:port/db shares entries between nodes
+
+    :param url: backend url, defaults to a sqlite file in the private directory of utils.universal.private_dir
+    :type url: str
+    :param maxsize: maximum number of entries of memory and sqlite backends
+    :type maxsize: int
+    """
+    if not url:
+        return SQLiteBackend(maxsize=maxsize)
+
+    parsed = urlparse(url)
+    if parsed.scheme == 'memory':
+        return MemoryBackend(maxsize=maxsize)
+    elif parsed.scheme == 'sqlite':
+        return SQLiteBackend(path=parsed.path or None, maxsize=maxsize)
+    elif parsed.scheme in ('redis', 'rediss', 'unix'):
+        return RedisBackend(url)
+    else:
+        raise Exception(f'Unknown cache backend {url}, use memory://, sqlite:/// or redis://')
+
+
+class TTLCache(object):
+    """
+    TTLCache is a namespace of a cache backend whose entries expire after ``ttl`` seconds.
+
+    Concurrent misses for the same key are coalesced: within a process the
+    first caller computes the value while the others wait for its result,
+    across processes the first one takes a lock entry in the backend and the
+    others wait for the value to show up. So only one upstream fetch per key
+    is in flight at any time.
+
+    Entries are kept for ``stale_ttl`` seconds after they expired. Until then
+    get_or_set(serve_stale=True) returns them right away and refreshes them
+    in the background (stale-while-revalidate).
+
+    :param ttl: seconds an entry stays fresh
+    :type ttl: int
+    :param backend: shared backend, defaults to a private MemoryBackend
+    :param namespace: prefix of the keys in the backend
+    :type namespace: str
+    :param lock_timeout: seconds other workers wait for a fetch holding the lock
+    :type lock_timeout: float
+    :param stale_ttl: seconds expired entries are kept to be served stale
+    :type stale_ttl: int
+    """
+
+    def __init__(self, ttl=20, backend=None, namespace='', lock_timeout=10, stale_ttl=0):
+        self.ttl = ttl
+        self.backend = backend if backend is not None else MemoryBackend()
+        self.namespace = namespace
+        self.lock_timeout = lock_timeout
+        self.stale_ttl = stale_ttl
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.stale_hits = 0
+        self.revalidations = 0
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._revalidator = None
+
+    def _entry(self, key):
+        # entries are stored as (expires_at, value)
+        return self.backend.get(self.namespace + key)
+
+    def get(self, key, min_ttl=0):
+        """
+        get returns the value of key if it is fresh
+
+        :param min_ttl: seconds the value has to stay fresh at least
+        :type min_ttl: float
+        """
+        entry = self._entry(key)
+        if entry is None or entry[0] < time.time() + min_ttl:
+            return None
+        return entry[1]
+
+    def get_stale(self, key):
+        """
+        get_stale returns the value of key even if it expired, as long as it is kept
+        """
+        entry = self._entry(key)
+        if entry is None:
+            return None
+        return entry[1]
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        self.backend.set(
+            self.namespace + key, (time.time() + ttl, value), ttl + self.stale_ttl
+        )
+
+    def get_or_set(self, key, func, serve_stale=False):
+        """
+        get_or_set returns the cached value of key or computes it with func
+
+        :param key: cache key
+        :param func: callable without arguments that produces the value
+        :param serve_stale: return an expired value at once and refresh it in the background
+        :type serve_stale: bool
+        :return: cached or freshly computed value
+        """
+        entry = self._entry(key)
+        if entry is not None:
+            expires_at, value = entry
+            if expires_at >= time.time():
+                self.hits += 1
+                return value
+            if serve_stale:
+                self.stale_hits += 1
+                self.revalidate(key, func)
+                return value
+
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._inflight[key] = future
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            logger.debug(f'waiting for in-flight fetch of {key}')
+            # at most until the deadline of the request, see utils.deadline
+            return future.result(_deadline.remaining())
+
+        return self._lead(key, func, future)
+
+    def refresh(self, key, func, min_ttl=0):
+        """
+        refresh computes key again unless its value stays fresh for min_ttl more seconds
+
+        Like get_or_set it goes through the lock of the backend, of the workers
+        refreshing the same key at once only one calls func, the others find
+        its value.
+
+        :param key: cache key
+        :param func: callable without arguments that produces the value
+        :param min_ttl: seconds the value has to stay fresh to be kept
+        :type min_ttl: float
+        :return: whether func was called by this process
+        :rtype: bool
+        """
+        if self.get(key, min_ttl) is not None:
+            return False
+        with self._lock:
+            if key in self._inflight:
+                # fetched by a request of this process right now
+                return False
+            future = Future()
+            self._inflight[key] = future
+
+        called = []
+
+        def compute():
+            called.append(True)
+            return func()
+
+        self._lead(key, compute, future, min_ttl)
+        return bool(called)
+
+    def revalidate(self, key, func):
+        """
+        revalidate refreshes key in the background unless a fetch of it is in flight already
+        """
+        with self._lock:
+            if key in self._inflight:
+                return
+            future = Future()
+            self._inflight[key] = future
+            if self._revalidator is None:
+                self._revalidator = ThreadPoolExecutor(
+                    max_workers=2, thread_name_prefix='cache-revalidate'
+                )
+
+        self.revalidations += 1
+        self._revalidator.submit(self._revalidate, key, func, future)
+
+    def _revalidate(self, key, func, future):
+        try:
+            self._lead(key, func, future)
+        except Exception as e:
+            logger.warning(f'could not revalidate {key}: {e}')
+
+    def _lead(self, key, func, future, min_ttl=0):
+        try:
+            value = self._get_or_set_locked(key, func, min_ttl)
+        except Exception as e:
+            # released first, a waiter that retries leads a fetch of its own
+            self._release(key)
+            future.set_exception(e)
+            raise
+        self._release(key)
+        future.set_result(value)
+        return value
+
+    def _release(self, key):
+        with self._lock:
+            self._inflight.pop(key, None)
+
+    def _get_or_set_locked(self, key, func, min_ttl=0):
+        lock_key = self.namespace + 'lock:' + key
+        deadline = time.monotonic() + self.lock_timeout
+        request_deadline = _deadline.at()
+
+        locked = self.backend.add(lock_key, os.getpid(), self.lock_timeout)
+        while not locked:
+            # another worker is fetching, its result lands in the backend
+            value = self.get(key, min_ttl)
+            if value is not None:
+                self.coalesced += 1
+                return value
+            if request_deadline is not None and time.monotonic() > request_deadline:
+                raise _deadline.DeadlineExceeded(f'no time left to wait for the fetch of {key}')
+            if time.monotonic() > deadline:
+                logger.warning(f'lock of {key} held for too long, fetching anyway')
+                break
+            time.sleep(0.05)
+            locked = self.backend.add(lock_key, os.getpid(), self.lock_timeout)
+
+        try:
+            value = self.get(key, min_ttl)
+            if value is not None:
+                self.hits += 1
+                return value
+            self.misses += 1
+            value = func()
+            self.set(key, value)
+            return value
+        finally:
+            if locked:
+                self.backend.delete(lock_key)
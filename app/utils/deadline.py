@@ -0,0 +1,92 @@
+import contextvars
+import time
+from contextlib import contextmanager
+
+# time.monotonic() by which the current request has to be answered, None without a deadline
+_deadline = contextvars.ContextVar('deadline', default=None)
+
+
+class DeadlineExceeded(Exception):
+    """
+    DeadlineExceeded is raised by a stage that has no time left to do its work
+    """
+
+
+def start(seconds):
+    """
+    start gives the current context ``seconds`` from now, whatever it had before
+
+    Contexts copied afterwards, e.g., with contextvars.copy_context, inherit it.
+
+    :param seconds: budget, None removes the deadline
+    :type seconds: float
+    :return: token for reset
+    """
+    return _deadline.set(None if seconds is None else time.monotonic() + seconds)
+
+
+def reset(token):
+    _deadline.reset(token)
+
+
+@contextmanager
+def within(seconds):
+    """
+    within runs a block with at most ``seconds``, an earlier deadline of the context is kept
+    """
+    at = time.monotonic() + seconds
+    current = _deadline.get()
+    token = _deadline.set(at if current is None else min(at, current))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def at():
+    """
+    at is the time.monotonic() of the deadline of the current context, None without one
+    """
+    return _deadline.get()
+
+
+def remaining(default=None):
+    """
+    remaining seconds of the current context, never below 0
+
+    :param default: returned without a deadline
+    :rtype: float
+    """
+    deadline = _deadline.get()
+    if deadline is None:
+        return default
+    return max(deadline - time.monotonic(), 0.0)
+
+
+def check(stage):
+    """
+    check raises DeadlineExceeded if the current context has no time left
+
+    :param stage: what was about to be done, for the message
+    :type stage: str
+    """
+    if remaining(1) <= 0:
+        raise DeadlineExceeded(f'no time left to {stage}')
+
+
+def trim(timeout):
+    """
+    trim shortens a requests timeout to the time left, a (connect, read) tuple element-wise
+
+    :param timeout: seconds or (connect, read) seconds
+    :return: timeout of the same shape, unchanged without a deadline
+    :raises DeadlineExceeded: if no time is left
+    """
+    left = remaining()
+    if left is None:
+        return timeout
+    if left <= 0:
+        raise DeadlineExceeded('no time left for the request')
+    if isinstance(timeout, tuple):
+        return tuple(left if t is None else min(t, left) for t in timeout)
+    return left if timeout is None else min(timeout, left)
@@ -0,0 +1,309 @@
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+try:
+    from utils.fetch import FetchClient, load_proxy_config, luminati_proxies
+except ImportError:
+    from fetch import FetchClient, load_proxy_config, luminati_proxies
+
+logging.basicConfig()
+logger = logging.getLogger('egress')
+
+# answers of an upstream throttling the exit ip of a session
+_THROTTLED = (403, 407, 429)
+
+
+class ProxySession(object):
+    """
+    ProxySession is one session of the super proxy, i.e., one exit ip, with its own connection pool.
+
+    Latency and error rate are exponentially weighted moving averages over
+    the requests of the session.
+
+    :param config: luminati config, see utils.fetch.load_proxy_config
+    :type config: dict
+    :param pool_maxsize: connections kept open to the proxy
+    :type pool_maxsize: int
+    :param timeout: connect and read timeout in seconds
+    :type timeout: tuple
+    :param alpha: weight of the last request in the averages
+    :type alpha: float
+    """
+
+    def __init__(self, config, pool_maxsize=10, timeout=(3, 10), alpha=0.2):
+        self.session_id = uuid.uuid4().hex[:12]
+        self.proxies = luminati_proxies(proxy_config=config, session_id=self.session_id)
+        # failing over to another session beats retrying through the same exit ip
+        self.client = FetchClient(
+            pool_connections=1, pool_maxsize=pool_maxsize,
+            retry_params={'retries': 0, 'status_forcelist': ()}, timeout=timeout
+        )
+        self.alpha = alpha
+        self.created_at = time.monotonic()
+        self.latency = None
+        self.error_rate = 0.0
+        self.requests = 0
+        self.throttled = 0
+        self.in_flight = 0
+        self.retired = False
+
+    def record(self, latency, error):
+        self.requests += 1
+        if not error:
+            self.latency = latency if self.latency is None else (
+                self.alpha * latency + (1 - self.alpha) * self.latency
+            )
+        self.error_rate = self.alpha * float(error) + (1 - self.alpha) * self.error_rate
+
+    def score(self):
+        """
+        score is the expected cost of a request through the session, lower is better
+
+        Sessions without requests yet score like a fast one so they get tried.
+        """
+        latency = self.latency if self.latency is not None else 0.0
+        return (latency + 0.05 * self.in_flight) * (1 + 10 * self.error_rate)
+
+    def get(self, url, headers=None):
+        return self.client.get(url, headers=headers, proxies=self.proxies)
+
+    def close(self):
+        self.client.session.close()
+
+    def statistics(self):
+        return {
+            'session_id': self.session_id,
+            'requests': self.requests,
+            'latency': self.latency,
+            'error_rate': self.error_rate,
+            'throttled': self.throttled,
+            'in_flight': self.in_flight,
+            'age': time.monotonic() - self.created_at,
+        }
+
+
+class EgressPool(object):
+    """
+    EgressPool spreads kvb fetches over a pool of proxy sessions.
+
+    Each fetch goes through the better scored of two random sessions (power
+    of two choices), or with ``sticky`` through the session its key is pinned
+    to, so a station is always fetched from the same exit ip. A session is
+    retired and replaced by a fresh one, i.e., a new exit ip, when it is
+    throttled (403, 407 or 429), when its error rate exceeds
+    ``max_error_rate`` or when it is older than ``max_age``.
+
+    :param config: luminati config, see utils.fetch.load_proxy_config
+    :type config: dict
+    :param size: number of sessions
+    :type size: int
+    :param pool_maxsize: connections per session
+    :type pool_maxsize: int
+    :param timeout: connect and read timeout in seconds
+    :type timeout: tuple
+    :param max_error_rate: error rate that retires a session
+    :type max_error_rate: float
+    :param min_requests: requests of a session before its error rate is judged
+    :type min_requests: int
+    :param max_age: seconds after which a session is rotated, 0 keeps sessions
+    :type max_age: float
+    :param sticky: pin keys to sessions
+    :type sticky: bool
+    :param attempts: sessions tried per fetch
+    :type attempts: int
+    :param max_pins: keys pinned at most, the least recently used key is unpinned first
+    :type max_pins: int
+    """
+
+    def __init__(
+        self, config, size=4, pool_maxsize=10, timeout=(3, 10), max_error_rate=0.5,
+        min_requests=5, max_age=600, sticky=False, attempts=2, max_pins=1024
+        ):
+        self.config = config
+        self.size = size
+        self.pool_maxsize = pool_maxsize
+        self.timeout = timeout
+        self.max_error_rate = max_error_rate
+        self.min_requests = min_requests
+        self.max_age = max_age
+        self.sticky = sticky
+        self.attempts = attempts
+        self.max_pins = max_pins
+        self.retired = 0
+
+        self._lock = threading.Lock()
+        self._sessions = [self._new_session() for _ in range(size)]
+        # keys are ids sent by clients, so the pins are bounded and counted per session
+        self._pins = OrderedDict()
+        self._pinned = {}
+
+    def _new_session(self):
+        return ProxySession(self.config, pool_maxsize=self.pool_maxsize, timeout=self.timeout)
+
+    @property
+    def sessions(self):
+        return list(self._sessions)
+
+    def choose(self, key=None, exclude=()):
+        """
+        choose picks the session for a fetch
+
+        :param key: key pinned to a session if the pool is sticky, e.g., the station id
+        :param exclude: sessions not to pick, e.g., the ones that failed this fetch
+        :rtype: ProxySession
+        """
+        with self._lock:
+            return self._choose(key, exclude)
+
+    def _choose(self, key, exclude):
+        # called with the lock held
+        candidates = [s for s in self._sessions if s not in exclude] or self._sessions
+        if self.sticky and key is not None and not exclude:
+            session = self._pins.get(key)
+            if session is not None and not session.retired:
+                self._pins.move_to_end(key)
+                return session
+            if session is not None:
+                self._unpin(key)
+            # the least pinned session takes the key
+            session = min(candidates, key=lambda s: self._pinned.get(s, 0))
+            self._pins[key] = session
+            self._pinned[session] = self._pinned.get(session, 0) + 1
+            while len(self._pins) > self.max_pins:
+                self._unpin(next(iter(self._pins)))
+            return session
+        if len(candidates) == 1:
+            return candidates[0]
+        a, b = random.sample(candidates, 2)
+        return a if a.score() <= b.score() else b
+
+    def _unpin(self, key):
+        session = self._pins.pop(key)
+        self._pinned[session] -= 1
+        if not self._pinned[session]:
+            del self._pinned[session]
+
+    def _acquire(self, key, exclude):
+        # the session can not be retired and closed between the choice and the request
+        with self._lock:
+            session = self._choose(key, exclude)
+            session.in_flight += 1
+            return session
+
+    def _release(self, session):
+        with self._lock:
+            session.in_flight -= 1
+            # the last request of a session retired while it ran closes it
+            close = session.retired and session.in_flight == 0
+        if close:
+            session.close()
+
+    def retire(self, session, reason):
+        with self._lock:
+            if session.retired or session not in self._sessions:
+                return
+            session.retired = True
+            self._sessions[self._sessions.index(session)] = self._new_session()
+            self.retired += 1
+            # otherwise the last running request closes it, see _release
+            close = session.in_flight == 0
+        logger.warning(
+            f'retired proxy session {session.session_id} after {session.requests} requests: {reason}'
+        )
+        if close:
+            session.close()
+
+    def _judge(self, session, status):
+        if status in _THROTTLED:
+            session.throttled += 1
+            self.retire(session, f'throttled with {status}')
+        elif session.requests >= self.min_requests and session.error_rate > self.max_error_rate:
+            self.retire(session, f'error rate {session.error_rate:.2f}')
+        elif self.max_age and time.monotonic() - session.created_at > self.max_age:
+            self.retire(session, 'rotated')
+
+    def get(self, url, key=None, headers=None):
+        """
+        get downloads a page through the pool, failing over to another session on errors
+
+        :param url: url of the page
+        :type url: str
+        :param key: key pinned to a session if the pool is sticky
+        :return: response of the request
+        :rtype: requests.Response
+        """
+        tried = []
+        error = None
+        for _ in range(self.attempts):
+            session = self._acquire(key, tried)
+            tried.append(session)
+            start = time.perf_counter()
+            try:
+                page = session.get(url, headers=headers)
+            except Exception as e:
+                session.record(time.perf_counter() - start, True)
+                self._judge(session, None)
+                error = e
+                continue
+            finally:
+                self._release(session)
+
+            failed = page.status_code >= 500 or page.status_code in _THROTTLED
+            session.record(time.perf_counter() - start, failed)
+            self._judge(session, page.status_code)
+            if not failed:
+                return page
+            error = None
+            last = page
+
+        if error is not None:
+            raise error
+        return last
+
+    def statistics(self):
+        return {
+            'retired': self.retired,
+            'sessions': [s.statistics() for s in self.sessions],
+        }
+
+
+_POOL = None
+_POOL_PID = None
+_POOL_LOCK = threading.Lock()
+
+
+def get_egress():
+    """
+    get_egress returns the egress pool of this process
+
+    The luminati config is read once from KVB_PROXY_CONFIG (json) or
+    KVB_PROXY_CONFIG_PATH, the pool is sized with KVB_PROXY_SESSIONS.
+    """
+    global _POOL, _POOL_PID
+
+    # connections must not be shared with forked workers
+    if _POOL is None or _POOL_PID != os.getpid():
+        with _POOL_LOCK:
+            if _POOL is None or _POOL_PID != os.getpid():
+                config = load_proxy_config(
+                    config_path=os.environ.get('KVB_PROXY_CONFIG_PATH'),
+                    proxy_config=os.environ.get('KVB_PROXY_CONFIG'),
+                )
+                _POOL = EgressPool(
+                    config,
+                    size=int(os.environ.get('KVB_PROXY_SESSIONS', 4)),
+                    pool_maxsize=int(os.environ.get('KVB_POOL_MAXSIZE', 10)),
+                    timeout=(
+                        float(os.environ.get('KVB_CONNECT_TIMEOUT', 3)),
+                        float(os.environ.get('KVB_READ_TIMEOUT', 10)),
+                    ),
+                    max_age=float(os.environ.get('KVB_PROXY_MAX_AGE', 600)),
+                    sticky=os.environ.get('KVB_PROXY_STICKY', '0') == '1',
+                )
+                _POOL_PID = os.getpid()
+    return _POOL
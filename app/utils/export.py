@@ -0,0 +1,145 @@
+import csv
+import logging
+from collections import deque
+
+try:
+    from utils.payload import dumps
+    from utils.universal import iter_flatten
+except ImportError:
+    from payload import dumps
+    from universal import iter_flatten
+
+logging.basicConfig()
+logger = logging.getLogger('export')
+
+# every row has these columns in this order, whatever the departures carry
+EXPORT_COLUMNS = (
+    'station_id', 'station', 'fetched_at', 'age', 'stale',
+    'line', 'terminal', 'departures_in', 'departures_at', 'error',
+)
+
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv; charset=utf-8',
+}
+
+
+def departure_rows(departures, columns=EXPORT_COLUMNS):
+    """
+    departure_rows turns the departures of a station into rows of a fixed schema
+
+    The departures are flattened with utils.universal.iter_flatten, keys that
+    are not columns are dropped and missing columns are None, so rows keep
+    their shape if the kvb page gains or loses a cell. A station whose
+    departures could not be retrieved has one row with the message in
+    ``error`` instead, so consumers can tell it apart from a station without
+    departures.
+
+    :param departures: result of retrieve_departures
+    :type departures: dict
+    :param columns: columns of the rows
+    :type columns: tuple
+    :return: one dict per departure, header rows are skipped
+    :rtype: generator
+    """
+    station = departures.get('station') or {}
+    common = {
+        'station_id': station.get('id'),
+        'station': station.get('name'),
+        'fetched_at': departures.get('fetched_at'),
+        'age': departures.get('age'),
+        'stale': departures.get('stale'),
+    }
+    status = departures.get('status', 200)
+    if status != 200:
+        row = dict.fromkeys(columns)
+        row.update((key, value) for key, value in common.items() if key in row)
+        if 'error' in row:
+            row['error'] = f"{status}: {departures.get('message')}"
+        yield row
+        return
+    for departure in departures['departures']:
+        if not departure:
+            # header rows have no cells
+            continue
+        row = dict.fromkeys(columns)
+        for key, value in iter_flatten(departure):
+            if key in row:
+                row[key] = value
+        for key, value in common.items():
+            if key in row:
+                row[key] = value
+        yield row
+
+
+def ordered_results(executor, func, items, window=8):
+    """
+    ordered_results runs func over items on an executor and yields the results in the order of the items
+
+    At most ``window`` calls are submitted ahead of the one yielded next, so
+    memory does not grow with the number of items and the first result is
+    yielded as soon as it is done. The calls not yet done are cancelled when
+    the consumer stops early, e.g., a client that disconnected.
+
+    :param executor: concurrent.futures executor
+    :param func: callable of one item
+    :param items: iterable of items
+    :param window: calls in flight at most
+    :type window: int
+    :return: (item, future) pairs whose future is done
+    :rtype: generator
+    """
+    pending = deque()
+    items = iter(items)
+    try:
+        for item in items:
+            pending.append((item, executor.submit(func, item)))
+            if len(pending) >= window:
+                item, future = pending.popleft()
+                future.exception()
+                yield item, future
+        while pending:
+            item, future = pending.popleft()
+            future.exception()
+            yield item, future
+    finally:
+        for _, future in pending:
+            future.cancel()
+
+
+class _Line(object):
+    # csv.writer writes into it and gets the formatted line back
+    def write(self, value):
+        return value
+
+
+def serialize(stations, kind='ndjson', columns=EXPORT_COLUMNS):
+    """
+    serialize the departures of station after station as ndjson or csv rows, see departure_rows
+
+    Every station is one chunk of the response, a station without departures
+    none, a station that failed one row with its error. csv starts with a
+    line naming the columns.
+
+    :param stations: results of retrieve_departures
+    :type stations: iterable
+    :param kind: one of FORMATS
+    :type kind: str
+    :return: the chunks
+    :rtype: generator of bytes
+    """
+    if kind == 'csv':
+        writer = csv.writer(_Line())
+        yield writer.writerow(columns).encode('utf-8')
+        for departures in stations:
+            chunk = ''.join(
+                writer.writerow([row[column] for column in columns])
+                for row in departure_rows(departures, columns)
+            ).encode('utf-8')
+            if chunk:
+                yield chunk
+    else:
+        for departures in stations:
+            chunk = b''.join(dumps(row) + b'\n' for row in departure_rows(departures, columns))
+            if chunk:
+                yield chunk
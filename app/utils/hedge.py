@@ -0,0 +1,301 @@
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, TimeoutError, wait
+
+try:
+    from utils import deadline as _deadline
+    from utils.universal import retry_timer
+except ImportError:
+    import deadline as _deadline
+    from universal import retry_timer
+
+logging.basicConfig()
+logger = logging.getLogger('hedge')
+
+
+class HedgeTimeout(TimeoutError):
+    """
+    HedgeTimeout is raised when no attempt of a fetch answered within its deadline
+
+    Timeouts of single requests, e.g., a socket read timeout of aiohttp, are
+    TimeoutErrors as well since python 3.11, but they are retried.
+    """
+
+
+class LatencyTracker(object):
+    """
+    LatencyTracker keeps the latencies of the last ``window`` upstream responses for percentiles.
+
+    :param window: number of latencies kept
+    :type window: int
+    :param min_samples: latencies needed before percentiles are given
+    :type min_samples: int
+    """
+
+    def __init__(self, window=1000, min_samples=50):
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=window)
+        self._sorted = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._samples)
+
+    def record(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+            self._sorted = None
+
+    def percentile(self, q):
+        """
+        percentile of the kept latencies
+
+        :param q: quantile between 0 and 1, e.g., 0.95
+        :type q: float
+        :return: latency in seconds, None while there are fewer than min_samples
+        :rtype: float
+        """
+        with self._lock:
+            if len(self._samples) < self.min_samples:
+                return None
+            if self._sorted is None:
+                self._sorted = sorted(self._samples)
+            return self._sorted[min(int(q * len(self._sorted)), len(self._sorted) - 1)]
+
+
+class RetryBudget(object):
+    """
+    RetryBudget caps the extra upstream requests, hedges and retries, to a fraction of the requests.
+
+    Every request deposits ``ratio`` tokens and every extra request takes a
+    whole one, so at most ``ratio`` extra requests are made per request on
+    average. When kvb.koeln fails everything the budget runs dry instead of
+    multiplying the load. The budget starts empty, so a worker that starts
+    while kvb.koeln is down, or a restart of all of them, does not begin with
+    a burst of extra requests.
+
+    :param ratio: extra requests allowed per request
+    :type ratio: float
+    :param capacity: tokens saved at most, the burst of extra requests
+    :type capacity: float
+    :param initial: tokens at the start
+    :type initial: float
+    """
+
+    def __init__(self, ratio=0.1, capacity=10, initial=0):
+        self.ratio = ratio
+        self.capacity = capacity
+        self.exhausted = 0
+        self._tokens = min(capacity, initial)
+        self._lock = threading.Lock()
+
+    @property
+    def tokens(self):
+        return self._tokens
+
+    def deposit(self):
+        with self._lock:
+            # rounded, ten deposits of 0.1 make a whole token
+            self._tokens = min(self.capacity, round(self._tokens + self.ratio, 9))
+
+    def withdraw(self):
+        """
+        withdraw takes the token of an extra request
+
+        :return: whether the extra request may be made
+        :rtype: bool
+        """
+        with self._lock:
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            self.exhausted += 1
+            return False
+
+
+class HedgedFetcher(object):
+    """
+    HedgedFetcher sends hedged and retried requests to an upstream within a deadline.
+
+    When a response takes longer than the ``quantile`` of the recent
+    latencies, a second, hedged request is sent and the first good response
+    wins; the other one is left to finish and only feeds the latencies.
+    Failed attempts, errors and 5xx, are retried after the ``retry_timer``
+    interval of ``retry_mode``. Nothing is waited for beyond ``deadline``
+    seconds from the start of the fetch, the attempts still running then are
+    cancelled (a download of the thread pool only if it has not started yet).
+
+    A fetch made within a utils.deadline context gets its remaining time at
+    most instead of ``deadline``.
+
+    Hedges and retries are extra requests: each one needs a token of
+    ``budget`` and the consent of ``allow``, e.g., a closed circuit breaker.
+
+    :param submit: callable starting the download of a url, returning a concurrent.futures.Future of status and text
+    :param tracker: latencies of the upstream
+    :type tracker: LatencyTracker
+    :param budget: budget of the extra requests
+    :type budget: RetryBudget
+    :param quantile: latency quantile after which a request is hedged
+    :type quantile: float
+    :param delay: seconds before hedging while the tracker has too few latencies
+    :type delay: float
+    :param min_delay: seconds before hedging at least
+    :type min_delay: float
+    :param retries: attempts after the first one
+    :type retries: int
+    :param retry_base: base interval of retry_timer in seconds
+    :type retry_base: float
+    :param retry_mode: 'random', 'multiply' or 'multirand', see utils.universal.retry_timer
+    :type retry_mode: str
+    :param deadline: seconds a fetch may take, all attempts included
+    :type deadline: float
+    :param allow: callable telling whether extra requests may be sent at all
+    """
+
+    def __init__(
+        self, submit, tracker=None, budget=None, quantile=0.95, delay=1.0, min_delay=0.02,
+        retries=2, retry_base=0.25, retry_mode='multirand', deadline=8.0, allow=None
+        ):
+        self.submit = submit
+        self.tracker = tracker if tracker is not None else LatencyTracker()
+        self.budget = budget if budget is not None else RetryBudget()
+        self.quantile = quantile
+        self.delay = delay
+        self.min_delay = min_delay
+        self.retries = retries
+        self.retry_base = retry_base
+        self.retry_mode = retry_mode
+        self.deadline = deadline
+        self.allow = allow
+
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.retried = 0
+        self.denied = 0
+        self.timeouts = 0
+
+    def hedge_delay(self):
+        """
+        hedge_delay is the number of seconds a request is given before it is hedged
+        """
+        latency = self.tracker.percentile(self.quantile)
+        if latency is None:
+            return self.delay
+        return max(latency, self.min_delay)
+
+    def _extra(self):
+        if self.allow is not None and not self.allow():
+            self.denied += 1
+            return False
+        if not self.budget.withdraw():
+            self.denied += 1
+            return False
+        return True
+
+    def _start(self, url, kwargs):
+        start = time.monotonic()
+        future = self.submit(url, **kwargs)
+
+        def observe(done):
+            if done.cancelled() or done.exception() is not None:
+                return
+            if done.result()[0] < 500:
+                self.tracker.record(time.monotonic() - start)
+
+        future.add_done_callback(observe)
+        return future
+
+    def _attempt(self, url, deadline, kwargs):
+        primary = self._start(url, kwargs)
+        pending = {primary}
+
+        done, _ = wait(pending, timeout=max(min(self.hedge_delay(), deadline - time.monotonic()), 0))
+        if not done and time.monotonic() < deadline and self._extra():
+            self.hedges += 1
+            pending.add(self._start(url, kwargs))
+
+        error = None
+        answer = None
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    status, text = future.result()
+                except Exception as e:
+                    error = e
+                    continue
+                if status < 500:
+                    if future is not primary:
+                        self.hedge_wins += 1
+                    return status, text
+                answer = (status, text)
+
+        if answer is not None:
+            return answer
+        if error is not None and not pending:
+            raise error
+        for future in pending:
+            future.cancel()
+        self.timeouts += 1
+        raise HedgeTimeout(f'no answer from {url} within the deadline')
+
+    def get(self, url, **kwargs):
+        """
+        get downloads a page, hedging slow requests and retrying failed ones
+
+        :param url: url of the page
+        :type url: str
+        :param kwargs: passed on to submit
+        :return: status code and text of the response, the last one if all attempts answered 5xx
+        :rtype: tuple
+        :raises HedgeTimeout: if no attempt answered within the deadline
+        """
+        self.requests += 1
+        self.budget.deposit()
+        deadline = time.monotonic() + min(self.deadline, _deadline.remaining(self.deadline))
+
+        for attempt in range(self.retries + 1):
+            error = None
+            try:
+                answer = self._attempt(url, deadline, kwargs)
+                if answer[0] < 500:
+                    return answer
+            except HedgeTimeout:
+                raise
+            except Exception as e:
+                error = e
+
+            if attempt == self.retries:
+                break
+            interval = retry_timer(attempt + 1, self.retry_base, mode=self.retry_mode)['interval']
+            if time.monotonic() + interval >= deadline or not self._extra():
+                break
+            self.retried += 1
+            logger.debug(f'retrying {url} in {interval:.2f}s after {error or answer[0]}')
+            time.sleep(interval)
+
+        if error is not None:
+            raise error
+        return answer
+
+    def statistics(self):
+        return {
+            'requests': self.requests,
+            'hedges': self.hedges,
+            'hedge_wins': self.hedge_wins,
+            'retries': self.retried,
+            'denied': self.denied,
+            'timeouts': self.timeouts,
+            'budget_tokens': self.budget.tokens,
+            'hedge_delay': self.hedge_delay(),
+            'p50': self.tracker.percentile(0.5),
+            'p95': self.tracker.percentile(0.95),
+            'p99': self.tracker.percentile(0.99),
+        }
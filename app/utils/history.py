@@ -0,0 +1,285 @@
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+try:
+    from utils.snapshot import departure_minutes
+    from utils.universal import private_dir
+except ImportError:
+    from snapshot import departure_minutes
+    from universal import private_dir
+
+logging.basicConfig()
+logger = logging.getLogger('history')
+
+_SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS terminals (id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL)',
+    # clustered by station and time, the rows of a station are read in one range
+    'CREATE TABLE IF NOT EXISTS departures '
+    '(station_id INTEGER NOT NULL, observed_at INTEGER NOT NULL, line TEXT NOT NULL, '
+    'terminal_id INTEGER NOT NULL, minutes INTEGER NOT NULL, '
+    'PRIMARY KEY (station_id, observed_at, line, terminal_id, minutes)) WITHOUT ROWID',
+    'CREATE INDEX IF NOT EXISTS departures_line ON departures (line, observed_at)',
+    'CREATE INDEX IF NOT EXISTS departures_observed ON departures (observed_at)',
+)
+
+
+class DepartureHistory(object):
+    """
+    DepartureHistory records every fetched departure row into a sqlite file for later analysis.
+
+    ``record`` only appends the rows to a bounded ring buffer, it never
+    touches the disk; a writer thread flushes the buffer in batches every
+    ``flush_interval`` seconds, or sooner once ``batch_size`` rows are
+    waiting. When the writer falls behind by ``buffer_size`` rows the oldest
+    ones are dropped and counted.
+
+    Rows keep the observation time in unix seconds, the station id, line,
+    terminal and minutes until the departure. Terminals are stored once in
+    their own table and rows are clustered by station and time, identical
+    rows of the same second are kept once. The database runs in WAL mode,
+    so queries do not block the writers of the workers of a node.
+
+    :param path: path of the database file
+    :type path: str
+    :param buffer_size: rows kept in memory at most
+    :type buffer_size: int
+    :param batch_size: rows written per transaction at most
+    :type batch_size: int
+    :param flush_interval: seconds between two flushes
+    :type flush_interval: float
+    :param retention: days rows are kept, 0 keeps them forever
+    :type retention: float
+    """
+
+    def __init__(self, path=None, buffer_size=50000, batch_size=5000, flush_interval=5, retention=0):
+        if path is None:
+            path = os.path.join(private_dir(), 'history.sqlite')
+        self.path = path
+        self.buffer_size = buffer_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retention = retention
+
+        self.recorded = 0
+        self.written = 0
+        self.dropped = 0
+        self.flushes = 0
+        self.failed = 0
+
+        self._buffer = deque(maxlen=buffer_size)
+        self._terminals = {}
+        self._local = threading.local()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+        connection = self._connection()
+        connection.execute('PRAGMA journal_mode=WAL')
+        for statement in _SCHEMA:
+            connection.execute(statement)
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            # sqlite3 is imported on first use to keep the start of the app fast
+            import sqlite3
+
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    @property
+    def pending(self):
+        return len(self._buffer)
+
+    def record(self, station_id, fetched):
+        """
+        record queues the departures of a fetch for the writer
+
+        :param station_id: id of the station
+        :type station_id: int
+        :param fetched: result of fetch_departures
+        :type fetched: dict
+        """
+        observed_at = int(fetched['fetched_at'])
+        rows = []
+        for departure in fetched['departures']:
+            minutes = departure_minutes(departure)
+            if minutes is None:
+                # header rows and rows whose time could not be parsed
+                continue
+            rows.append((
+                observed_at, station_id, departure.get('line', ''), departure.get('terminal', ''), minutes
+            ))
+
+        overflow = len(self._buffer) + len(rows) - self.buffer_size
+        if overflow > 0:
+            self.dropped += overflow
+        # appending to a deque is atomic, full buffers drop their oldest rows
+        self._buffer.extend(rows)
+        self.recorded += len(rows)
+        if len(self._buffer) >= self.batch_size:
+            self._wake.set()
+
+    def _terminal_ids(self, connection, names):
+        missing = [name for name in names if name not in self._terminals]
+        if missing:
+            connection.executemany(
+                'INSERT OR IGNORE INTO terminals (name) VALUES (?)', [(name,) for name in missing]
+            )
+            for name in missing:
+                self._terminals[name] = connection.execute(
+                    'SELECT id FROM terminals WHERE name = ?', (name,)
+                ).fetchone()[0]
+        return self._terminals
+
+    def flush(self):
+        """
+        flush writes the buffered rows, one transaction per batch
+
+        :return: number of rows written
+        :rtype: int
+        """
+        written = 0
+        with self._flush_lock:
+            connection = self._connection()
+            while self._buffer:
+                batch = []
+                while self._buffer and len(batch) < self.batch_size:
+                    batch.append(self._buffer.popleft())
+
+                connection.execute('BEGIN IMMEDIATE')
+                try:
+                    terminals = self._terminal_ids(connection, {row[3] for row in batch})
+                    connection.executemany(
+                        'INSERT OR IGNORE INTO departures (observed_at, station_id, line, terminal_id, minutes) '
+                        'VALUES (?, ?, ?, ?, ?)',
+                        [(t, s, line, terminals[terminal], m) for t, s, line, terminal, m in batch]
+                    )
+                    connection.execute('COMMIT')
+                except Exception:
+                    connection.execute('ROLLBACK')
+                    # the ids of a rolled back transaction may not exist
+                    self._terminals.clear()
+                    self.failed += len(batch)
+                    raise
+                written += len(batch)
+
+            self.written += written
+            self.flushes += 1
+        return written
+
+    def prune(self, now=None):
+        """
+        prune deletes the rows older than the retention
+
+        :return: number of rows deleted
+        :rtype: int
+        """
+        if not self.retention:
+            return 0
+        if now is None:
+            now = time.time()
+        cursor = self._connection().execute(
+            'DELETE FROM departures WHERE observed_at < ?', (int(now - self.retention * 86400),)
+        )
+        return cursor.rowcount
+
+    def query(self, station_id=None, line=None, since=None, until=None, limit=1000):
+        """
+        query lists the recorded departures of a station, a line or both within a time window
+
+        :param station_id: id of the station
+        :type station_id: int
+        :param line: line, e.g., '5'
+        :type line: str
+        :param since: unix timestamp the window starts at, included
+        :type since: float
+        :param until: unix timestamp the window ends at, excluded
+        :type until: float
+        :param limit: rows returned at most
+        :type limit: int
+        :return: observation time, station id, line, terminal and minutes, oldest first
+        :rtype: list
+        """
+        clauses = []
+        params = []
+        if station_id is not None:
+            clauses.append('d.station_id = ?')
+            params.append(int(station_id))
+        if line is not None:
+            clauses.append('d.line = ?')
+            params.append(str(line))
+        if since is not None:
+            clauses.append('d.observed_at >= ?')
+            params.append(int(since))
+        if until is not None:
+            clauses.append('d.observed_at < ?')
+            params.append(int(until))
+        where = f'WHERE {" AND ".join(clauses)}' if clauses else ''
+
+        rows = self._connection().execute(
+            'SELECT d.observed_at, d.station_id, d.line, t.name, d.minutes '
+            'FROM departures d JOIN terminals t ON t.id = d.terminal_id '
+            f'{where} ORDER BY d.observed_at, d.station_id LIMIT ?',
+            params + [int(limit)]
+        ).fetchall()
+        return [
+            {
+                'observed_at': observed_at,
+                'station_id': station_id,
+                'line': line,
+                'terminal': terminal,
+                'minutes': minutes,
+            }
+            for observed_at, station_id, line, terminal, minutes in rows
+        ]
+
+    def _run(self):
+        last_prune = 0.0
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+                if self.retention and time.monotonic() - last_prune > 3600:
+                    self.prune()
+                    last_prune = time.monotonic()
+            except Exception as e:
+                logger.warning(f'could not write the departure history: {e}')
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name='kvb-history', daemon=True
+        )
+        self._thread.start()
+        logger.info(f'recording the departure history into {self.path}')
+
+    def stop(self):
+        """
+        stop ends the writer thread and writes the rows still buffered
+        """
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+        self.flush()
+
+    def statistics(self):
+        return {
+            'recorded': self.recorded,
+            'written': self.written,
+            'dropped': self.dropped,
+            'failed': self.failed,
+            'pending': self.pending,
+            'flushes': self.flushes,
+        }
@@ -0,0 +1,179 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+_DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    pairs = ','.join(
+        '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+        for k, v in labels
+    )
+    return '{' + pairs + '}'
+
+
+class Registry(object):
+    """
+    Registry keeps counters, gauges and histograms and renders them in the
+    Prometheus text format.
+
+    Values that live elsewhere (cache statistics, pool sizes) are read at
+    scrape time from collectors registered with add_collector.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._help = {}
+        self._collectors = []
+
+    def describe(self, name, kind, text):
+        self._help[name] = (kind, text)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets=_DEFAULT_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {
+                    'buckets': buckets, 'counts': [0] * len(buckets), 'sum': 0.0, 'count': 0
+                }
+            index = bisect.bisect_left(histogram['buckets'], value)
+            if index < len(histogram['counts']):
+                histogram['counts'][index] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def add_collector(self, collector):
+        """
+        add_collector registers a callable returning (name, kind, labels, value) samples
+        """
+        self._collectors.append(collector)
+
+    def render(self):
+        """
+        render returns all metrics in the Prometheus text exposition format
+        """
+        samples = {}
+        with self._lock:
+            for (name, labels), value in self._counters.items():
+                samples.setdefault(name, []).append((labels, value))
+            histograms = [
+                (name, labels, dict(h, counts=list(h['counts'])))
+                for (name, labels), h in self._histograms.items()
+            ]
+
+        for name, labels, histogram in histograms:
+            cumulative = 0
+            for bound, count in zip(histogram['buckets'], histogram['counts']):
+                cumulative += count
+                samples.setdefault(name + '_bucket', []).append(
+                    (labels + (('le', bound),), cumulative)
+                )
+            samples.setdefault(name + '_bucket', []).append(
+                (labels + (('le', '+Inf'),), histogram['count'])
+            )
+            samples.setdefault(name + '_sum', []).append((labels, histogram['sum']))
+            samples.setdefault(name + '_count', []).append((labels, histogram['count']))
+
+        for collector in self._collectors:
+            for name, kind, labels, value in collector():
+                self._help.setdefault(name, (kind, name))
+                samples.setdefault(name, []).append(
+                    (tuple(sorted(labels.items())), value)
+                )
+
+        lines = []
+        described = set()
+        for name in sorted(samples):
+            base = name
+            for suffix in ('_bucket', '_sum', '_count'):
+                if name.endswith(suffix) and name[:-len(suffix)] in self._help:
+                    base = name[:-len(suffix)]
+            if base in self._help and base not in described:
+                kind, text = self._help[base]
+                lines.append(f'# HELP {base} {text}')
+                lines.append(f'# TYPE {base} {kind}')
+                described.add(base)
+            for labels, value in samples[name]:
+                lines.append(f'{name}{_format_labels(labels)} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+registry.describe(
+    'tram_bot_span_seconds', 'histogram', 'Duration of the stages of a request'
+)
+
+_local = threading.local()
+
+
+def start_request():
+    """
+    start_request resets the span timings collected for the Server-Timing header
+    """
+    _local.timings = []
+
+
+def request_timings():
+    """
+    request_timings returns (span, seconds) of the current request
+    """
+    return getattr(_local, 'timings', [])
+
+
+@contextmanager
+def span(name):
+    """
+    span times a stage of the request
+
+    The duration goes to the tram_bot_span_seconds histogram and to the
+    Server-Timing header of the current request.
+
+    :param name: name of the stage, e.g., fetch or parse
+    :type name: str
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        registry.observe('tram_bot_span_seconds', elapsed, span=name)
+        timings = getattr(_local, 'timings', None)
+        if timings is not None:
+            timings.append((name, elapsed))
+
+
+def timed(name):
+    """
+    timed is a decorator running the whole function in a span
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            with span(name):
+                return f(*args, **kwargs)
+        return decorated_function
+    return decorator
+
+
+def server_timing_header(timings):
+    """
+    server_timing_header formats span timings as a Server-Timing header value
+
+    >>> server_timing_header([('fetch', 0.1204), ('parse', 0.0012)])
+    'fetch;dur=120.4, parse;dur=1.2'
+    """
+    return ', '.join(f'{name};dur={elapsed * 1000:.1f}' for name, elapsed in timings)
@@ -1,5 +1,16 @@
 import re
 
+# compiled once, parse_time runs for every row of every departure table
+_RE_TIME_TAB = re.compile('^(?P<value>.*?)[\u00a0|\s](?P<unit>.*?)$')
+
+_TABLE_ID = 'qr_ergebnis'
+_RE_TABLE_START = re.compile(r'<table[^>]*\bid=["\']?qr_ergebnis\b', re.IGNORECASE)
+_RE_TABLE_END = re.compile(r'</table\s*>', re.IGNORECASE)
+
+# column names of the departure table
+_FIELDS = ['line', 'terminal', 'departures_in']
+
+
 def parse_time(data):
     """
     parse_time parse the extracted time format from html and clean it up.
@@ -34,9 +45,7 @@ def parse_time(data):
             'unit': 'min'
         }
     else:
-        re_time_tab = re.compile('^(?P<value>.*?)[\u00a0|\s](?P<unit>.*?)$')
-
-        time_value_unit = re_time_tab.findall(data)
+        time_value_unit = _RE_TIME_TAB.findall(data)
         if time_value_unit:
             time_value_unit = time_value_unit[0]
             time_value_unit = [i.lower() for i in time_value_unit]
@@ -49,4 +58,90 @@ def parse_time(data):
         except Exception as e:
             raise Exception(f'Could not convert {res} value to float/int: {e}')
 
-    return res
\ No newline at end of file
+    return res
+
+
+def _rows_bs4(html):
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(html, "lxml")
+    table = soup.find('table', id=_TABLE_ID)
+    if not table:
+        return None
+
+    return [
+        dict(zip(_FIELDS, [cell.text for cell in row("td")]))
+        for row in table('tr')
+    ]
+
+
+def _rows_strainer(html):
+    from bs4 import BeautifulSoup, SoupStrainer
+
+    soup = BeautifulSoup(
+        html, "lxml", parse_only=SoupStrainer('table', id=_TABLE_ID)
+    )
+    table = soup.find('table', id=_TABLE_ID)
+    if not table:
+        return None
+
+    return [
+        dict(zip(_FIELDS, [cell.text for cell in row("td")]))
+        for row in table('tr')
+    ]
+
+
+def _rows_lxml(html):
+    import lxml.html
+
+    # cut the table out of the page so that only a few hundred bytes are parsed
+    fragment = None
+    start = _RE_TABLE_START.search(html)
+    if start:
+        end = _RE_TABLE_END.search(html, start.end())
+        if end:
+            fragment = html[start.start():end.end()]
+
+    if fragment is not None:
+        table = lxml.html.fragment_fromstring(fragment)
+    else:
+        # unusual markup, fall back to the whole document
+        tables = lxml.html.fromstring(html).xpath(f'//table[@id="{_TABLE_ID}"]')
+        if not tables:
+            return None
+        table = tables[0]
+
+    return [
+        dict(zip(_FIELDS, [cell.text_content() for cell in row.iter('td')]))
+        for row in table.iter('tr')
+    ]
+
+
+PARSER_BACKENDS = {
+    'bs4': _rows_bs4,
+    'strainer': _rows_strainer,
+    'lxml': _rows_lxml,
+}
+
+
+def parse_departure_table(html, backend='lxml'):
+    """
+    parse_departure_table extracts the rows of the qr_ergebnis table of a kvb departure page
+
+    All backends return the same rows:
+
+    - bs4: BeautifulSoup over the whole document, the reference implementation
+    - strainer: BeautifulSoup restricted to the table with a SoupStrainer
+    - lxml: lxml on the table cut out of the page, the fastest
+
+    :param html: html of the departure page
+    :type html: str
+    :param backend: one of PARSER_BACKENDS
+    :type backend: str
+    :return: rows with line, terminal and departures_in; None if the page has no departure table
+    :rtype: list
+    """
+    if backend not in PARSER_BACKENDS:
+        raise Exception(f'Unknown parser backend {backend}, use one of {list(PARSER_BACKENDS)}')
+
+    return PARSER_BACKENDS[backend](html)
@@ -0,0 +1,144 @@
+import gzip
+import hashlib
+import json
+import threading
+from functools import lru_cache
+from importlib.util import find_spec
+
+# preferred first, brotli is only looked up here, not imported
+ENCODINGS = ('br', 'gzip') if find_spec('brotli') is not None else ('gzip',)
+
+
+@lru_cache(maxsize=None)
+def _orjson():
+    # orjson is imported on first use to keep the start of the app fast
+    try:
+        import orjson
+    except ImportError:
+        return None
+    return orjson
+
+
+@lru_cache(maxsize=None)
+def _brotli():
+    # brotli is imported on first use to keep the start of the app fast
+    import brotli
+    return brotli
+
+
+def dumps(obj):
+    """
+    dumps serializes obj to json bytes, with orjson if it is installed
+
+    :param obj: json serializable object
+    :return: utf-8 encoded json
+    :rtype: bytes
+    """
+    orjson = _orjson()
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def compress(body, encoding, best=False):
+    """
+    compress encodes body for a Content-Encoding
+
+    :param body: response body
+    :type body: bytes
+    :param encoding: 'br' or 'gzip'
+    :type encoding: str
+    :param best: use the slowest, smallest setting, for bodies compressed once and served often
+    :type best: bool
+    :rtype: bytes
+    """
+    if encoding == 'br':
+        return _brotli().compress(body, quality=11 if best else 5)
+    elif encoding == 'gzip':
+        return gzip.compress(body, compresslevel=9 if best else 6, mtime=0)
+    raise ValueError(f'unknown content encoding {encoding}')
+
+
+class Payload(object):
+    """
+    Payload is a serialized response body with its strong ETag and compressed variants.
+
+    Variants are compressed on first use and kept, so a payload served many
+    times is serialized and compressed once. Each variant has its own ETag
+    since its bytes differ.
+
+    :param body: serialized body
+    :type body: bytes
+    :param content_type: Content-Type of the body
+    :type content_type: str
+    :param precompress: compress all variants right away, with the best settings, instead of on first use
+    :type precompress: bool
+    :param min_size: bodies smaller than this many bytes are never compressed
+    :type min_size: int
+    """
+
+    def __init__(self, body, content_type='application/json', precompress=False, min_size=512):
+        self.body = body
+        self.content_type = content_type
+        self.min_size = min_size
+        self.etag = hashlib.blake2b(body, digest_size=16).hexdigest()
+        self.best = precompress
+
+        self._variants = {None: body}
+        self._lock = threading.Lock()
+        if precompress:
+            for encoding in ENCODINGS:
+                self.variant(encoding)
+
+    def __getstate__(self):
+        # payloads are pickled into the prebuilt station map, see utils.stations
+        state = dict(self.__dict__)
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_json(cls, obj, **kwargs):
+        return cls(dumps(obj), **kwargs)
+
+    def negotiate(self, accept_encodings):
+        """
+        negotiate picks the content encoding to send
+
+        :param accept_encodings: Accept-Encoding of the request, werkzeug's request.accept_encodings
+        :return: 'br', 'gzip' or None for the identity
+        """
+        if len(self.body) < self.min_size:
+            return None
+        for encoding in ENCODINGS:
+            if accept_encodings.quality(encoding) > 0:
+                return encoding
+        return None
+
+    def variant(self, encoding):
+        """
+        variant returns the body compressed with encoding, None is the identity
+        """
+        body = self._variants.get(encoding)
+        if body is None:
+            with self._lock:
+                body = self._variants.get(encoding)
+                if body is None:
+                    body = self._variants[encoding] = compress(self.body, encoding, best=self.best)
+        return body
+
+    def variant_etag(self, encoding):
+        if encoding is None:
+            return self.etag
+        return f'{self.etag}-{encoding}'
+
+    def sizes(self):
+        """
+        sizes of the variants compressed so far
+
+        :rtype: dict
+        """
+        return {encoding or 'identity': len(body) for encoding, body in self._variants.items()}
@@ -0,0 +1,167 @@
+import logging
+import random
+import threading
+import time
+from collections import Counter, deque
+
+logging.basicConfig()
+logger = logging.getLogger('prefetch')
+
+
+class HotStations(object):
+    """
+    HotStations counts requests per station id over a sliding time window.
+
+    Counts are kept in buckets of ``bucket_seconds`` so that old requests
+    drop out of the window without storing every request.
+
+    :param window: seconds of request history taken into account
+    :type window: int
+    :param bucket_seconds: resolution of the window
+    :type bucket_seconds: int
+    """
+
+    def __init__(self, window=900, bucket_seconds=60):
+        self.bucket_seconds = bucket_seconds
+        self._buckets = deque(maxlen=max(window // bucket_seconds, 1))
+        self._lock = threading.Lock()
+
+    def _current(self):
+        bucket_start = int(time.time() // self.bucket_seconds)
+        if not self._buckets or self._buckets[-1][0] != bucket_start:
+            self._buckets.append((bucket_start, Counter()))
+        return self._buckets[-1][1]
+
+    def record(self, station_id):
+        with self._lock:
+            self._current()[station_id] += 1
+
+    def counts(self):
+        oldest = int(time.time() // self.bucket_seconds) - self._buckets.maxlen
+        total = Counter()
+        with self._lock:
+            for bucket_start, counter in self._buckets:
+                if bucket_start > oldest:
+                    total.update(counter)
+        return total
+
+    def top(self, n, min_count=1):
+        """
+        top returns the n most requested station ids of the window
+
+        :param n: maximum number of stations
+        :type n: int
+        :param min_count: minimum number of requests of a station
+        :type min_count: int
+        :rtype: list
+        """
+        return [
+            station_id for station_id, count in self.counts().most_common(n)
+            if count >= min_count
+        ]
+
+
+class PrefetchScheduler(object):
+    """
+    PrefetchScheduler keeps departures of hot stations warm in the background.
+
+    Every ``interval`` seconds (with random jitter so workers do not refresh in
+    lockstep) the configured stations and the most requested ones are
+    refreshed, each refresh takes a token of the kvb rate limiter first.
+    Stations that ``needed`` says are still fresh, e.g., refreshed by another
+    worker, are skipped without a token.
+
+    :param refresh: callable refreshing the departures of a station id, False if it found them refreshed already
+    :param hot_stations: request counts per station
+    :type hot_stations: HotStations
+    :param limiter: rate limiter towards kvb.koeln
+    :type limiter: utils.ratelimit.TokenBucket
+    :param stations: station ids that are always kept warm
+    :type stations: list
+    :param interval: seconds between two refresh rounds
+    :type interval: float
+    :param jitter: fraction of the interval added or subtracted at random
+    :type jitter: float
+    :param max_hot: number of learned hot stations kept warm
+    :type max_hot: int
+    :param min_count: requests within the window that make a station hot
+    :type min_count: int
+    :param needed: callable telling whether a station id needs a refresh, all do without
+    """
+
+    def __init__(
+        self, refresh, hot_stations, limiter, stations=None, interval=15,
+        jitter=0.2, max_hot=10, min_count=3, needed=None
+        ):
+        self.refresh = refresh
+        self.needed = needed
+        self.hot_stations = hot_stations
+        self.limiter = limiter
+        self.stations = list(stations or [])
+        self.interval = interval
+        self.jitter = jitter
+        self.max_hot = max_hot
+        self.min_count = min_count
+        self.rounds = 0
+        self.refreshed = 0
+        self.skipped = 0
+        self.failed = 0
+
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def max_interval(self):
+        """
+        max_interval is the most seconds between two rounds, jitter included
+        """
+        return self.interval * (1 + self.jitter)
+
+    def targets(self):
+        """
+        targets are the station ids refreshed in the next round
+        """
+        targets = list(self.stations)
+        for station_id in self.hot_stations.top(self.max_hot, self.min_count):
+            if station_id not in targets:
+                targets.append(station_id)
+        return targets
+
+    def run_once(self):
+        for station_id in self.targets():
+            if self._stop.is_set():
+                return
+            if self.needed is not None and not self.needed(station_id):
+                self.skipped += 1
+                continue
+            self.limiter.acquire()
+            try:
+                if self.refresh(station_id) is False:
+                    self.skipped += 1
+                else:
+                    self.refreshed += 1
+            except Exception as e:
+                self.failed += 1
+                logger.warning(f'could not prefetch station {station_id}: {e}')
+        self.rounds += 1
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.run_once()
+            delay = self.interval * (1 + random.uniform(-self.jitter, self.jitter))
+            self._stop.wait(delay)
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name='kvb-prefetch', daemon=True
+        )
+        self._thread.start()
+        logger.info(
+            f'prefetching every {self.interval}s: {self.stations} and up to {self.max_hot} hot stations'
+        )
+
+    def stop(self):
+        self._stop.set()
@@ -0,0 +1,199 @@
+import logging
+import marshal
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+
+try:
+    from utils.universal import private_dir
+except ImportError:
+    from universal import private_dir
+
+logging.basicConfig()
+logger = logging.getLogger('profiler')
+
+MODES = ('collapsed', 'pstats')
+
+_RE_NAME = re.compile(r'^[\w.-]+\.(collapsed|pstats)$')
+
+
+class StackSampler(object):
+    """
+    StackSampler samples the stack of one thread from a thread of its own.
+
+    Every ``interval`` seconds the current frame of the thread is read and its
+    stack counted in the collapsed format of flame graphs, outermost frame
+    first. The sampled thread runs untouched, a sample costs the sampler a
+    walk of the stack.
+
+    :param thread_id: ident of the thread to sample
+    :type thread_id: int
+    :param interval: seconds between two samples
+    :type interval: float
+    """
+
+    def __init__(self, thread_id, interval=0.002):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='kvb-profiler', daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def collapsed(self):
+        """
+        collapsed renders the samples one stack per line followed by its count, for flamegraph.pl or speedscope
+        """
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+
+class RequestProfile(object):
+    """
+    RequestProfile profiles the calling thread until it is stopped.
+
+    ``collapsed`` samples the stack, see StackSampler, ``pstats`` records
+    every call with cProfile, exact but slowing the request down.
+
+    :param mode: 'collapsed' or 'pstats'
+    :type mode: str
+    :param interval: seconds between two samples in collapsed mode
+    :type interval: float
+    """
+
+    def __init__(self, mode='collapsed', interval=0.002):
+        if mode not in MODES:
+            raise ValueError(f'unknown profile mode {mode}, use one of {", ".join(MODES)}')
+        self.mode = mode
+        self.interval = interval
+        self.started_at = None
+        self.seconds = None
+        self._profiler = None
+
+    def start(self):
+        self.started_at = time.perf_counter()
+        if self.mode == 'collapsed':
+            self._profiler = StackSampler(threading.get_ident(), interval=self.interval)
+            self._profiler.start()
+        else:
+            # cProfile is imported on first use, most requests are not profiled
+            import cProfile
+
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        return self
+
+    def stop(self):
+        """
+        stop ends the profile
+
+        :return: the profile in the format of its mode
+        :rtype: bytes
+        """
+        if self.mode == 'collapsed':
+            self._profiler.stop()
+            output = self._profiler.collapsed().encode('utf-8')
+        else:
+            self._profiler.disable()
+            import pstats
+
+            stats = pstats.Stats(self._profiler)
+            # the format of pstats.Stats.dump_stats, read it with pstats.Stats(path)
+            output = marshal.dumps(stats.stats)
+        self.seconds = time.perf_counter() - self.started_at
+        return output
+
+
+class ProfileStore(object):
+    """
+    ProfileStore keeps the last ``max_files`` profiles in a local directory.
+
+    :param directory: directory of the profiles, created if missing
+    :type directory: str
+    :param max_files: profiles kept, the oldest are deleted first
+    :type max_files: int
+    """
+
+    def __init__(self, directory=None, max_files=100):
+        if directory is None:
+            directory = os.path.join(private_dir(), 'profiles')
+        self.directory = directory
+        self.max_files = max_files
+        self.written = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def write(self, label, mode, data):
+        """
+        write saves a profile
+
+        :param label: what was profiled, e.g., the endpoint and duration
+        :type label: str
+        :return: name of the profile file
+        :rtype: str
+        """
+        label = re.sub(r'[^\w.-]+', '_', label)[:80]
+        with self._lock:
+            name = f'{time.strftime("%Y%m%dT%H%M%S")}-{os.getpid()}-{self.written}-{label}.{mode}'
+            path = os.path.join(self.directory, name)
+            with open(f'{path}.tmp', 'wb') as fp:
+                fp.write(data)
+            os.replace(f'{path}.tmp', path)
+            self.written += 1
+            self._prune()
+        return name
+
+    def _prune(self):
+        names = self.list()
+        for name in names[self.max_files:]:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                # pruned by another worker
+                pass
+
+    def list(self):
+        """
+        list the names of the profiles, newest first
+
+        :rtype: list
+        """
+        entries = []
+        for entry in os.scandir(self.directory):
+            if _RE_NAME.match(entry.name):
+                try:
+                    entries.append((entry.stat().st_mtime, entry.name))
+                except FileNotFoundError:
+                    continue
+        return [name for _, name in sorted(entries, reverse=True)]
+
+    def path(self, name):
+        """
+        path of a profile, None unless it is one of the store
+
+        :rtype: str
+        """
+        if not _RE_NAME.match(name):
+            return None
+        path = os.path.join(self.directory, name)
+        return path if os.path.isfile(path) else None
@@ -0,0 +1,70 @@
+import threading
+import time
+
+
+class TokenBucket(object):
+    """
+    TokenBucket allows ``rate`` operations per second with bursts of up to ``capacity``.
+
+    :param rate: tokens added per second
+    :type rate: float
+    :param capacity: maximum number of tokens, defaults to rate
+    :type capacity: float
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(
+            self.capacity, self._tokens + (now - self._updated) * self.rate
+        )
+        self._updated = now
+
+    def try_acquire(self, tokens=1):
+        """
+        try_acquire takes tokens if they are available right now
+
+        :return: whether the tokens were taken
+        :rtype: bool
+        """
+        with self._lock:
+            self._refill()
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return True
+            return False
+
+    def wait_time(self, tokens=1):
+        """
+        wait_time is the number of seconds until tokens will be available
+        """
+        with self._lock:
+            self._refill()
+            return max(tokens - self._tokens, 0) / self.rate
+
+    def acquire(self, tokens=1, timeout=None):
+        """
+        acquire waits until tokens are available
+
+        :param timeout: maximum seconds to wait, waits forever by default
+        :type timeout: float
+        :return: whether the tokens were taken before the timeout
+        :rtype: bool
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if self.try_acquire(tokens):
+                return True
+            wait = self.wait_time(tokens)
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                wait = min(wait, remaining)
+            time.sleep(wait)
@@ -0,0 +1,271 @@
+import bisect
+import heapq
+import re
+import unicodedata
+from collections import defaultdict
+
+# fuzzywuzzy and Levenshtein take tens of milliseconds to import, they are
+# imported by the first search instead of when the app starts, see _import_fuzz
+fuzz = None
+utils = None
+_ratio = None
+
+_RE_STREET = re.compile(r'(strasse|straße|str\.)')
+_RE_UMLAUT_DIGRAPH = re.compile(r'([aou])e')
+_RE_NON_ALNUM = re.compile(r'[^a-z0-9]+')
+
+
+def _import_fuzz():
+    global fuzz, utils, _ratio
+    if fuzz is not None:
+        return
+
+    from fuzzywuzzy import fuzz as _fuzz, utils as _utils
+    try:
+        from Levenshtein import ratio
+    except ImportError:
+        # fuzzywuzzy falls back to difflib as well
+        def ratio(s1, s2):
+            return _fuzz.SequenceMatcher(None, s1, s2).ratio()
+
+    utils, _ratio = _utils, ratio
+    fuzz = _fuzz
+
+
+def normalize(text):
+    """
+    normalize folds a station name or query into the form used for the index
+
+    >>> normalize('Aachener Str./Gürtel')
+    'aachener str gurtel'
+    >>> normalize('Aachener Strasse  Guertel')
+    'aachener str gurtel'
+
+    :param text: station name or query
+    :type text: str
+    :return: lower case, ascii-only, space separated tokens
+    :rtype: str
+    """
+    text = text.lower()
+    text = _RE_STREET.sub('str ', text)
+    text = text.replace('ß', 'ss')
+    text = unicodedata.normalize('NFKD', text)
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    text = _RE_UMLAUT_DIGRAPH.sub(r'\1', text)
+    text = _RE_NON_ALNUM.sub(' ', text)
+
+    return ' '.join(text.split())
+
+
+def ngrams(text, n=3):
+    """
+    ngrams returns the set of padded character n-grams of every token
+
+    >>> sorted(ngrams('dom'))
+    [' do', 'dom', 'om ']
+    """
+    grams = set()
+    for token in text.split():
+        token = f' {token} '
+        for i in range(len(token) - n + 1):
+            grams.add(token[i:i + n])
+
+    return grams
+
+
+class StationIndex(object):
+    """
+    StationIndex ranks stations exactly like ``fuzz.token_set_ratio`` over all
+    stations, without scoring all of them.
+
+    A trigram inverted index shortlists the likely best stations first. Their
+    scores set the bar for the remaining stations: a station that shares no
+    token with the query scores at most ``200 * min(l1, l2) / (l1 + l2)`` for
+    the lengths of the two token strings, so only stations whose length can
+    still reach the bar are scored.
+
+    :param stations: mapping of station names to station ids
+    :type stations: dict
+    :param shortlist: number of trigram candidates scored first
+    :type shortlist: int
+    """
+
+    def __init__(self, stations, shortlist=32):
+        self.shortlist = shortlist
+        self.names = list(stations)
+        self.ids = [stations[name] for name in self.names]
+
+        _import_fuzz()
+        # the fields below mirror the preprocessing of fuzz.token_set_ratio
+        self.processed = [
+            utils.full_process(name, force_ascii=True) for name in self.names
+        ]
+        self.tokens = [set(p.split()) for p in self.processed]
+        self.joined = [' '.join(sorted(tokens)) for tokens in self.tokens]
+        self.by_length = sorted(
+            range(len(self.names)), key=lambda k: len(self.joined[k])
+        )
+        self.lengths = [len(self.joined[k]) for k in self.by_length]
+
+        token_postings = defaultdict(list)
+        gram_postings = defaultdict(list)
+        for position, name in enumerate(self.names):
+            for token in self.tokens[position]:
+                token_postings[token].append(position)
+            for gram in ngrams(normalize(name)):
+                gram_postings[gram].append(position)
+        self.token_postings = dict(token_postings)
+        self.gram_postings = dict(gram_postings)
+
+    def __len__(self):
+        return len(self.names)
+
+    def candidates(self, query):
+        """
+        candidates returns the positions of the stations sharing the most trigrams with query
+        """
+        counts = defaultdict(int)
+        for gram in ngrams(normalize(query)):
+            for position in self.gram_postings.get(gram, ()):
+                counts[position] += 1
+
+        best = heapq.nlargest(
+            self.shortlist, counts.items(), key=lambda k: (k[1], -k[0])
+        )
+
+        return [position for position, _ in best]
+
+    def search(self, query, k=1):
+        """
+        search finds the k best matching stations of query
+
+        :param query: input station name to be searched
+        :type query: str
+        :param k: number of results
+        :type k: int
+        :return: best matches with station name, score and id
+        :rtype: list
+        """
+        _import_fuzz()
+        processed = utils.full_process(query, force_ascii=True)
+        tokens = set(processed.split())
+
+        if not tokens:
+            # token_set_ratio scores every station 0
+            top = [(0, -position) for position in range(min(k, len(self.names)))]
+        else:
+            top = self._top(processed, tokens, k)
+
+        return [
+            {
+                'station': self.names[-neg_position],
+                'score': score,
+                'station_id': self.ids[-neg_position]
+            }
+            for score, neg_position in top
+        ]
+
+    def _top(self, processed, tokens, k):
+        joined = ' '.join(sorted(tokens))
+
+        # stations sharing a token are always scored with the full scorer
+        seeds = set(self.candidates(processed))
+        for token in tokens:
+            seeds.update(self.token_postings.get(token, ()))
+
+        # ties are broken by position to keep the order of the station map
+        scored = [
+            (self._score(processed, tokens, joined, position), -position)
+            for position in seeds
+        ]
+        top = heapq.nlargest(k, scored)
+
+        bar = top[-1][0] - 1 if len(top) == k else 0
+        if bar > 0:
+            size = len(joined)
+            start = bisect.bisect_left(self.lengths, bar * size / (200 - bar))
+            stop = bisect.bisect_right(self.lengths, size * (200 - bar) / bar)
+        else:
+            start, stop = 0, len(self.lengths)
+
+        for position in self.by_length[start:stop]:
+            if position not in seeds:
+                scored.append(
+                    (self._score(processed, tokens, joined, position), -position)
+                )
+
+        return heapq.nlargest(k, scored)
+
+    def _score(self, processed, tokens, joined, position):
+        if not self.tokens[position]:
+            return 0
+        if tokens & self.tokens[position]:
+            return fuzz.token_set_ratio(
+                processed, self.processed[position], full_process=False
+            )
+        # without common tokens token_set_ratio reduces to the ratio of the
+        # sorted token strings
+        return utils.intr(100 * _ratio(joined, self.joined[position]))
+
+
+def linear_search(stations, st):
+    """
+    linear_search scores every station, it is the reference the index is checked against
+    """
+    _import_fuzz()
+    res = [
+        {'station': key, 'score': fuzz.token_set_ratio(st, key), 'station_id': val}
+        for key, val in stations.items()
+    ]
+    res = sorted(res, key=lambda k: k['score'], reverse=True)
+
+    return res[0] if res else {}
+
+
+# queries users actually send, the index has to rank them like linear_search
+GOLDEN_QUERIES = [
+    'dom', 'dom/hbf', 'hbf', 'neumarkt', 'dreh', 'drehbrucke', 'drehbrücke',
+    'barbarossaplatz', 'barbarossa', 'rudolfplatz', 'friesenplatz',
+    'ebertplatz', 'chlodwigplatz', 'heumarkt', 'poststr', 'appellhofplatz',
+    'zülpicher platz', 'zulpicher', 'universitat', 'universität', 'deutz',
+    'deutz/messe', 'kalk post', 'mulheim', 'wiener platz', 'ehrenfeld',
+    'aachener str', 'aachener strasse gürtel', 'lindenthal', 'sulz',
+    'bayenthal', 'sudfriedhof', 'weiden west', 'königsforst', 'bensberg',
+    'porz', 'chorweiler', 'nippes', 'severinstr', 'ubierring',
+]
+
+
+if __name__ == "__main__":
+    import json
+    import os
+    import time
+
+    __location__ = os.path.realpath(
+        os.path.join(os.getcwd(), os.path.dirname(__file__))
+    )
+    with open(os.path.join(__location__, 'stations.json'), 'r') as fp:
+        stations = json.load(fp)
+
+    index = StationIndex(stations)
+    mismatches = 0
+    for query in GOLDEN_QUERIES:
+        expected = linear_search(stations, query)
+        got = index.search(query)[0]
+        if (got['station'], got['score']) != (expected['station'], expected['score']):
+            mismatches += 1
+            print(f'MISMATCH {query!r}: index {got} linear {expected}')
+
+    runs = 20
+    start = time.perf_counter()
+    for _ in range(runs):
+        for query in GOLDEN_QUERIES:
+            index.search(query)
+    index_ms = (time.perf_counter() - start) * 1000 / (runs * len(GOLDEN_QUERIES))
+
+    start = time.perf_counter()
+    for query in GOLDEN_QUERIES:
+        linear_search(stations, query)
+    linear_ms = (time.perf_counter() - start) * 1000 / len(GOLDEN_QUERIES)
+
+    print(f'{len(GOLDEN_QUERIES)} golden queries, {mismatches} mismatches')
+    print(f'index: {index_ms:.3f} ms/query, linear: {linear_ms:.3f} ms/query')
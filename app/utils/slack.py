@@ -0,0 +1,166 @@
+import hashlib
+import hmac
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+logging.basicConfig()
+logger = logging.getLogger('slack')
+
+
+# slack posts the replies of slash commands to response urls on these hosts
+SLACK_RESPONSE_HOSTS = ('hooks.slack.com',)
+
+
+def verify_signature(secret, timestamp, body, signature, max_age=300, now=None):
+    """
+    verify_signature checks the X-Slack-Signature of a request with the signing secret of the slack app
+
+    :param secret: signing secret of the slack app
+    :type secret: str
+    :param timestamp: X-Slack-Request-Timestamp of the request
+    :type timestamp: str
+    :param body: raw body of the request
+    :type body: bytes
+    :param signature: X-Slack-Signature of the request
+    :type signature: str
+    :param max_age: seconds a request is accepted after it was signed, older ones may be replayed
+    :type max_age: float
+    :rtype: bool
+    """
+    if not timestamp or not signature:
+        return False
+    try:
+        signed_at = int(timestamp)
+    except ValueError:
+        return False
+    if now is None:
+        now = time.time()
+    if abs(now - signed_at) > max_age:
+        return False
+    base = b'v0:' + timestamp.encode('utf-8') + b':' + body
+    expected = 'v0=' + hmac.new(secret.encode('utf-8'), base, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature)
+
+
+def response_host(url):
+    """
+    response_host is the scheme and host of a response url, what of it may be logged
+    """
+    parsed = urlparse(url or '')
+    return f'{parsed.scheme}://{parsed.hostname}'
+
+
+def allowed_response_url(url, hosts=SLACK_RESPONSE_HOSTS):
+    """
+    allowed_response_url checks that a response url points to slack, replies are posted nowhere else
+
+    :param hosts: hosts replies may be posted to
+    :type hosts: tuple
+    :rtype: bool
+    """
+    try:
+        parsed = urlparse(url or '')
+    except ValueError:
+        return False
+    if parsed.hostname not in hosts or parsed.username or parsed.password:
+        return False
+    if parsed.scheme == 'https':
+        return True
+    # slack is reached over https only, hosts added for a stand-in may use http
+    return parsed.scheme == 'http' and parsed.hostname not in SLACK_RESPONSE_HOSTS
+
+
+class DeferredResponder(object):
+    """
+    DeferredResponder builds slack replies in the background and posts them to
+    the response_url of the slash command.
+
+    Slack gives up on a slash command after 3 seconds, so the command is
+    acknowledged right away and the reply is built on a bounded pool.
+
+    :param post: callable posting a json payload to a url
+    :param max_workers: threads building replies
+    :type max_workers: int
+    :param max_queue: replies queued or running at most, further commands are rejected
+    :type max_queue: int
+    :param deadline: seconds a reply may take from the command to being posted
+    :type deadline: float
+    """
+
+    def __init__(self, post, max_workers=4, max_queue=50, deadline=25):
+        self.post = post
+        self.max_queue = max_queue
+        self.deadline = deadline
+        self.submitted = 0
+        self.rejected = 0
+        self.expired = 0
+        self.failed = 0
+        self.posted = 0
+
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='slack-reply'
+        )
+
+    @property
+    def pending(self):
+        return self._pending
+
+    def submit(self, build, response_url, error_payload=None):
+        """
+        submit queues a reply
+
+        :param build: callable without arguments returning the slack payload
+        :param response_url: response_url of the slash command
+        :type response_url: str
+        :param error_payload: payload posted when the reply fails or misses the deadline
+        :type error_payload: dict
+        :return: False if the queue is full and the reply was not queued
+        :rtype: bool
+        """
+        with self._lock:
+            if self._pending >= self.max_queue:
+                self.rejected += 1
+                return False
+            self._pending += 1
+            self.submitted += 1
+
+        self._executor.submit(
+            self._run, build, response_url, error_payload, time.monotonic() + self.deadline
+        )
+        return True
+
+    def _run(self, build, response_url, error_payload, deadline):
+        try:
+            if time.monotonic() > deadline:
+                # waited in the queue for too long, slack has moved on
+                self.expired += 1
+                logger.warning(f'dropped slack reply to {response_host(response_url)}: deadline passed in queue')
+                return
+
+            try:
+                payload = build()
+            except Exception as e:
+                self.failed += 1
+                logger.error(f'could not build slack reply: {e}')
+                payload = error_payload
+
+            if time.monotonic() > deadline:
+                self.expired += 1
+                logger.warning(f'slack reply to {response_host(response_url)} missed its deadline')
+                payload = error_payload
+
+            if payload is not None:
+                self.post(response_url, payload)
+                self.posted += 1
+        except Exception as e:
+            self.failed += 1
+            # the message of the error may contain the url, and with it the token of the reply
+            logger.error(f'could not post slack reply to {response_host(response_url)}: {type(e).__name__}')
+        finally:
+            with self._lock:
+                self._pending -= 1
@@ -0,0 +1,349 @@
+import bisect
+import logging
+import sys
+import threading
+import time
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+
+logging.basicConfig()
+logger = logging.getLogger('snapshot')
+
+_MINUTES_PER_UNIT = {'min': 1, 'hour': 60, 'std': 60, 'h': 60}
+
+
+def departure_minutes(departure):
+    """
+    departure_minutes is the number of minutes until a parsed departure leaves, None if unknown
+    """
+    parsed = departure.get('parsed_time')
+    if not parsed:
+        return None
+    factor = _MINUTES_PER_UNIT.get(parsed.get('unit'))
+    if factor is None:
+        return None
+    return int(parsed['value']) * factor
+
+
+class _Strings(object):
+    """
+    _Strings dictionary-encodes a string column: every distinct value is kept once
+    """
+
+    def __init__(self):
+        self.values = []
+        self._codes = {}
+
+    def code(self, value):
+        code = self._codes.get(value)
+        if code is None:
+            code = self._codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+
+class DepartureSnapshot(object):
+    """
+    DepartureSnapshot holds the departures of the whole network in columns.
+
+    Rows are grouped by station: ``station_ids`` is sorted and the rows of
+    ``station_ids[k]`` are ``starts[k]:starts[k + 1]``. Line and terminal are
+    codes into the ``lines`` and ``terminals`` tables, minutes are relative to
+    the fetch time of the station. Compared to the lists of dicts returned by
+    fetch_departures this takes a few bytes per departure.
+
+    A snapshot is never modified once built, see SnapshotBuilder.
+    """
+
+    def __init__(self, station_ids, starts, fetched_at, line_codes, terminal_codes,
+                 minutes, lines, terminals, crawled_at, crawl_seconds=0.0, failed=0):
+        self.station_ids = station_ids
+        self.starts = starts
+        self.fetched_at = fetched_at
+        self.line_codes = line_codes
+        self.terminal_codes = terminal_codes
+        self.minutes = minutes
+        self.lines = lines
+        self.terminals = terminals
+        self.crawled_at = crawled_at
+        self.crawl_seconds = crawl_seconds
+        self.failed = failed
+
+    def __len__(self):
+        return len(self.minutes)
+
+    @property
+    def stations(self):
+        return len(self.station_ids)
+
+    def _rows(self, station_id):
+        k = bisect.bisect_left(self.station_ids, station_id)
+        if k == len(self.station_ids) or self.station_ids[k] != station_id:
+            return None
+        return k, range(self.starts[k], self.starts[k + 1])
+
+    def fetched(self, station_id):
+        """
+        fetched returns the departures of a station in the format of fetch_departures
+
+        :param station_id: id of the station
+        :type station_id: int
+        :return: fetch timestamp and departures, None if the station was not crawled
+        :rtype: dict
+        """
+        found = self._rows(station_id)
+        if found is None:
+            return None
+        k, rows = found
+        return {
+            'fetched_at': self.fetched_at[k],
+            'departures': [
+                {
+                    'line': self.lines[self.line_codes[i]],
+                    'terminal': self.terminals[self.terminal_codes[i]],
+                    'departures_in': f'{self.minutes[i]} min',
+                    'parsed_time': {'value': self.minutes[i], 'unit': 'min'},
+                }
+                for i in rows
+            ]
+        }
+
+    def departing_within(self, minutes, now=None, line=None):
+        """
+        departing_within lists the departures of the network leaving in the next minutes
+
+        :param minutes: size of the window in minutes
+        :type minutes: int
+        :param now: unix timestamp the window starts at, defaults to now
+        :type now: float
+        :param line: only departures of this line
+        :type line: str
+        :return: station id, line, terminal and minutes from now, soonest first
+        :rtype: list
+        """
+        if now is None:
+            now = time.time()
+
+        line_code = None
+        if line is not None:
+            try:
+                line_code = self.lines.index(line)
+            except ValueError:
+                return []
+
+        rows = []
+        for k, station_id in enumerate(self.station_ids):
+            elapsed = int(max(now - self.fetched_at[k], 0) // 60)
+            for i in range(self.starts[k], self.starts[k + 1]):
+                if line_code is not None and self.line_codes[i] != line_code:
+                    continue
+                left = self.minutes[i] - elapsed
+                if 0 <= left <= minutes:
+                    rows.append((left, station_id, i))
+
+        rows.sort()
+        return [
+            {
+                'station_id': station_id,
+                'line': self.lines[self.line_codes[i]],
+                'terminal': self.terminals[self.terminal_codes[i]],
+                'minutes': left,
+            }
+            for left, station_id, i in rows
+        ]
+
+    def memory_bytes(self):
+        """
+        memory_bytes is the size of the columns and string tables
+        """
+        columns = (
+            self.station_ids, self.starts, self.fetched_at,
+            self.line_codes, self.terminal_codes, self.minutes
+        )
+        size = sum(sys.getsizeof(column) for column in columns)
+        for table in (self.lines, self.terminals):
+            size += sys.getsizeof(table) + sum(sys.getsizeof(value) for value in table)
+        return size
+
+    def statistics(self):
+        return {
+            'crawled_at': self.crawled_at,
+            'crawl_seconds': self.crawl_seconds,
+            'stations': self.stations,
+            'failed': self.failed,
+            'departures': len(self),
+            'memory_bytes': self.memory_bytes(),
+        }
+
+
+class SnapshotBuilder(object):
+    """
+    SnapshotBuilder collects the departures of stations into the columns of a DepartureSnapshot
+    """
+
+    def __init__(self):
+        self._stations = {}
+
+    def add(self, station_id, fetched):
+        """
+        add records the result of fetch_departures for a station
+        """
+        self._stations[int(station_id)] = fetched
+
+    def build(self, crawl_seconds=0.0, failed=0):
+        lines = _Strings()
+        terminals = _Strings()
+        station_ids = array('i')
+        starts = array('I', [0])
+        fetched_at = array('d')
+        line_codes = array('H')
+        terminal_codes = array('H')
+        minutes = array('H')
+
+        for station_id in sorted(self._stations):
+            fetched = self._stations[station_id]
+            for departure in fetched['departures']:
+                left = departure_minutes(departure)
+                if left is None:
+                    # header rows and rows whose time could not be parsed
+                    continue
+                line_codes.append(lines.code(departure.get('line', '')))
+                terminal_codes.append(terminals.code(departure.get('terminal', '')))
+                minutes.append(left)
+            station_ids.append(station_id)
+            starts.append(len(minutes))
+            fetched_at.append(fetched['fetched_at'])
+
+        return DepartureSnapshot(
+            station_ids, starts, fetched_at, line_codes, terminal_codes, minutes,
+            lines.values, terminals.values, crawled_at=time.time(),
+            crawl_seconds=crawl_seconds, failed=failed
+        )
+
+
+class NetworkCrawler(object):
+    """
+    NetworkCrawler sweeps the departures of every station into a DepartureSnapshot.
+
+    Stations are fetched by ``concurrency`` threads, each fetch takes a token
+    of ``limiter`` first so the whole sweep stays under its rate towards
+    kvb.koeln. The finished snapshot replaces ``snapshot`` with a single
+    assignment, readers keep the one they hold.
+
+    With a shared cache backend only the worker holding the crawl lock
+    sweeps, the others pick its snapshot up from the backend.
+
+    :param fetch: callable returning the fetch_departures result of a station id
+    :param stations: callable returning the station ids to crawl
+    :param limiter: rate limiter of the sweep
+    :type limiter: utils.ratelimit.TokenBucket
+    :param concurrency: stations fetched at the same time
+    :type concurrency: int
+    :param interval: seconds between the starts of two sweeps
+    :type interval: float
+    :param backend: cache backend the snapshot is shared through
+    :param key: key of the snapshot in the backend
+    :type key: str
+    """
+
+    def __init__(self, fetch, stations, limiter, concurrency=8, interval=300,
+                 backend=None, key='snapshot:network'):
+        self.fetch = fetch
+        self.stations = stations
+        self.limiter = limiter
+        self.concurrency = concurrency
+        self.interval = interval
+        self.backend = backend
+        self.key = key
+        self.snapshot = None
+        self.crawls = 0
+        self.failed = 0
+
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _fetch(self, station_id):
+        self.limiter.acquire()
+        return self.fetch(station_id)
+
+    def crawl(self):
+        """
+        crawl fetches all stations and swaps the new snapshot in
+
+        :rtype: DepartureSnapshot
+        """
+        start = time.perf_counter()
+        station_ids = sorted(set(self.stations()))
+        builder = SnapshotBuilder()
+        failed = 0
+
+        with ThreadPoolExecutor(
+            max_workers=self.concurrency, thread_name_prefix='kvb-crawl'
+        ) as executor:
+            futures = [
+                (station_id, executor.submit(self._fetch, station_id))
+                for station_id in station_ids
+            ]
+            for station_id, future in futures:
+                if self._stop.is_set():
+                    future.cancel()
+                    continue
+                try:
+                    builder.add(station_id, future.result())
+                except Exception as e:
+                    failed += 1
+                    logger.debug(f'could not crawl station {station_id}: {e}')
+
+        snapshot = builder.build(
+            crawl_seconds=time.perf_counter() - start, failed=failed
+        )
+        self.snapshot = snapshot
+        self.crawls += 1
+        self.failed += failed
+        logger.info(
+            f'crawled {snapshot.stations} stations in {snapshot.crawl_seconds:.1f}s, '
+            f'{len(snapshot)} departures in {snapshot.memory_bytes()} bytes, {failed} failed'
+        )
+        return snapshot
+
+    def run_once(self):
+        """
+        run_once crawls, or takes the snapshot another worker crawled
+
+        :rtype: DepartureSnapshot
+        """
+        if self.backend is None:
+            return self.crawl()
+
+        if self.backend.add(f'{self.key}:lock', time.time(), self.interval):
+            snapshot = self.crawl()
+            self.backend.set(self.key, snapshot, self.interval * 3)
+            return snapshot
+
+        shared = self.backend.get(self.key)
+        if shared is not None and (
+            self.snapshot is None or shared.crawled_at > self.snapshot.crawled_at
+        ):
+            self.snapshot = shared
+        return self.snapshot
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.warning(f'could not crawl the network: {e}')
+            self._stop.wait(self.interval)
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name='kvb-crawler', daemon=True
+        )
+        self._thread.start()
+        logger.info(f'crawling the network every {self.interval}s')
+
+    def stop(self):
+        self._stop.set()
@@ -1,51 +1,400 @@
+import hashlib
 import json
+import logging
 import os
+import pickle
 import re
+import threading
+import time
 
-import requests
-from bs4 import BeautifulSoup
+try:
+    from utils.fetch import get_client as _get_client
+    from utils.fetch import random_user_agent
+    from utils.payload import Payload
+    from utils.search import StationIndex
+except ImportError:
+    # when run as a script from within utils
+    from fetch import get_client as _get_client
+    from fetch import random_user_agent
+    from payload import Payload
+    from search import StationIndex
 
-from fetch import random_user_agent as _random_user_agent
+logging.basicConfig()
+logger = logging.getLogger('stations')
+# swaps of the station map are worth seeing in the logs
+logger.setLevel(logging.INFO)
 
 __cwd__ = os.getcwd()
 __location__ = os.path.realpath(
     os.path.join(__cwd__, os.path.dirname(__file__))
 )
 
-with open(os.path.join(__location__, 'stations.json'), 'r') as fp:
-    _MANUAL_STATIONS = json.load(fp)
+_STATIONS_PATH = os.path.join(__location__, 'stations.json')
+_OVERRIDES_PATH = os.path.join(__location__, 'stations_overrides.json')
+# prebuilt StationMap, written by `python -m utils.stations build` when the app is built
+_STATION_MAP_PATH = os.path.join(__location__, 'stations.idx')
+# bump when StationMap, StationIndex or Payload change their attributes
+_STATION_MAP_FORMAT = b'1'
 
-def get_stations():
+_RE_STATION_URL = re.compile(r'haltestellen/overview/(?P<station_id>\d+)/')
+
+
+def overview_url():
+    base_url = os.environ.get('KVB_BASE_URL', 'https://www.kvb.koeln').rstrip('/')
+    return f"{base_url}/haltestellen/overview/"
+
+
+def parse_stations(html):
+    """
+    parse_stations extracts the stations linked from the kvb overview page
+
+    Names are lower cased and ids are ints, as in stations.json.
+
+    :param html: html of the overview page
+    :type html: str
+    :return: dictionary of station names and ids
+    :rtype: dict
+    """
+    from bs4 import BeautifulSoup, SoupStrainer
+
+    soup = BeautifulSoup(html, 'lxml', parse_only=SoupStrainer('a', href=_RE_STATION_URL))
+
+    stations = {}
+    for a in soup.find_all('a'):
+        station_id = _RE_STATION_URL.search(a['href'])
+        station_name = a.get_text().strip().lower()
+        if station_id and station_name:
+            stations[station_name] = int(station_id.group('station_id'))
+
+    return stations
+
+
+def get_stations(admit=None):
     """
     get_stations retrieve a list of stations in cologne
 
+    :param admit: callable blocking until kvb.koeln may be requested, see utils.admission
     :return: dictionary of stations with names and id
     :rtype: dict
     """
-    re_parse_url = re.compile(r'haltestellen/overview/(?P<station_id>.*?)/')
-    url = "https://www.kvb.koeln/haltestellen/overview/"
-    req = requests.get(url, headers=_random_user_agent())
-    soup = BeautifulSoup(req.text, 'lxml')
-    soup_a = soup.find_all('a')
-    soup_a = [i for i in soup_a if 'haltestellen/overview/' in i['href']]
+    if admit is not None:
+        admit()
+    req = _get_client().get(overview_url())
+    return parse_stations(req.text)
 
-    stations = {}
 
-    for a in soup_a:
-        href = a['href']
-        station_id = re_parse_url.findall(href)
-        station_name = a.text
-        if station_id:
-            station_id = station_id[0]
-            stations[station_name] =  station_id
+def _overrides_path(path=None):
+    if path is None:
+        path = os.environ.get('KVB_STATIONS_OVERRIDES', _OVERRIDES_PATH)
+    return path
 
-    return stations
 
+def load_overrides(path=None):
+    """
+    load_overrides reads the manual corrections of the scraped station map
 
+    A name mapped to an id adds or replaces the station, a name mapped to
+    null removes it.
 
+    :param path: json file of the overrides, defaults to KVB_STATIONS_OVERRIDES or stations_overrides.json
+    :type path: str
+    :rtype: dict
+    """
+    path = _overrides_path(path)
+    if not os.path.isfile(path):
+        return {}
+    with open(path, 'r') as fp:
+        return json.load(fp)
+
+
+def merge_stations(scraped, overrides):
+    """
+    merge_stations applies the manual overrides to a scraped station map
+
+    :rtype: dict
+    """
+    stations = dict(scraped)
+    for name, station_id in overrides.items():
+        if station_id is None:
+            stations.pop(name, None)
+        else:
+            stations[name] = station_id
+    return dict(sorted(stations.items()))
+
+
+def diff_stations(old, new):
+    """
+    diff_stations lists the stations added, removed and renumbered between two maps
+
+    :return: added names, removed names and names whose id changed
+    :rtype: tuple
+    """
+    added = sorted(set(new) - set(old))
+    removed = sorted(set(old) - set(new))
+    changed = sorted(k for k in set(old) & set(new) if old[k] != new[k])
+    return added, removed, changed
+
+
+class StationMap(object):
+    """
+    StationMap is a station map with every structure derived from it.
+
+    It is never modified after it was built: a new map is built next to the
+    one in use and swapped in with a single assignment, so readers holding a
+    reference always see a consistent set of names, ids, index and payload.
+
+    :param stations: dictionary of station names and ids
+    :type stations: dict
+    :param source: where the map comes from, for the logs
+    :type source: str
+    """
+
+    def __init__(self, stations, source=''):
+        self.stations = stations
+        self.inverse = {value: key for key, value in stations.items()}
+        self.index = StationIndex(stations)
+        # /station/ is served from this body, compressed once here
+        self.payload = Payload.from_json(stations, precompress=True)
+        self.source = source
+        self.loaded_at = time.time()
+
+    def __len__(self):
+        return len(self.stations)
+
+
+def _source_digest(stations_path, overrides_path):
+    digest = hashlib.blake2b(_STATION_MAP_FORMAT, digest_size=16)
+    for path in (stations_path, overrides_path):
+        if os.path.isfile(path):
+            with open(path, 'rb') as fp:
+                digest.update(fp.read())
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def build_station_map(stations_path=_STATIONS_PATH, overrides_path=None):
+    """
+    build_station_map builds the station map of stations.json and the manual overrides
+
+    :rtype: StationMap
+    """
+    with open(stations_path, 'r') as fp:
+        stations = json.load(fp)
+    return StationMap(
+        merge_stations(stations, load_overrides(overrides_path)), source=stations_path
+    )
+
+
+def write_station_map(path=_STATION_MAP_PATH, stations_path=_STATIONS_PATH, overrides_path=None):
+    """
+    write_station_map prebuilds the station map into a file loaded by load_station_map
+
+    The file is tagged with a digest of its sources, a file built from other
+    sources is ignored.
+
+    :return: the station map written
+    :rtype: StationMap
+    """
+    overrides_path = _overrides_path(overrides_path)
+    station_map = build_station_map(stations_path, overrides_path)
+    artifact = {
+        'digest': _source_digest(stations_path, overrides_path),
+        'station_map': station_map,
+    }
+    # written next to the target and renamed, workers never read half a file
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as fp:
+        pickle.dump(artifact, fp, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+    return station_map
+
+
+def load_station_map(path=_STATION_MAP_PATH, stations_path=_STATIONS_PATH, overrides_path=None):
+    """
+    load_station_map loads the prebuilt station map, or builds it if it is missing or outdated
+
+    Unpickling the prebuilt map takes a few milliseconds where building the
+    search index and compressing the station list takes tens.
+
+    :param path: prebuilt station map
+    :type path: str
+    :param stations_path: json file of station names and ids
+    :type stations_path: str
+    :rtype: StationMap
+    """
+    overrides_path = _overrides_path(overrides_path)
+    try:
+        with open(path, 'rb') as fp:
+            artifact = pickle.load(fp)
+        if artifact['digest'] == _source_digest(stations_path, overrides_path):
+            station_map = artifact['station_map']
+            station_map.loaded_at = time.time()
+            return station_map
+        logger.warning(f'prebuilt station map {path} is outdated, building it')
+    except FileNotFoundError:
+        logger.warning(
+            f'no prebuilt station map at {path}, building it. '
+            'Run `python -m utils.stations build` from app/ when building the app'
+        )
+    except Exception as e:
+        logger.warning(f'could not load the prebuilt station map {path}: {e}')
+
+    return build_station_map(stations_path, overrides_path)
+
+
+class StationRefresher(object):
+    """
+    StationRefresher keeps the station map in line with the kvb overview page.
+
+    Every ``interval`` seconds the overview page is requested with the
+    validators of the last response, so an unchanged page costs a 304. A
+    changed page is parsed, merged with the manual overrides and compared to
+    the current map. If stations were added, removed or renumbered a new
+    StationMap is built on the refresher thread and handed to ``swap``.
+
+    A scrape that lost more than ``max_removed`` of the stations is rejected,
+    it is more likely a change of the page layout than of the network.
+
+    :param current: callable returning the StationMap in use
+    :param swap: callable installing a new StationMap
+    :param interval: seconds between two checks
+    :type interval: float
+    :param max_removed: largest fraction of the stations a refresh may remove
+    :type max_removed: float
+    :param admit: callable blocking until kvb.koeln may be requested, see utils.admission
+    """
+
+    def __init__(self, current, swap, interval=21600, max_removed=0.2, admit=None):
+        self.current = current
+        self.swap = swap
+        self.interval = interval
+        self.max_removed = max_removed
+        self.admit = admit
+        self.checks = 0
+        self.not_modified = 0
+        self.swaps = 0
+        self.failed = 0
+
+        self._etag = None
+        self._last_modified = None
+        self._scraped = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def fetch(self):
+        """
+        fetch downloads the overview page unless it is unchanged since the last fetch
+
+        :return: scraped stations, None if the page is not modified
+        :rtype: dict
+        """
+        headers = random_user_agent()
+        if self._etag:
+            headers['If-None-Match'] = self._etag
+        if self._last_modified:
+            headers['If-Modified-Since'] = self._last_modified
+
+        if self.admit is not None:
+            self.admit()
+        client = _get_client()
+        page = client.get(overview_url(), headers=headers)
+        if page.status_code == 304:
+            return None
+        page.raise_for_status()
+
+        stations = parse_stations(page.text)
+        if not stations:
+            raise Exception('no station found on the overview page')
+        # validators are kept only once the page could be parsed
+        self._etag = page.headers.get('ETag')
+        self._last_modified = page.headers.get('Last-Modified')
+        self._scraped = stations
+        return stations
+
+    def run_once(self):
+        """
+        run_once checks the overview page and swaps the station map if it changed
+
+        :return: True if a new map was swapped in
+        :rtype: bool
+        """
+        self.checks += 1
+        try:
+            scraped = self.fetch()
+        except Exception as e:
+            self.failed += 1
+            logger.warning(f'could not refresh the station map: {e}')
+            return False
+        if scraped is None:
+            self.not_modified += 1
+            logger.debug('station overview not modified')
+            # the overrides may have been edited in the meantime
+            scraped = self._scraped
+            if scraped is None:
+                return False
+
+        current = self.current()
+        stations = merge_stations(scraped, load_overrides())
+        added, removed, changed = diff_stations(current.stations, stations)
+        if not (added or removed or changed):
+            logger.debug('station map unchanged')
+            return False
+
+        if len(removed) > self.max_removed * len(current):
+            self.failed += 1
+            logger.error(
+                f'rejected station map refresh removing {len(removed)} of {len(current)} stations'
+            )
+            return False
+
+        self.swap(StationMap(stations, source=overview_url()))
+        self.swaps += 1
+        logger.info(
+            f'swapped station map: {len(current)} -> {len(stations)} stations, '
+            f'added {added}, removed {removed}, renumbered {changed}'
+        )
+        return True
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.run_once()
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name='kvb-stations', daemon=True
+        )
+        self._thread.start()
+        logger.info(f'refreshing the station map every {self.interval}s')
+
+    def stop(self):
+        self._stop.set()
 
 
 if __name__ == "__main__":
-    print(_MANUAL_STATIONS)
-    print(get_stations())
-    print('END OF GAME')
+    import sys
+
+    if sys.argv[1:] == ['build']:
+        # pickled through the module of the app, objects defined in __main__
+        # could not be unpickled by it
+        from utils.stations import write_station_map
+
+        start = time.perf_counter()
+        station_map = write_station_map()
+        print(
+            f'wrote {len(station_map)} stations to {_STATION_MAP_PATH} '
+            f'in {time.perf_counter() - start:.3f}s'
+        )
+        sys.exit(0)
+
+    with open(_STATIONS_PATH, 'r') as fp:
+        _MANUAL_STATIONS = json.load(fp)
+
+    stations = get_stations()
+    added, removed, changed = diff_stations(_MANUAL_STATIONS, stations)
+    print(f'{len(stations)} stations on kvb.koeln, {len(_MANUAL_STATIONS)} in stations.json')
+    print(f'added: {added}')
+    print(f'removed: {removed}')
+    print(f'renumbered: {changed}')
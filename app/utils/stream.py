@@ -0,0 +1,313 @@
+import json
+import logging
+import threading
+import time
+from collections import deque
+
+logging.basicConfig()
+logger = logging.getLogger('stream')
+
+
+def row_key(departure):
+    """
+    row_key identifies a departure across polls, departures_in changes every minute but departures_at does not
+    """
+    return (departure.get('line'), departure.get('terminal'), departure.get('departures_at'))
+
+
+def diff_rows(old, new):
+    """
+    diff_rows compares two lists of departures
+
+    :return: departures only in new and departures only in old
+    :rtype: tuple
+    """
+    old_keys = {row_key(dep) for dep in old}
+    new_keys = {row_key(dep) for dep in new}
+    added = [dep for dep in new if row_key(dep) not in old_keys]
+    removed = [dep for dep in old if row_key(dep) not in new_keys]
+    return added, removed
+
+
+def format_event(event, data, event_id=None):
+    """
+    format_event encodes a message in the text/event-stream format
+    """
+    lines = []
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    lines.append(f'event: {event}')
+    lines.append(f'data: {json.dumps(data, separators=(",", ":"))}')
+    return '\n'.join(lines) + '\n\n'
+
+
+class Subscription(object):
+    """
+    Subscription is the queue of one streaming client.
+
+    Pollers never wait for a client: when a slow client lets ``max_queue``
+    messages pile up its queue is dropped and the client is resynchronized
+    with a full snapshot of its stations instead.
+
+    :param stations: station ids of the client
+    :type stations: list
+    :param max_queue: messages kept for the client at most
+    :type max_queue: int
+    """
+
+    def __init__(self, stations, max_queue=20):
+        self.stations = list(stations)
+        self.max_queue = max_queue
+        self.overflows = 0
+        self.resync = False
+        self.closed = False
+
+        self._queue = deque()
+        self._ready = threading.Condition()
+
+    def offer(self, event, data):
+        with self._ready:
+            if len(self._queue) >= self.max_queue:
+                self._queue.clear()
+                self.overflows += 1
+                self.resync = True
+            else:
+                self._queue.append((event, data))
+            self._ready.notify()
+
+    def get(self, timeout):
+        """
+        get waits for the next message
+
+        :return: event and data, None after the timeout or if the client has to be resynchronized
+        :rtype: tuple
+        """
+        with self._ready:
+            if not self._queue and not self.resync:
+                self._ready.wait(timeout)
+            if self.resync or not self._queue:
+                return None
+            return self._queue.popleft()
+
+    def take_resync(self):
+        """
+        take_resync tells whether the client has to be sent full snapshots, once
+        """
+        with self._ready:
+            resync, self.resync = self.resync, False
+            return resync
+
+
+class StationPoller(object):
+    """
+    StationPoller polls the departures of one station for all of its subscribers.
+
+    Every ``interval`` seconds the departures are taken from ``get``; the
+    first result is sent as a snapshot and later ones as the rows added and
+    removed since, nothing is sent while they do not change.
+
+    :param station_id: id of the station
+    :type station_id: int
+    :param get: callable returning the rendered departures of a station id
+    :param interval: seconds between two polls
+    :type interval: float
+    """
+
+    def __init__(self, station_id, get, interval=10):
+        self.station_id = station_id
+        self.get = get
+        self.interval = interval
+        self.last = None
+        self.polls = 0
+        self.failed = 0
+
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name=f'kvb-stream-{station_id}', daemon=True
+        )
+
+    def snapshot(self):
+        last = self.last
+        if last is None:
+            return None
+        return {
+            'station': self.station_id,
+            'fetched_at': last.get('fetched_at'),
+            'departures': last['departures'],
+        }
+
+    def add(self, subscription):
+        with self._lock:
+            self._subscribers.add(subscription)
+        snapshot = self.snapshot()
+        if snapshot is not None:
+            subscription.offer('snapshot', snapshot)
+
+    def remove(self, subscription):
+        """
+        remove drops a subscriber
+
+        :return: number of subscribers left
+        :rtype: int
+        """
+        with self._lock:
+            self._subscribers.discard(subscription)
+            return len(self._subscribers)
+
+    def publish(self, event, data):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscription in subscribers:
+            subscription.offer(event, data)
+
+    def poll(self):
+        departures = self.get(self.station_id)
+        self.polls += 1
+        if departures.get('status') != 200:
+            # keep the last departures, the clients keep counting down
+            return
+
+        last, self.last = self.last, departures
+        if last is None:
+            self.publish('snapshot', self.snapshot())
+            return
+
+        added, removed = diff_rows(last['departures'], departures['departures'])
+        if added or removed:
+            self.publish('diff', {
+                'station': self.station_id,
+                'fetched_at': departures.get('fetched_at'),
+                'added': added,
+                'removed': removed,
+            })
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.poll()
+            except Exception as e:
+                self.failed += 1
+                logger.warning(f'could not poll station {self.station_id}: {e}')
+            self._stop.wait(self.interval)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+
+class StreamHub(object):
+    """
+    StreamHub shares one StationPoller per station between all streaming clients of a worker.
+
+    A poller starts with the first subscriber of its station and stops with
+    the last one, so kvb.koeln is polled per station, not per client.
+
+    :param get: callable returning the rendered departures of a station id
+    :param interval: seconds between two polls of a station
+    :type interval: float
+    :param max_clients: streaming clients at most, further ones are refused
+    :type max_clients: int
+    :param max_queue: messages kept per client, see Subscription
+    :type max_queue: int
+    """
+
+    def __init__(self, get, interval=10, max_clients=50, max_queue=20):
+        self.get = get
+        self.interval = interval
+        self.max_clients = max_clients
+        self.max_queue = max_queue
+        self.clients = 0
+        self.refused = 0
+        self.messages = 0
+        self.overflows = 0
+
+        self._pollers = {}
+        self._lock = threading.Lock()
+
+    @property
+    def pollers(self):
+        return len(self._pollers)
+
+    def subscribe(self, stations):
+        """
+        subscribe registers a client for the departures of stations
+
+        :param stations: station ids
+        :type stations: list
+        :return: subscription of the client, None if there are too many clients already
+        :rtype: Subscription
+        """
+        subscription = Subscription(stations, max_queue=self.max_queue)
+        with self._lock:
+            if self.clients >= self.max_clients:
+                self.refused += 1
+                return None
+            self.clients += 1
+            for station_id in subscription.stations:
+                poller = self._pollers.get(station_id)
+                if poller is None:
+                    poller = self._pollers[station_id] = StationPoller(
+                        station_id, self.get, interval=self.interval
+                    )
+                    poller.start()
+                poller.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """
+        unsubscribe releases the slot and pollers of a client, once however often it is called
+        """
+        with self._lock:
+            if subscription.closed:
+                return
+            subscription.closed = True
+            self.clients -= 1
+            self.overflows += subscription.overflows
+            for station_id in subscription.stations:
+                poller = self._pollers.get(station_id)
+                if poller is not None and poller.remove(subscription) == 0:
+                    poller.stop()
+                    del self._pollers[station_id]
+
+    def snapshots(self, subscription):
+        with self._lock:
+            pollers = [self._pollers.get(station_id) for station_id in subscription.stations]
+        return [
+            snapshot for snapshot in (p.snapshot() for p in pollers if p is not None)
+            if snapshot is not None
+        ]
+
+    def stream(self, subscription, heartbeat=15, max_seconds=3600, retry=2):
+        """
+        stream yields the text/event-stream of a client until it disconnects
+
+        A comment is sent when nothing happened for ``heartbeat`` seconds, it
+        keeps proxies from closing the connection and notices clients that
+        left. After ``max_seconds`` the stream ends and EventSource clients
+        reconnect, so no request thread is held forever.
+
+        :param subscription: subscription of the client
+        :type subscription: Subscription
+        """
+        deadline = time.monotonic() + max_seconds
+        sent = 0
+        try:
+            yield f'retry: {int(retry * 1000)}\n\n'
+            while time.monotonic() < deadline:
+                message = subscription.get(timeout=heartbeat)
+                if message is None and subscription.take_resync():
+                    for snapshot in self.snapshots(subscription):
+                        sent += 1
+                        yield format_event('snapshot', snapshot, sent)
+                elif message is None:
+                    yield ': heartbeat\n\n'
+                else:
+                    sent += 1
+                    yield format_event(message[0], message[1], sent)
+        finally:
+            self.messages += sent
+            self.unsubscribe(subscription)
@@ -1,26 +1,35 @@
+import os
 import random
+import stat
+import tempfile
 
 
-def flatten_json(y):
-    '''Flattens the JSON data
-    '''
-    out = {}
+def iter_flatten(y, separator='__'):
+    '''Yields the leaves of the JSON data as (flat key, value) pairs
+
+    Nested keys and list indices are joined with separator, in the order of
+    the data. The data is walked with a stack instead of recursion, so deeply
+    nested data does not hit the recursion limit and nothing is collected.
 
-    def flatten(x, name=''):
+    Args:
+        separator(optional, default='__'): string joining the keys of the levels
+    '''
+    stack = [('', y)]
+    while stack:
+        name, x = stack.pop()
         if type(x) is dict:
-            for a in x:
-                flatten(x[a], name + a + '__')
+            # pushed in reverse to be taken in order
+            stack.extend((name + a + separator, x[a]) for a in reversed(list(x)))
         elif type(x) is list:
-            i = 0
-            for a in x:
-                flatten(a, name + str(i) + '__')
-                i += 1
+            stack.extend((name + str(i) + separator, x[i]) for i in range(len(x) - 1, -1, -1))
         else:
-            out[name[:-2]] = x
+            yield name[:-len(separator)], x
 
-    flatten(y)
 
-    return out
+def flatten_json(y):
+    '''Flattens the JSON data
+    '''
+    return dict(iter_flatten(y))
 
 
 def retry_timer(which_retry, retry_base_interval, mode=None):
@@ -42,3 +51,22 @@ def retry_timer(which_retry, retry_base_interval, mode=None):
         retry_wait_interval = which_retry * retry_base_interval * random.random()
 
     return {'mode': mode, 'interval': retry_wait_interval, 'retry': which_retry}
+
+
+def private_dir():
+    '''Directory in the temp directory for the files of the app, only its user may access it
+
+    The files in it, e.g., the pickles of the sqlite cache, are trusted when
+    they are read, so a directory that another user created first or may
+    write to is refused.
+    '''
+    uid = os.getuid() if hasattr(os, 'getuid') else None
+    path = os.path.join(tempfile.gettempdir(), f'tram-bot-{uid}' if uid is not None else 'tram-bot')
+    os.makedirs(path, mode=0o700, exist_ok=True)
+
+    info = os.lstat(path)
+    if uid is not None and (
+        not stat.S_ISDIR(info.st_mode) or info.st_uid != uid or info.st_mode & 0o077
+    ):
+        raise Exception(f'{path} is not a private directory of this user, choose the paths of the files yourself')
+    return path
@@ -0,0 +1,116 @@
+"""
+Compare the cache backends the way gunicorn uses them: several worker
+processes looking up zipf-distributed station keys with a TTL and fetching
+on a miss.
+
+Reports the hit rate over all workers (a private memory cache misses once
+per worker, shared backends once per node) and get/set latencies.
+
+    python benchmarks/cache_bench.py --workers 4 --lookups 5000 [--redis redis://localhost:6379/0]
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+__location__ = os.path.realpath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(__location__, '..', 'app'))
+
+from utils.cache import TTLCache, get_backend
+
+
+def percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(int(round(q / 100 * (len(values) - 1))), len(values) - 1)]
+
+
+def worker(url, seed, lookups, stations, ttl, fetch_seconds, results):
+    backend = get_backend(url)
+    cache = TTLCache(ttl=ttl, backend=backend, namespace='bench:')
+    rng = random.Random(seed)
+    keys = [str(i) for i in range(stations)]
+    weights = [1 / (rank + 1) ** 1.1 for rank in range(stations)]
+
+    def fetch():
+        time.sleep(fetch_seconds)
+        return {'fetched_at': time.time(), 'departures': [{'line': '1'}] * 20}
+
+    get_latencies = []
+    lookup_latencies = []
+    for _ in range(lookups):
+        key = rng.choices(keys, weights=weights)[0]
+        start = time.perf_counter()
+        cache.get(key)
+        get_latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        cache.get_or_set(key, fetch)
+        lookup_latencies.append(time.perf_counter() - start)
+
+    results.put({
+        'hits': cache.hits,
+        'misses': cache.misses,
+        'coalesced': cache.coalesced,
+        'get': get_latencies,
+        'lookup': lookup_latencies,
+    })
+
+
+def run(url, workers, lookups, stations, ttl, fetch_seconds):
+    results = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(
+            target=worker,
+            args=(url, k, lookups, stations, ttl, fetch_seconds, results)
+        )
+        for k in range(workers)
+    ]
+    start = time.perf_counter()
+    for p in processes:
+        p.start()
+    collected = [results.get() for _ in processes]
+    for p in processes:
+        p.join()
+    elapsed = time.perf_counter() - start
+
+    hits = sum(r['hits'] + r['coalesced'] for r in collected)
+    misses = sum(r['misses'] for r in collected)
+    gets = [v for r in collected for v in r['get']]
+    return {
+        'hit_rate': hits / (hits + misses),
+        'upstream_fetches': misses,
+        'get_p50_us': percentile(gets, 50) * 1e6,
+        'get_p99_us': percentile(gets, 99) * 1e6,
+        'elapsed_s': elapsed,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--lookups', type=int, default=5000)
+    parser.add_argument('--stations', type=int, default=200)
+    parser.add_argument('--ttl', type=float, default=20)
+    parser.add_argument('--fetch-seconds', type=float, default=0.005)
+    parser.add_argument('--redis', help='also benchmark a redis server')
+    args = parser.parse_args()
+
+    sqlite_path = os.path.join(tempfile.mkdtemp(), 'bench.sqlite')
+    backends = {'memory': 'memory://', 'sqlite': f'sqlite://{sqlite_path}'}
+    if args.redis:
+        backends['redis'] = args.redis
+
+    print(f'{"backend":<10}{"hit rate":>10}{"fetches":>10}{"get p50 us":>12}{"get p99 us":>12}{"total s":>10}')
+    for name, url in backends.items():
+        result = run(
+            url, args.workers, args.lookups, args.stations, args.ttl, args.fetch_seconds
+        )
+        print(
+            f'{name:<10}{result["hit_rate"]:>10.3f}{result["upstream_fetches"]:>10}'
+            f'{result["get_p50_us"]:>12.1f}{result["get_p99_us"]:>12.1f}{result["elapsed_s"]:>10.2f}'
+        )
@@ -0,0 +1,95 @@
+"""
+Sweep the departures of all stations into a network snapshot, against the
+kvb stand-in, and report the crawl time and the memory of the columnar
+snapshot next to the lists of dicts it is built from.
+
+    python benchmarks/crawl_bench.py --latency 0.05 --rate 200 --concurrency 16
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+__location__ = os.path.realpath(os.path.dirname(__file__))
+sys.path.insert(0, __location__)
+sys.path.insert(0, os.path.join(__location__, '..', 'app'))
+
+from kvb_server import KVBStandIn
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--rate', type=float, default=200, help='requests per second to the stand-in')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--within', type=int, default=10)
+    args = parser.parse_args()
+
+    kvb = KVBStandIn(latency=args.latency).start()
+    os.environ.update({
+        'KVB_BASE_URL': kvb.url, 'KVB_CACHE_URL': 'memory://',
+        'KVB_DEPARTURES_TTL': '600',
+    })
+
+    import app
+    from utils.ratelimit import TokenBucket
+    from utils.snapshot import NetworkCrawler, SnapshotBuilder
+
+    results = {}
+
+    def fetch(station_id):
+        fetched = app.fetch_departures(station_id)
+        results[station_id] = fetched
+        return fetched
+
+    crawler = NetworkCrawler(
+        fetch=fetch,
+        stations=lambda: list(app._STATION_MAP.inverse),
+        limiter=TokenBucket(rate=args.rate),
+        concurrency=args.concurrency,
+    )
+    try:
+        snapshot = crawler.crawl()
+    finally:
+        kvb.stop()
+
+    # memory of the parsed departures as fetch_departures returns them
+    tracemalloc.start()
+    baseline = tracemalloc.take_snapshot()
+    copies = {
+        station_id: {
+            'fetched_at': fetched['fetched_at'],
+            'departures': [dict(dep, parsed_time=dict(dep['parsed_time'])) if 'parsed_time' in dep else dict(dep) for dep in fetched['departures']]
+        }
+        for station_id, fetched in results.items()
+    }
+    dicts_bytes = sum(
+        stat.size_diff for stat in tracemalloc.take_snapshot().compare_to(baseline, 'filename')
+    )
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    builder = SnapshotBuilder()
+    for station_id, fetched in copies.items():
+        builder.add(station_id, fetched)
+    builder.build()
+    build_ms = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    departing = snapshot.departing_within(args.within)
+    query_ms = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    for station_id in snapshot.station_ids:
+        snapshot.fetched(station_id)
+    lookup_us = (time.perf_counter() - start) * 1e6 / max(snapshot.stations, 1)
+
+    print(f'stations crawled:     {snapshot.stations} ({snapshot.failed} failed)')
+    print(f'crawl time:           {snapshot.crawl_seconds:.2f} s at {args.rate}/s, concurrency {args.concurrency}')
+    print(f'departures:           {len(snapshot)}, {len(snapshot.lines)} lines, {len(snapshot.terminals)} terminals')
+    print(f'snapshot memory:      {snapshot.memory_bytes() / 1024:.1f} KiB')
+    print(f'lists of dicts:       {dicts_bytes / 1024:.1f} KiB')
+    print(f'build snapshot:       {build_ms:.1f} ms')
+    print(f'next {args.within} minutes:      {len(departing)} departures in {query_ms:.2f} ms')
+    print(f'station lookup:       {lookup_us:.1f} us')
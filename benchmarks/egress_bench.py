@@ -0,0 +1,78 @@
+"""
+Fetch departures through the egress pool and a proxy stand-in that throttles busy exit ips.
+
+Starts the kvb stand-in and the proxy stand-in, then fetches --requests
+departure pages from --threads threads through an EgressPool of each of
+the --sessions sizes, and reports the pages fetched, the failed fetches,
+the sessions retired and the calls the proxy saw.
+
+    python benchmarks/egress_bench.py --requests 500 --session-limit 40 --bad-rate 0.25
+"""
+import argparse
+import os
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+__location__ = os.path.realpath(os.path.dirname(__file__))
+sys.path.insert(0, __location__)
+sys.path.insert(0, os.path.join(__location__, '..', 'app'))
+
+from kvb_server import KVBStandIn
+from proxy_server import ProxyStandIn
+from utils.egress import EgressPool
+
+
+def run(pool, kvb_url, requests, threads, stations=20):
+    outcomes = Counter()
+
+    def fetch(i):
+        station_id = i % stations
+        try:
+            page = pool.get(f'{kvb_url}/qr/{station_id}/', key=station_id)
+            outcomes[page.status_code] += 1
+        except Exception as e:
+            outcomes[type(e).__name__] += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(fetch, range(requests)))
+    return outcomes, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--sessions', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--session-limit', type=int, default=40)
+    parser.add_argument('--window', type=float, default=60)
+    parser.add_argument('--bad-rate', type=float, default=0.25)
+    parser.add_argument('--sticky', action='store_true')
+    args = parser.parse_args()
+
+    kvb = KVBStandIn(latency=0.01).start()
+    proxy = ProxyStandIn(
+        session_limit=args.session_limit, window=args.window, bad_rate=args.bad_rate
+    ).start()
+
+    try:
+        for size in args.sessions:
+            proxy.reset()
+            pool = EgressPool(proxy.proxy_config(), size=size, sticky=args.sticky)
+            outcomes, seconds = run(pool, kvb.url, args.requests, args.threads)
+            stats = proxy.stats()
+            print(f'{size} session(s){" sticky" if args.sticky else ""}: {seconds:.1f}s')
+            print(f'  pages fetched:    {outcomes[200]} of {args.requests}')
+            print(f'  failed fetches:   {args.requests - outcomes[200]} {dict(outcomes)}')
+            print(f'  sessions retired: {pool.retired}')
+            print(
+                f'  proxy calls:      {sum(s["requests"] for s in stats.values())} over '
+                f'{len(stats)} sessions, {sum(s.get("throttled", 0) for s in stats.values())} throttled, '
+                f'{sum(s.get("error", 0) for s in stats.values())} errors, '
+                f'{sum(1 for s in stats.values() if s["bad"])} bad sessions'
+            )
+    finally:
+        proxy.stop()
+        kvb.stop()
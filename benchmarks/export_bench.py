@@ -0,0 +1,96 @@
+"""
+Measure the streaming export of departures: time to the first row, total
+time and memory of the worker as the number of exported stations grows.
+
+Starts the kvb stand-in and the app with one worker, then downloads
+/export/departures/ for the first --stations stations of the map, twice
+each so the second run reads the cache, and reports the rows, bytes and the
+resident memory of the worker after every run (on linux).
+
+    python benchmarks/export_bench.py --stations 50 200 800 --format csv
+"""
+import argparse
+import os
+import sys
+import time
+
+import requests
+
+__location__ = os.path.realpath(os.path.dirname(__file__))
+sys.path.insert(0, __location__)
+sys.path.insert(0, os.path.join(__location__, '..', 'app'))
+
+from kvb_server import KVBStandIn
+from load import start_app
+from utils.stations import load_station_map
+
+
+def worker_rss(process):
+    """
+    worker_rss is the resident memory of the gunicorn worker in MiB, None if it can not be read
+    """
+    try:
+        with open(f'/proc/{process.pid}/task/{process.pid}/children') as fp:
+            worker = fp.read().split()[0]
+        with open(f'/proc/{worker}/status') as fp:
+            for line in fp:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except (OSError, IndexError):
+        return None
+
+
+def export(app_url, station_ids, kind):
+    start = time.perf_counter()
+    first = None
+    rows = 0
+    size = 0
+    with requests.post(
+        f'{app_url}/export/departures/', params={'format': kind},
+        json={'stations': station_ids}, stream=True, timeout=600
+    ) as response:
+        response.raise_for_status()
+        encoding = response.headers.get('Transfer-Encoding')
+        for chunk in response.iter_content(chunk_size=None):
+            if first is None:
+                first = time.perf_counter() - start
+            rows += chunk.count(b'\n')
+            size += len(chunk)
+    if kind == 'csv':
+        rows -= 1
+    return first, time.perf_counter() - start, rows, size, encoding
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--stations', type=int, nargs='+', default=[50, 200, 800])
+    parser.add_argument('--format', default='ndjson', choices=['ndjson', 'csv'])
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds kvb.koeln takes per page')
+    parser.add_argument('--workers', type=int, default=8, help='KVB_EXPORT_WORKERS')
+    args = parser.parse_args()
+
+    station_ids = sorted(load_station_map().inverse)
+    kvb = KVBStandIn(latency=args.latency).start()
+    process, app_url = start_app(
+        kvb.url, workers=1, threads=4,
+        env={
+            'KVB_CACHE_URL': 'memory://', 'KVB_PREFETCH': '0', 'KVB_STATIONS_REFRESH': '0',
+            'KVB_UPSTREAM_RATE': '1000', 'KVB_DEPARTURES_TTL': '3600',
+            'KVB_EXPORT_WORKERS': str(args.workers),
+        }
+    )
+    try:
+        for count in args.stations:
+            for run in ('cold', 'cached'):
+                first, total, rows, size, encoding = export(app_url, station_ids[:count], args.format)
+                rss = worker_rss(process)
+                print(
+                    f'{count:5d} stations {run:<7} first row {first * 1000:7.1f} ms, '
+                    f'total {total:6.2f} s, {rows:6d} rows, {size / 1024:7.1f} KiB, '
+                    f'{encoding or "not chunked"}, worker rss '
+                    + (f'{rss:.1f} MiB' if rss is not None else 'unknown')
+                )
+    finally:
+        process.terminate()
+        process.wait()
+        kvb.stop()
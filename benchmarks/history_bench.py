@@ -0,0 +1,99 @@
+"""
+Measure the departure history: the cost of recording on the request path,
+the write throughput of the batched writer and range queries over months of rows.
+
+Records --days of synthetic sweeps, --stations stations every --every
+seconds with --rows departures each, into a fresh database, then times
+queries by station, by line and by both over a day, a week and the whole
+range.
+
+    python benchmarks/history_bench.py --days 30 --stations 50
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+__location__ = os.path.realpath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(__location__, '..', 'app'))
+
+from utils.history import DepartureHistory
+
+_LINES = [str(line) for line in (1, 3, 4, 5, 7, 9, 12, 13, 15, 16, 18)]
+_TERMINALS = ['Weiden West', 'Sülz', 'Frechen', 'Bensberg', 'Thielenbruch', 'Sürth', 'Ubierring', 'Bocklemünd']
+
+
+def fetched(observed_at, rows):
+    return {
+        'fetched_at': observed_at,
+        'departures': [
+            {
+                'line': random.choice(_LINES),
+                'terminal': random.choice(_TERMINALS),
+                'parsed_time': {'value': random.randint(0, 30), 'unit': 'min'},
+            }
+            for _ in range(rows)
+        ]
+    }
+
+
+def timed(func, runs=5):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times), result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--stations', type=int, default=50)
+    parser.add_argument('--every', type=int, default=300)
+    parser.add_argument('--rows', type=int, default=8)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), 'history.sqlite')
+    history = DepartureHistory(path=path, buffer_size=10 ** 6)
+    end = int(time.time())
+    start = end - args.days * 86400
+    samples = [fetched(0, args.rows) for _ in range(100)]
+
+    record_seconds = 0.0
+    write_seconds = 0.0
+    for observed_at in range(start, end, args.every):
+        for station_id in range(1, args.stations + 1):
+            sample = samples[random.randrange(len(samples))]
+            t = time.perf_counter()
+            history.record(station_id, {**sample, 'fetched_at': observed_at})
+            record_seconds += time.perf_counter() - t
+        if history.pending >= 100000:
+            t = time.perf_counter()
+            history.flush()
+            write_seconds += time.perf_counter() - t
+    t = time.perf_counter()
+    history.flush()
+    write_seconds += time.perf_counter() - t
+
+    fetches = history.recorded // args.rows
+    print(f'rows:    {history.written} in {os.path.getsize(path) / 2 ** 20:.1f} MiB, '
+          f'{os.path.getsize(path) / history.written:.1f} bytes per row')
+    print(f'record:  {record_seconds / fetches * 1e6:.1f} us per fetch on the request path')
+    print(f'write:   {history.written / write_seconds:,.0f} rows/s in batches of {history.batch_size}')
+
+    day = end - 86400
+    week = end - 7 * 86400
+    queries = [
+        ('station, last day', dict(station_id=7, since=day, until=end)),
+        ('line, last day', dict(line='5', since=day, until=end)),
+        ('station and line, last week', dict(station_id=7, line='5', since=week, until=end)),
+        ('station and line, all', dict(station_id=7, line='5', since=start, until=end, limit=10 ** 6)),
+        ('one hour, all stations', dict(since=day, until=day + 3600, limit=10 ** 6)),
+    ]
+    for name, kwargs in queries:
+        seconds, rows = timed(lambda: history.query(**kwargs))
+        print(f'query:   {seconds * 1000:8.2f} ms  {len(rows):7d} rows  {name}')
@@ -0,0 +1,194 @@
+"""
+Local stand-in for kvb.koeln serving the saved fixtures.
+
+It answers /qr/<station id>/ and /haltestellen/overview/ with configurable
+latency and error rates and counts every upstream call, GET /_stats returns
+the counts and POST /_reset clears them. The overview page carries an ETag
+and is answered with 304 Not Modified when it is sent back. Point the app to it with
+KVB_BASE_URL.
+
+    python benchmarks/kvb_server.py --port 8001 --latency 0.1 --error-rate 0.05
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+__location__ = os.path.realpath(os.path.dirname(__file__))
+
+_RE_QR = re.compile(r'^/qr/(?P<station_id>\d+)/?$')
+_RE_OVERVIEW = re.compile(r'^/haltestellen/overview/?$')
+
+
+def load_fixture(name):
+    with open(os.path.join(__location__, 'fixtures', name), 'rb') as fp:
+        return fp.read()
+
+
+class KVBStandIn(object):
+    """
+    KVBStandIn serves the fixtures on a local port in a background thread.
+
+    :param latency: mean seconds before a response is sent
+    :type latency: float
+    :param jitter: seconds of uniform random noise added to the latency
+    :type jitter: float
+    :param error_rate: fraction of requests answered with a 503
+    :type error_rate: float
+    :param hang_rate: fraction of requests that take hang_seconds
+    :type hang_rate: float
+    :param hang_seconds: latency of hanging requests
+    :type hang_seconds: float
+    """
+
+    def __init__(
+        self, host='127.0.0.1', port=0, latency=0.05, jitter=0.0,
+        error_rate=0.0, hang_rate=0.0, hang_seconds=30
+        ):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.hang_rate = hang_rate
+        self.hang_seconds = hang_seconds
+
+        self.pages = {
+            'overview': load_fixture('overview.html'),
+            'qr_46': load_fixture('qr_46.html'),
+            'qr_8': load_fixture('qr_8.html'),
+            'qr_empty': load_fixture('qr_empty.html'),
+        }
+        self.calls = Counter()
+        self._lock = threading.Lock()
+
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                standin.handle(self)
+
+            def do_POST(self):
+                standin.handle(self)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self.server.serve_forever, name='kvb-standin', daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def stats(self):
+        with self._lock:
+            return dict(self.calls)
+
+    def reset(self):
+        with self._lock:
+            self.calls.clear()
+
+    def qr_page(self, station_id):
+        # stations without a fixture of their own get one of the two busy pages
+        page = self.pages.get(f'qr_{station_id}')
+        if page is None:
+            page = self.pages['qr_46'] if station_id % 2 else self.pages['qr_8']
+        return page
+
+    def handle(self, request):
+        path = request.path.split('?', 1)[0]
+
+        if path == '/_stats':
+            return self.respond(request, 200, json.dumps(self.stats()).encode(), 'application/json')
+        if path == '/_reset':
+            self.reset()
+            return self.respond(request, 200, b'{}', 'application/json')
+
+        qr = _RE_QR.match(path)
+        if qr:
+            kind, body = 'qr', self.qr_page(int(qr.group('station_id')))
+        elif _RE_OVERVIEW.match(path):
+            kind, body = 'overview', self.pages['overview']
+        else:
+            return self.respond(request, 404, b'not found', 'text/plain')
+
+        with self._lock:
+            self.calls[kind] += 1
+
+        delay = self.latency + random.uniform(0, self.jitter)
+        if random.random() < self.hang_rate:
+            delay = self.hang_seconds
+        time.sleep(delay)
+
+        if random.random() < self.error_rate:
+            with self._lock:
+                self.calls[f'{kind}_errors'] += 1
+            return self.respond(request, 503, b'service unavailable', 'text/plain')
+
+        headers = {}
+        if kind == 'overview':
+            etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+            headers['ETag'] = etag
+            if request.headers.get('If-None-Match') == etag:
+                with self._lock:
+                    self.calls['overview_not_modified'] += 1
+                return self.respond(request, 304, b'', None, headers)
+
+        return self.respond(request, 200, body, 'text/html; charset=utf-8', headers)
+
+    def respond(self, request, status, body, content_type, headers=None):
+        try:
+            request.send_response(status)
+            for name, value in (headers or {}).items():
+                request.send_header(name, value)
+            if content_type:
+                request.send_header('Content-Type', content_type)
+            request.send_header('Content-Length', str(len(body)))
+            request.end_headers()
+            request.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # the client gave up, e.g., after a timeout
+            pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--hang-rate', type=float, default=0.0)
+    parser.add_argument('--hang-seconds', type=float, default=30)
+    args = parser.parse_args()
+
+    standin = KVBStandIn(
+        host=args.host, port=args.port, latency=args.latency, jitter=args.jitter,
+        error_rate=args.error_rate, hang_rate=args.hang_rate,
+        hang_seconds=args.hang_seconds,
+    )
+    print(f'serving kvb fixtures on {standin.url}')
+    try:
+        standin.server.serve_forever()
+    except KeyboardInterrupt:
+        standin.stop()
@@ -0,0 +1,226 @@
+"""
+Load scenarios against the app with kvb.koeln replaced by the local stand-in.
+
+Starts benchmarks/kvb_server.py and the app under gunicorn (unless --kvb-url
+or --app-url point to running ones), runs concurrent clients for a while
+and reports latency percentiles, throughput and upstream calls. Results
+can be saved and compared against a baseline run:
+
+    python benchmarks/load.py --scenario departures --output before.json
+    python benchmarks/load.py --scenario departures --baseline before.json
+
+Scenarios: departures (GET /station/<id>/departures/), post_station
+(POST /station), slack (POST /slack/kvb/departures) and mixed.
+"""
+import argparse
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import requests
+
+__location__ = os.path.realpath(os.path.dirname(__file__))
+sys.path.insert(0, __location__)
+
+from kvb_server import KVBStandIn
+
+_APP_DIR = os.path.join(__location__, '..', 'app')
+
+
+def station_pool(size=50, seed=46):
+    """
+    station_pool picks stations with zipf weights, a few stations get most requests
+    """
+    with open(os.path.join(_APP_DIR, 'utils', 'stations.json'), 'r') as fp:
+        stations = list(json.load(fp).items())
+
+    rng = random.Random(seed)
+    rng.shuffle(stations)
+    stations = stations[:size]
+    weights = [1 / (rank + 1) ** 1.1 for rank in range(len(stations))]
+
+    return stations, weights
+
+
+def request_departures(session, app_url, name, station_id):
+    return session.get(f'{app_url}/station/{station_id}/departures/')
+
+
+def request_post_station(session, app_url, name, station_id):
+    return session.post(f'{app_url}/station', json={'station': name})
+
+
+def request_slack(session, app_url, name, station_id):
+    return session.post(
+        f'{app_url}/slack/kvb/departures',
+        data={'command': '/kvb', 'text': name}
+    )
+
+
+SCENARIOS = {
+    'departures': [request_departures],
+    'post_station': [request_post_station],
+    'slack': [request_slack],
+    'mixed': [request_departures, request_post_station, request_slack],
+}
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    k = min(int(round(q / 100 * (len(values) - 1))), len(values) - 1)
+    return values[k]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_app(kvb_url, workers, threads, env=None):
+    port = free_port()
+    app_env = {**os.environ, 'KVB_BASE_URL': kvb_url, **(env or {})}
+    process = subprocess.Popen(
+        [
+            sys.executable, '-m', 'gunicorn', '--pythonpath', _APP_DIR,
+            '--bind', f'127.0.0.1:{port}', '--workers', str(workers),
+            '--worker-class', 'gthread', '--threads', str(threads),
+            '--log-level', 'warning', 'app:app'
+        ],
+        env=app_env,
+    )
+    app_url = f'http://127.0.0.1:{port}'
+
+    for _ in range(300):
+        try:
+            requests.get(f'{app_url}/', timeout=1)
+            return process, app_url
+        except requests.RequestException:
+            time.sleep(0.1)
+
+    process.terminate()
+    raise Exception(f'app did not start on {app_url}')
+
+
+def run_scenario(app_url, scenario, concurrency, duration, seed=46):
+    stations, weights = station_pool(seed=seed)
+    requesters = SCENARIOS[scenario]
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+    stop_at = time.perf_counter() + duration
+
+    def client(k):
+        rng = random.Random(seed + k)
+        session = requests.Session()
+        while time.perf_counter() < stop_at:
+            name, station_id = rng.choices(stations, weights=weights)[0]
+            requester = rng.choice(requesters)
+            start = time.perf_counter()
+            try:
+                status = requester(session, app_url, name, station_id).status_code
+            except requests.RequestException:
+                status = 'error'
+            latency = time.perf_counter() - start
+            with lock:
+                latencies.append(latency)
+                statuses[status] = statuses.get(status, 0) + 1
+
+    start = time.perf_counter()
+    clients = [threading.Thread(target=client, args=(k,)) for k in range(concurrency)]
+    for c in clients:
+        c.start()
+    for c in clients:
+        c.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'scenario': scenario,
+        'concurrency': concurrency,
+        'requests': len(latencies),
+        'statuses': {str(k): v for k, v in statuses.items()},
+        'throughput': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'max_ms': (latencies[-1] if latencies else 0) * 1000,
+    }
+
+
+def report(result, baseline=None):
+    keys = [
+        'requests', 'throughput', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms',
+        'upstream_calls', 'upstream_calls_per_request',
+    ]
+    print(f"scenario {result['scenario']}, {result['concurrency']} clients, statuses {result['statuses']}")
+    for key in keys:
+        line = f'{key:<28}{result[key]:>12.2f}'
+        if baseline and key in baseline and baseline[key]:
+            change = (result[key] - baseline[key]) / baseline[key] * 100
+            line += f'{baseline[key]:>12.2f}{change:>+9.1f}%'
+        print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scenario', choices=list(SCENARIOS), default='departures')
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--app-url', help='benchmark a running app instead')
+    parser.add_argument('--kvb-url', help='use a running stand-in instead')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0.1)
+    parser.add_argument('--jitter', type=float, default=0.05)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--env', action='append', default=[], help='KEY=VALUE passed to the app')
+    parser.add_argument('--output', help='save the result as json')
+    parser.add_argument('--baseline', help='compare against a saved result')
+    args = parser.parse_args()
+
+    standin = None
+    kvb_url = args.kvb_url
+    if kvb_url is None:
+        standin = KVBStandIn(
+            latency=args.latency, jitter=args.jitter, error_rate=args.error_rate
+        ).start()
+        kvb_url = standin.url
+
+    process = None
+    app_url = args.app_url
+    if app_url is None:
+        env = dict(i.split('=', 1) for i in args.env)
+        process, app_url = start_app(kvb_url, args.workers, args.threads, env=env)
+
+    try:
+        requests.post(f'{kvb_url}/_reset')
+        result = run_scenario(app_url, args.scenario, args.concurrency, args.duration)
+        upstream = requests.get(f'{kvb_url}/_stats').json()
+        result['upstream'] = upstream
+        result['upstream_calls'] = upstream.get('qr', 0)
+        result['upstream_calls_per_request'] = (
+            result['upstream_calls'] / result['requests'] if result['requests'] else 0
+        )
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+        if standin is not None:
+            standin.stop()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r') as fp:
+            baseline = json.load(fp)
+    report(result, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(result, fp, indent=2)
@@ -0,0 +1,84 @@
+"""
+Micro-benchmark of the departure table parser backends.
+
+Checks that every backend returns the same rows as the BeautifulSoup
+reference on the saved fixtures, then reports parse time and peak memory
+per page.
+
+    python benchmarks/parser_bench.py [--runs 200]
+"""
+import argparse
+import glob
+import os
+import sys
+import time
+import tracemalloc
+
+__location__ = os.path.realpath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(__location__, '..', 'app'))
+
+from utils.parser import PARSER_BACKENDS, parse_departure_table, parse_time
+
+
+def load_fixtures():
+    fixtures = {}
+    for path in sorted(glob.glob(os.path.join(__location__, 'fixtures', 'qr_*.html'))):
+        with open(path, 'r') as fp:
+            fixtures[os.path.basename(path)] = fp.read()
+    return fixtures
+
+
+def check_equivalence(fixtures):
+    ok = True
+    for name, html in fixtures.items():
+        expected = parse_departure_table(html, backend='bs4')
+        for backend in PARSER_BACKENDS:
+            got = parse_departure_table(html, backend=backend)
+            if got != expected:
+                ok = False
+                print(f'MISMATCH {backend} on {name}:\n  {got}\n  {expected}')
+    return ok
+
+
+def parse_page(html, backend):
+    rows = parse_departure_table(html, backend=backend) or []
+    for row in rows:
+        try:
+            parse_time(row.get('departures_in', ''))
+        except Exception:
+            pass
+    return rows
+
+
+def benchmark(html, backend, runs):
+    # warm up lazy imports
+    parse_page(html, backend)
+
+    start = time.perf_counter()
+    for _ in range(runs):
+        parse_page(html, backend)
+    elapsed_ms = (time.perf_counter() - start) * 1000 / runs
+
+    tracemalloc.start()
+    parse_page(html, backend)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return elapsed_ms, peak / 1024
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=200)
+    args = parser.parse_args()
+
+    fixtures = load_fixtures()
+    if not check_equivalence(fixtures):
+        sys.exit(1)
+    print(f'all backends agree on {len(fixtures)} fixtures\n')
+
+    print(f'{"fixture":<16}{"backend":<10}{"ms/page":>10}{"peak KiB":>10}')
+    for name, html in fixtures.items():
+        for backend in PARSER_BACKENDS:
+            elapsed_ms, peak_kib = benchmark(html, backend, args.runs)
+            print(f'{name:<16}{backend:<10}{elapsed_ms:>10.3f}{peak_kib:>10.1f}')
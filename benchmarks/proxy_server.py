@@ -0,0 +1,259 @@
+"""
+Local stand-in for the luminati super proxy.
+
+It is a plain forward HTTP proxy: requests come with an absolute url and a
+Proxy-Authorization of `<username>-session-<id>:<password>`, as built by
+utils.fetch.luminati_proxies, and are relayed to the target. Every session
+id stands for one exit ip:
+
+- a session answering more than --session-limit requests within
+  --window seconds is throttled with a 429, like kvb.koeln does to a busy ip
+- a fraction --bad-rate of the sessions is bad and answers --bad-error-rate
+  of its requests with a 502
+- --latency seconds are added to every request
+
+GET /_stats on the proxy itself returns the counts per session and POST
+/_reset clears them. Point the app to it with
+
+    KVB_FETCH_ENGINE=egress
+    KVB_PROXY_CONFIG='{"username": "bot", "password": "pw", "host": "127.0.0.1", "port": 8002}'
+
+    python benchmarks/proxy_server.py --port 8002 --session-limit 50 --bad-rate 0.2
+"""
+import argparse
+import base64
+import http.client
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+_RE_SESSION = re.compile(r'^(?P<username>.+)-session-(?P<session_id>[^:]+)$')
+
+
+class ProxyStandIn(object):
+    """
+    ProxyStandIn relays requests on a local port in a background thread.
+
+    :param latency: seconds added to every request
+    :type latency: float
+    :param session_limit: requests of a session per window before it is throttled, 0 never throttles
+    :type session_limit: int
+    :param window: seconds of the throttling window
+    :type window: float
+    :param bad_rate: fraction of the sessions that are bad
+    :type bad_rate: float
+    :param bad_error_rate: fraction of the requests of a bad session answered with a 502
+    :type bad_error_rate: float
+    :param username: expected username, None accepts any
+    :type username: str
+    :param password: expected password, None accepts any
+    :type password: str
+    """
+
+    def __init__(
+        self, host='127.0.0.1', port=0, latency=0.0, session_limit=0, window=60,
+        bad_rate=0.0, bad_error_rate=0.8, username=None, password=None
+        ):
+        self.latency = latency
+        self.session_limit = session_limit
+        self.window = window
+        self.bad_rate = bad_rate
+        self.bad_error_rate = bad_error_rate
+        self.username = username
+        self.password = password
+
+        self.calls = defaultdict(Counter)
+        self._bad = {}
+        self._recent = defaultdict(deque)
+        self._lock = threading.Lock()
+
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                standin.handle(self)
+
+            def do_POST(self):
+                standin.handle(self)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def proxy_config(self, username='bot', password='pw'):
+        """
+        proxy_config is the luminati config pointing to the stand-in
+        """
+        host, port = self.server.server_address[:2]
+        return {'username': username, 'password': password, 'host': host, 'port': port}
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self.server.serve_forever, name='proxy-standin', daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def stats(self):
+        with self._lock:
+            return {
+                session_id: {**counts, 'bad': self._bad.get(session_id, False)}
+                for session_id, counts in self.calls.items()
+            }
+
+    def reset(self):
+        with self._lock:
+            self.calls.clear()
+            self._recent.clear()
+            self._bad.clear()
+
+    def session_of(self, request):
+        """
+        session_of reads the session id from the Proxy-Authorization, None if it is missing or wrong
+        """
+        header = request.headers.get('Proxy-Authorization', '')
+        scheme, _, credentials = header.partition(' ')
+        if scheme.lower() != 'basic':
+            return None
+        try:
+            user, _, password = base64.b64decode(credentials).decode().partition(':')
+        except ValueError:
+            return None
+        match = _RE_SESSION.match(user)
+        if match is None:
+            return None
+        if self.username is not None and match.group('username') != self.username:
+            return None
+        if self.password is not None and password != self.password:
+            return None
+        return match.group('session_id')
+
+    def admit(self, session_id):
+        """
+        admit counts a request of a session and tells how to answer it
+
+        :return: 'ok', 'throttled' or 'error'
+        :rtype: str
+        """
+        now = time.monotonic()
+        with self._lock:
+            bad = self._bad.get(session_id)
+            if bad is None:
+                bad = self._bad[session_id] = random.random() < self.bad_rate
+
+            recent = self._recent[session_id]
+            while recent and recent[0] < now - self.window:
+                recent.popleft()
+            recent.append(now)
+
+            counts = self.calls[session_id]
+            counts['requests'] += 1
+            if self.session_limit and len(recent) > self.session_limit:
+                outcome = 'throttled'
+            elif bad and random.random() < self.bad_error_rate:
+                outcome = 'error'
+            else:
+                outcome = 'ok'
+            counts[outcome] += 1
+            return outcome
+
+    def handle(self, request):
+        target = urlsplit(request.path)
+        if not target.netloc:
+            # addressed to the stand-in itself
+            if target.path == '/_stats':
+                return self.respond(request, 200, json.dumps(self.stats()).encode(), 'application/json')
+            if target.path == '/_reset':
+                self.reset()
+                return self.respond(request, 200, b'{}', 'application/json')
+            return self.respond(request, 404, b'not found', 'text/plain')
+
+        session_id = self.session_of(request)
+        if session_id is None:
+            return self.respond(
+                request, 407, b'proxy authentication required', 'text/plain',
+                {'Proxy-Authenticate': 'Basic realm="proxy"'}
+            )
+
+        time.sleep(self.latency)
+        outcome = self.admit(session_id)
+        if outcome == 'throttled':
+            return self.respond(request, 429, b'too many requests', 'text/plain')
+        if outcome == 'error':
+            return self.respond(request, 502, b'bad gateway', 'text/plain')
+
+        length = int(request.headers.get('Content-Length') or 0)
+        body = request.rfile.read(length) if length else None
+        headers = {
+            name: value for name, value in request.headers.items()
+            if name.lower() not in ('proxy-authorization', 'proxy-connection', 'connection', 'host')
+        }
+        path = target.path + (f'?{target.query}' if target.query else '')
+        try:
+            upstream = http.client.HTTPConnection(target.hostname, target.port or 80, timeout=30)
+            upstream.request(request.command, path or '/', body=body, headers=headers)
+            response = upstream.getresponse()
+            payload = response.read()
+            upstream.close()
+        except OSError as e:
+            return self.respond(request, 502, str(e).encode(), 'text/plain')
+
+        return self.respond(
+            request, response.status, payload, response.getheader('Content-Type'),
+            {name: value for name, value in response.getheaders() if name.lower() == 'etag'}
+        )
+
+    def respond(self, request, status, body, content_type, headers=None):
+        try:
+            request.send_response(status)
+            for name, value in (headers or {}).items():
+                request.send_header(name, value)
+            if content_type:
+                request.send_header('Content-Type', content_type)
+            request.send_header('Content-Length', str(len(body)))
+            request.end_headers()
+            request.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # the client gave up, e.g., after a timeout
+            pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8002)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--session-limit', type=int, default=0)
+    parser.add_argument('--window', type=float, default=60)
+    parser.add_argument('--bad-rate', type=float, default=0.0)
+    parser.add_argument('--bad-error-rate', type=float, default=0.8)
+    args = parser.parse_args()
+
+    standin = ProxyStandIn(
+        host=args.host, port=args.port, latency=args.latency,
+        session_limit=args.session_limit, window=args.window,
+        bad_rate=args.bad_rate, bad_error_rate=args.bad_error_rate,
+    )
+    print(f'proxying on {args.host}:{standin.port}')
+    try:
+        standin.server.serve_forever()
+    except KeyboardInterrupt:
+        standin.stop()
@@ -0,0 +1,158 @@
+"""
+Local stand-in for slack receiving the deferred replies of the /kvb command.
+
+Every POST to /response/<name> is recorded. Run as a script it starts the
+kvb stand-in with a latency above slack's 3 second limit, the app and
+itself, sends slash commands with a response_url pointing here and reports
+how fast the command was acknowledged and the reply arrived:
+
+    python benchmarks/slack_server.py --kvb-latency 4 --commands 5
+"""
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+__location__ = os.path.realpath(os.path.dirname(__file__))
+sys.path.insert(0, __location__)
+
+# the app verifies the commands with it, as it does the ones of slack
+SIGNING_SECRET = 'slack-stand-in'
+
+
+def signed_headers(body, secret=SIGNING_SECRET):
+    """
+    signed_headers signs a form encoded body the way slack signs slash commands
+    """
+    timestamp = str(int(time.time()))
+    base = f'v0:{timestamp}:'.encode('utf-8') + body
+    return {
+        'Content-Type': 'application/x-www-form-urlencoded',
+        'X-Slack-Request-Timestamp': timestamp,
+        'X-Slack-Signature': 'v0=' + hmac.new(secret.encode('utf-8'), base, hashlib.sha256).hexdigest(),
+    }
+
+
+class SlackStandIn(object):
+    """
+    SlackStandIn records the payloads posted to its response urls.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.responses = {}
+        self._lock = threading.Lock()
+        self._arrived = threading.Condition(self._lock)
+
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                payload = json.loads(self.rfile.read(length) or b'null')
+                with standin._arrived:
+                    standin.responses.setdefault(self.path, []).append(
+                        (time.perf_counter(), payload)
+                    )
+                    standin._arrived.notify_all()
+                self.send_response(200)
+                self.send_header('Content-Length', '2')
+                self.end_headers()
+                self.wfile.write(b'ok')
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def response_url(self, name):
+        return f'{self.url}/response/{name}'
+
+    def start(self):
+        threading.Thread(
+            target=self.server.serve_forever, name='slack-standin', daemon=True
+        ).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def wait_for(self, name, timeout=30):
+        """
+        wait_for blocks until a reply was posted to the response url of name
+
+        :return: arrival time (perf_counter) and payload, None after the timeout
+        :rtype: tuple
+        """
+        path = f'/response/{name}'
+        with self._arrived:
+            self._arrived.wait_for(lambda: path in self.responses, timeout=timeout)
+            replies = self.responses.get(path)
+        return replies[0] if replies else None
+
+
+if __name__ == "__main__":
+    from urllib.parse import urlencode
+
+    from kvb_server import KVBStandIn
+    from load import start_app
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--kvb-latency', type=float, default=4)
+    parser.add_argument('--commands', type=int, default=5)
+    parser.add_argument('--text', default='dom')
+    args = parser.parse_args()
+
+    kvb = KVBStandIn(latency=args.kvb_latency).start()
+    slack = SlackStandIn().start()
+    process, app_url = start_app(
+        kvb.url, workers=1, threads=20,
+        env={'KVB_SLACK_SIGNING_SECRET': SIGNING_SECRET, 'KVB_SLACK_RESPONSE_HOSTS': '127.0.0.1'}
+    )
+
+    try:
+        for k in range(args.commands):
+            name = f'command-{k}'
+            start = time.perf_counter()
+            body = urlencode({
+                'command': '/kvb', 'text': args.text,
+                'response_url': slack.response_url(name)
+            }).encode('utf-8')
+            ack = requests.post(
+                f'{app_url}/slack/kvb/departures',
+                data=body, headers=signed_headers(body), timeout=10
+            )
+            ack_s = time.perf_counter() - start
+            if 'blocks' in ack.json():
+                # fresh departures were on hand, the reply came with the ack
+                print(f'{name}: inline reply in {ack_s:.3f}s with {len(ack.json()["blocks"])} blocks')
+                continue
+            reply = slack.wait_for(name, timeout=60)
+            if reply is None:
+                print(f'{name}: ack {ack_s:.3f}s, no reply')
+                continue
+            reply_s = reply[0] - start
+            print(
+                f'{name}: ack {ack_s:.3f}s, deferred reply {reply_s:.3f}s '
+                f'with {len(reply[1].get("blocks", []))} blocks'
+            )
+    finally:
+        process.terminate()
+        process.wait()
+        slack.stop()
+        kvb.stop()
@@ -0,0 +1,129 @@
+"""
+Measure the cold start of the app, what a sleeping dyno pays on its first request.
+
+Reports, over several runs in fresh interpreters:
+
+- import: wall time of `import app` minus the one of an empty interpreter
+- first response: from spawning gunicorn to the first answered departures
+  request (with the kvb stand-in), the lazily imported modules included
+- the modules costing the most import time, from python -X importtime
+
+    python benchmarks/startup_bench.py --runs 5
+    python benchmarks/startup_bench.py --no-prebuilt   # without app/utils/stations.idx
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import requests
+
+__location__ = os.path.realpath(os.path.dirname(__file__))
+sys.path.insert(0, __location__)
+
+from kvb_server import KVBStandIn
+from load import free_port
+
+_APP_DIR = os.path.realpath(os.path.join(__location__, '..', 'app'))
+
+
+def interpreter_seconds(code, env):
+    start = time.perf_counter()
+    subprocess.run(
+        [sys.executable, '-c', code], cwd=_APP_DIR, env=env, check=True,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    return time.perf_counter() - start
+
+
+def import_profile(env, top=10):
+    """
+    import_profile lists the modules with the largest cumulative import time in microseconds
+    """
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import app'],
+        cwd=_APP_DIR, env=env, check=True, capture_output=True, text=True
+    )
+    modules = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative_us, name = line[len('import time:'):].split('|')
+        # nested imports are indented by two spaces per level
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth <= 1:
+            # app, its own imports and theirs
+            modules.append((int(cumulative_us), name.strip()))
+    return sorted(modules, reverse=True)[:top]
+
+
+def first_response_seconds(env, path):
+    port = free_port()
+    app_url = f'http://127.0.0.1:{port}'
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [
+            sys.executable, '-m', 'gunicorn', '--pythonpath', _APP_DIR,
+            '--bind', f'127.0.0.1:{port}', '--workers', '1',
+            '--worker-class', 'gthread', '--threads', '4',
+            '--log-level', 'warning', 'app:app'
+        ],
+        env=env, stderr=subprocess.DEVNULL,
+    )
+    try:
+        while time.perf_counter() - start < 30:
+            try:
+                response = requests.get(f'{app_url}{path}', timeout=5)
+                if response.status_code == 200:
+                    return time.perf_counter() - start
+            except requests.RequestException:
+                pass
+            time.sleep(0.005)
+        raise Exception(f'app did not answer {path} within 30 seconds')
+    finally:
+        process.terminate()
+        process.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--path', default='/station/46/departures/')
+    parser.add_argument(
+        '--no-prebuilt', action='store_true',
+        help='hide the prebuilt station map, as if `python -m utils.stations build` was not run'
+    )
+    args = parser.parse_args()
+
+    kvb = KVBStandIn(latency=0).start()
+    env = {
+        **os.environ, 'KVB_BASE_URL': kvb.url, 'KVB_CACHE_URL': 'memory://',
+        'KVB_PREFETCH': '0', 'KVB_STATIONS_REFRESH': '0',
+    }
+    prebuilt = os.path.join(_APP_DIR, 'utils', 'stations.idx')
+    hidden = f'{prebuilt}.hidden'
+    if args.no_prebuilt and os.path.exists(prebuilt):
+        os.rename(prebuilt, hidden)
+
+    try:
+        # warm the file system cache, the numbers are for a warm disk
+        interpreter_seconds('import app', env)
+
+        baseline = [interpreter_seconds('pass', env) for _ in range(args.runs)]
+        imports = [interpreter_seconds('import app', env) for _ in range(args.runs)]
+        first = [first_response_seconds(env, args.path) for _ in range(args.runs)]
+        profile = import_profile(env)
+    finally:
+        if os.path.exists(hidden):
+            os.rename(hidden, prebuilt)
+        kvb.stop()
+
+    import_ms = (statistics.median(imports) - statistics.median(baseline)) * 1000
+    print(f'prebuilt station map: {"no" if args.no_prebuilt else os.path.exists(prebuilt)}')
+    print(f'import app:      {import_ms:8.1f} ms (median of {args.runs}, interpreter start excluded)')
+    print(f'first response:  {statistics.median(first) * 1000:8.1f} ms (median of {args.runs}, gunicorn start included)')
+    print('largest imports:')
+    for cumulative_us, name in profile:
+        print(f'  {cumulative_us / 1000:8.1f} ms  {name}')
@@ -0,0 +1,97 @@
+"""
+Compare the upstream load of display screens polling the departures with
+the one of screens subscribed to the departures stream.
+
+Starts the kvb stand-in and the app, then runs --clients screens for
+--seconds, either each polling /station/<id>/departures/ every --every
+seconds or each holding one /stream/departures/ connection, and reports
+the calls kvb.koeln got and the events the screens received.
+
+    python benchmarks/stream_bench.py --clients 50 --stations 5 --seconds 60
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+import requests
+
+__location__ = os.path.realpath(os.path.dirname(__file__))
+sys.path.insert(0, __location__)
+
+from kvb_server import KVBStandIn
+from load import start_app
+
+
+def poll_screen(app_url, station_id, every, stop_at, counts):
+    session = requests.Session()
+    while time.time() < stop_at:
+        session.get(f'{app_url}/station/{station_id}/departures/', timeout=30)
+        counts['responses'] += 1
+        time.sleep(every)
+
+
+def stream_screen(app_url, station_id, stop_at, counts):
+    with requests.get(
+        f'{app_url}/stream/departures/?stations={station_id}', stream=True, timeout=30
+    ) as response:
+        for line in response.iter_lines(decode_unicode=True):
+            if line.startswith('event: '):
+                counts[line[len('event: '):]] += 1
+            elif line.startswith(':'):
+                counts['heartbeat'] += 1
+            if time.time() > stop_at:
+                break
+
+
+def run(mode, app_url, kvb, clients, stations, seconds, every):
+    requests.post(f'{kvb.url}/_reset')
+    counts = {'responses': 0, 'snapshot': 0, 'diff': 0, 'heartbeat': 0}
+    stop_at = time.time() + seconds
+    threads = []
+    for k in range(clients):
+        station_id = 1 + k % stations
+        if mode == 'poll':
+            target, args = poll_screen, (app_url, station_id, every, stop_at, counts)
+        else:
+            target, args = stream_screen, (app_url, station_id, stop_at, counts)
+        thread = threading.Thread(target=target, args=args, daemon=True)
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join(seconds + 30)
+    return requests.get(f'{kvb.url}/_stats').json().get('qr', 0), counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--stations', type=int, default=5)
+    parser.add_argument('--seconds', type=float, default=60)
+    parser.add_argument('--every', type=float, default=5, help='seconds between two polls of a screen')
+    parser.add_argument('--workers', type=int, default=2)
+    args = parser.parse_args()
+
+    kvb = KVBStandIn(latency=0.05).start()
+    process, app_url = start_app(
+        kvb.url, workers=args.workers, threads=args.clients + 20,
+        env={
+            'KVB_CACHE_URL': 'memory://', 'KVB_PREFETCH': '0',
+            'KVB_STREAM_MAX_CLIENTS': str(args.clients),
+            'KVB_STREAM_INTERVAL': '5', 'KVB_STREAM_HEARTBEAT': '5',
+        }
+    )
+    try:
+        for mode in ('poll', 'stream'):
+            upstream, counts = run(
+                mode, app_url, kvb, args.clients, args.stations, args.seconds, args.every
+            )
+            print(
+                f'{mode:<7} {args.clients} screens, {args.stations} stations, {args.seconds:.0f}s: '
+                f'{upstream} kvb.koeln calls, {counts}'
+            )
+    finally:
+        process.terminate()
+        process.wait()
+        kvb.stop()